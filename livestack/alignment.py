@@ -0,0 +1,369 @@
+import logging
+import os
+from os.path import join
+from threading import Lock
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+import weakref
+
+import astroalign as aa
+import numpy as np
+from scipy import fft, ndimage
+import sep
+
+
+def find_stars(data: np.ndarray, detection_sigma: float = 5, min_area: int = 5) -> np.ndarray:
+    """
+    Detects stars the same way astroalign does, returning sep's source catalogue
+    sorted from brightest to faintest.
+    """
+    data = np.ascontiguousarray(data, dtype=np.float32)
+
+    bkg = sep.Background(data)
+    sources = sep.extract(data - bkg.back(), detection_sigma * bkg.globalrms, minarea=min_area)
+    sources.sort(order="flux")
+
+    return sources[::-1]
+
+
+def control_points(sources: np.ndarray, max_points: int = 50) -> np.ndarray:
+    return np.array([sources["x"][:max_points], sources["y"][:max_points]]).T
+
+
+class ReferenceStars:
+    """
+    Control points of the stack each key is aligned against. Detecting stars
+    on a full size stack is as expensive as on the incoming frame, so it is done
+    once per key and kept in memory and in a sidecar next to the stack. The
+    stack never moves, so the points only get refreshed each time the stack
+    doubles in depth and shows fainter stars.
+
+    The detection image of the stack, what stars are found and frames are
+    matched on, is kept in memory too, until the stack is replaced.
+    """
+
+    def __init__(self, folder: str, max_points: int = 50):
+        self.folder = folder
+        self.max_points = max_points
+        self._stars: Dict[str, Tuple[int, np.ndarray]] = {}
+        # a weak reference to the stack pixels each image was made from
+        self._images: Dict[str, Tuple[Any, np.ndarray]] = {}
+        self._lock = Lock()
+
+    def image(
+        self, key: str, reference: np.ndarray, fn: Callable[[np.ndarray], np.ndarray]
+    ) -> np.ndarray:
+        """
+        Returns `fn(reference)`, computed once per stack. Stacks are replaced
+        rather than changed in place, so the pixel array itself says whether
+        the stack is still the same one.
+        """
+        with self._lock:
+            entry = self._images.get(key)
+
+        if entry is not None and entry[0]() is reference:
+            return entry[1]
+
+        image = fn(reference)
+
+        with self._lock:
+            self._images[key] = (weakref.ref(reference), image)
+
+        return image
+
+    def get(self, key: str, data: np.ndarray, subcount: int) -> np.ndarray:
+        with self._lock:
+            entry = self._stars.get(key) or self._load(key)
+
+        # a shallower stack than the one the points came from means the stack
+        # was deleted and started over
+        if entry is None or subcount >= 2 * entry[0] or subcount < entry[0]:
+            logging.info(f"detecting reference stars for {key} at {subcount} subs")
+
+            points = control_points(find_stars(data), self.max_points)
+            entry = (subcount, points)
+
+            with self._lock:
+                self._save(key, entry)
+
+        with self._lock:
+            self._stars[key] = entry
+
+        return entry[1]
+
+    def _path(self, key: str) -> str:
+        return join(self.folder, f"{key}.stars.npz")
+
+    def _load(self, key: str) -> Optional[Tuple[int, np.ndarray]]:
+        try:
+            with np.load(self._path(key)) as f:
+                return int(f["subcount"]), f["points"]
+        except OSError:
+            return None
+
+    def _save(self, key: str, entry: Tuple[int, np.ndarray]):
+        path = self._path(key)
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(f, subcount=entry[0], points=entry[1])
+        os.replace(f"{path}.tmp", path)
+
+
+def warp(data: np.ndarray, params: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Applies a 3x3 (x, y) transform matrix, as used by skimage and astroalign, to
+    a (H, W) frame or to every channel of a (C, H, W) cube, sampling bilinearly
+    into `out`. The inverse mapping is worked out once and shared by all the
+    channels.
+    """
+    inverse = np.linalg.inv(params)
+
+    # skimage works in (x, y), ndimage in (row, col)
+    matrix = inverse[:2, :2][::-1, ::-1]
+    offset = inverse[:2, 2][::-1]
+
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
+
+    # a single 3d transform over the cube would interpolate along the channel
+    # axis too, which makes it over twice as slow as one pass per channel
+    for src, dst in zip(data.reshape((-1,) + data.shape[-2:]), out.reshape((-1,) + out.shape[-2:])):
+        ndimage.affine_transform(
+            src, matrix, offset, output=dst, order=1, mode="constant", cval=0.0
+        )
+
+    return out
+
+
+def downsample(data: np.ndarray, factor: int) -> np.ndarray:
+    h, w = data.shape[0] // factor, data.shape[1] // factor
+    blocks = data[: h * factor, : w * factor].reshape(h, factor, w, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def phase_correlate(
+    reference: np.ndarray, moving: np.ndarray, whiten: bool = True
+) -> Tuple[float, float, float]:
+    """
+    Finds the translation between two images of the same size. Returns the
+    sub-pixel (dy, dx) to shift `moving` by to line it up with `reference`, and
+    the height of the correlation peak in standard deviations of the
+    correlation surface.
+
+    With `whiten` this is phase correlation, which gives a sharp peak that is
+    easy to find and judge. Without it, it is plain cross correlation, whose
+    broader peak gives a more accurate sub-pixel position once the images are
+    already close.
+    """
+    window = np.outer(np.hanning(reference.shape[0]), np.hanning(reference.shape[1]))
+    window = window.astype(np.float32)
+
+    cross = fft.rfft2(reference * window) * np.conj(fft.rfft2(moving * window))
+    if whiten:
+        cross /= np.abs(cross) + 1e-12
+    corr = fft.irfft2(cross, s=reference.shape)
+
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    strength = float((corr[peak] - corr.mean()) / corr.std())
+
+    shift = []
+    for axis, size in enumerate(corr.shape):
+        before, after = list(peak), list(peak)
+        before[axis] = (peak[axis] - 1) % size
+        after[axis] = (peak[axis] + 1) % size
+
+        c0, cm, cp = corr[peak], corr[tuple(before)], corr[tuple(after)]
+        if min(c0, cm, cp) > 0:
+            # fit a gaussian through the peak and its neighbours
+            c0, cm, cp = np.log(c0), np.log(cm), np.log(cp)
+
+        denom = cm - 2 * c0 + cp
+        offset = 0.5 * (cm - cp) / denom if denom != 0 else 0.0
+
+        s = peak[axis] + offset
+        if s > size / 2:
+            s -= size
+        shift.append(float(s))
+
+    return shift[0], shift[1], strength
+
+
+class Aligner:
+    """
+    Registers frames against their stack.
+
+    In "auto" mode a frame is first matched by phase correlation on a
+    downsampled copy, which is enough for the usual dither between subs. The
+    same is done for each quadrant, and if the quadrants disagree with the
+    whole frame (rotation, or a field that doesn't match) or the correlation
+    peak is weak, the frame falls back to astroalign's star matching. In
+    "astroalign" mode every frame uses star matching.
+    """
+
+    CHANNELS = {"luminance": None, "red": 0, "green": 1, "blue": 2}
+
+    def __init__(
+        self,
+        folder: str,
+        mode: str = "auto",
+        channel: str = "luminance",
+        factor: int = 4,
+        min_strength: float = 10.0,
+        max_residual: float = 1.0,
+        refine_size: int = 1024,
+    ):
+        assert mode in ("auto", "astroalign"), mode
+        assert channel in self.CHANNELS, channel
+
+        self.mode = mode
+        # what colour frames are matched on
+        self.channel = channel
+        # downsampling factor for phase correlation
+        self.factor = factor
+        # weakest acceptable correlation peak, in standard deviations
+        self.min_strength = min_strength
+        # largest disagreement between quadrant and whole frame shifts, in pixels
+        self.max_residual = max_residual
+        # size of the full resolution crop used to refine the shift
+        self.refine_size = refine_size
+        self.reference_stars = ReferenceStars(folder)
+
+    def align(
+        self, key: str, data: np.ndarray, reference: np.ndarray, subcount: int
+    ) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """
+        Returns `data` registered onto `reference`, and metrics describing how
+        it was done.
+        """
+        start = time.perf_counter()
+        metrics: Optional[Dict[str, Any]] = None
+
+        moving = self._detection_image(data)
+        fixed = self.reference_stars.image(key, reference, self._detection_image)
+
+        if self.mode == "auto":
+            metrics = self._find_shift(moving, fixed)
+
+        if metrics is not None:
+            registered = self._shift(data, metrics["dy"], metrics["dx"])
+        else:
+            registered, metrics = self._astroalign(key, data, moving, fixed, subcount)
+
+        metrics["ms"] = (time.perf_counter() - start) * 1000
+
+        logging.info(
+            f"aligned {key} with {metrics['method']} in {metrics['ms']:.3f}ms, "
+            f"residual {metrics['residual']:.3f}px"
+        )
+
+        return registered, metrics
+
+    def _find_shift(self, data: np.ndarray, reference: np.ndarray) -> Optional[Dict[str, Any]]:
+        """
+        Matches the detection images of a frame and its stack.
+        """
+        f = self.factor
+        moving = self._prepare(data)
+        fixed = self._prepare(reference)
+
+        _, _, strength = phase_correlate(fixed, moving)
+        if strength < self.min_strength:
+            logging.info(f"weak phase correlation peak {strength:.1f}, falling back to astroalign")
+            return None
+
+        # the phase correlation peak says whether there is a match, plain cross
+        # correlation says more precisely where it is
+        dy, dx, _ = phase_correlate(fixed, moving, whiten=False)
+
+        h, w = fixed.shape[0] // 2, fixed.shape[1] // 2
+        residual = 0.0
+        for y in (0, h):
+            for x in (0, w):
+                qy, qx, _ = phase_correlate(
+                    fixed[y : y + h, x : x + w], moving[y : y + h, x : x + w], whiten=False
+                )
+                residual = max(residual, float(f * np.hypot(qy - dy, qx - dx)))
+
+        if residual > self.max_residual:
+            logging.info(
+                f"frame is not a pure shift ({residual:.3f}px), falling back to astroalign"
+            )
+            return None
+
+        dy, dx = self._refine(data, reference, f * dy, f * dx)
+
+        return {
+            "method": "phase",
+            "dy": dy,
+            "dx": dx,
+            "strength": strength,
+            "residual": residual,
+        }
+
+    def _refine(
+        self, data: np.ndarray, reference: np.ndarray, dy: float, dx: float
+    ) -> Tuple[float, float]:
+        """
+        The downsampled match is only good to a fraction of `factor` pixels, so
+        correlate a full resolution crop from the middle of the frame, offset by
+        the coarse shift, to get the sub-pixel remainder.
+        """
+        fixed, moving = reference, data
+
+        size = min(self.refine_size, fixed.shape[0] // 2, fixed.shape[1] // 2)
+        y0, x0 = (fixed.shape[0] - size) // 2, (fixed.shape[1] - size) // 2
+        iy, ix = int(round(dy)), int(round(dx))
+
+        if abs(iy) > y0 or abs(ix) > x0:
+            return dy, dx
+
+        a = fixed[y0 : y0 + size, x0 : x0 + size]
+        b = moving[y0 - iy : y0 - iy + size, x0 - ix : x0 - ix + size]
+
+        ry, rx, _ = phase_correlate(self._above_sky(a), self._above_sky(b), whiten=False)
+        if abs(ry) > 1 or abs(rx) > 1:
+            # the crop didn't agree with the coarse match, keep the coarse one
+            return dy, dx
+
+        return iy + ry, ix + rx
+
+    def _prepare(self, data: np.ndarray) -> np.ndarray:
+        return self._above_sky(downsample(data, self.factor))
+
+    def _above_sky(self, data: np.ndarray) -> np.ndarray:
+        # keep only what is above the sky, so gradients don't drive the match
+        return np.clip(data - np.median(data), 0.0, None)
+
+    def _detection_image(self, data: np.ndarray) -> np.ndarray:
+        if data.ndim != 3:
+            return data
+
+        channel = self.CHANNELS[self.channel]
+        if channel is None:
+            # the channels together show more stars than any one of them
+            return data.mean(axis=0, dtype=np.float32)
+
+        return data[channel]
+
+    def _shift(self, data: np.ndarray, dy: float, dx: float) -> np.ndarray:
+        return warp(data, np.array([[1.0, 0.0, dx], [0.0, 1.0, dy], [0.0, 0.0, 1.0]]))
+
+    def _astroalign(
+        self, key: str, data: np.ndarray, moving: np.ndarray, fixed: np.ndarray, subcount: int
+    ) -> Tuple[np.ndarray, Dict[str, Any]]:
+        stars = self.reference_stars.get(key, fixed, subcount)
+        transform, (src, dst) = aa.find_transform(moving, stars)
+
+        if data.ndim not in (2, 3):
+            raise Exception(f"invalid image dimensions {data.ndim}")
+
+        registered = warp(data, transform.params)
+
+        residual = float(np.sqrt(np.mean(np.sum((transform(src) - dst) ** 2, axis=1))))
+
+        return registered, {
+            "method": "astroalign",
+            "dx": float(transform.translation[0]),
+            "dy": float(transform.translation[1]),
+            "rotation": float(transform.rotation),
+            "residual": residual,
+        }
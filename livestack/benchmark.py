@@ -0,0 +1,292 @@
+"""
+Runs the stacker over synthetic frames and reports its throughput, the
+latency of each stage and the peak memory used, so changes to the pipeline
+can be compared on the same data.
+
+    python -m livestack.benchmark --width 6000 --height 4000 --frames 20 --bayer RGGB
+
+Darks and flats are generated and stacked first, then the lights. Everything
+is written to a temporary folder, which is removed afterwards unless
+--keep is given.
+"""
+import argparse
+import json
+import logging
+import os
+from os.path import join
+import resource
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from astropy.io import fits
+import numpy as np
+
+from .metrics import metrics
+from .stacking_service import Stacker
+
+
+class FrameGenerator:
+    """
+    Writes uint16 frames of a fixed star field, with the read noise, bias,
+    hot pixels and vignetting of a real camera. Lights are dithered by a few
+    pixels from one to the next. With `bayer`, the frames are a colour mosaic
+    of that pattern.
+    """
+
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        bayer: Optional[str] = None,
+        stars: int = 500,
+        fwhm: float = 3.0,
+        seed: int = 0,
+    ):
+        self.width = width
+        self.height = height
+        self.bayer = bayer
+        self.fwhm = fwhm
+        self.rng = np.random.default_rng(seed)
+
+        margin = 32
+        self.stars = np.column_stack(
+            [
+                self.rng.uniform(margin, width - margin, stars),
+                self.rng.uniform(margin, height - margin, stars),
+                # a few bright stars and many faint ones
+                20000 * self.rng.power(0.3, stars) + 300,
+            ]
+        )
+        self.hot = (
+            self.rng.integers(0, height, width * height // 10000),
+            self.rng.integers(0, width, width * height // 10000),
+        )
+
+        yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+        r2 = ((xx - width / 2) ** 2 + (yy - height / 2) ** 2) / (
+            (width / 2) ** 2 + (height / 2) ** 2
+        )
+        self.vignetting = (1 - 0.3 * r2).astype(np.float32)
+
+        # how much of the light each pixel of the mosaic lets through
+        self.response = np.ones((height, width), dtype=np.float32)
+        if bayer:
+            gains = {"R": 0.6, "G": 1.0, "B": 0.8}
+            for i, c in enumerate(bayer.upper()):
+                self.response[i // 2 :: 2, i % 2 :: 2] = gains[c]
+
+    def _bias(self) -> np.ndarray:
+        data = self.rng.normal(800, 12, (self.height, self.width)).astype(np.float32)
+        data[self.hot] += 5000
+        return data
+
+    def dark(self) -> np.ndarray:
+        return self._bias()
+
+    def flat(self) -> np.ndarray:
+        light = 25000 * self.vignetting * self.response
+        return self._bias() + self.rng.poisson(light).astype(np.float32)
+
+    def light(self, dx: float, dy: float) -> np.ndarray:
+        sky = np.full((self.height, self.width), 600, dtype=np.float32)
+
+        # each star is drawn into a small stamp around it, not the whole frame
+        sigma = self.fwhm / 2.3548
+        radius = int(np.ceil(4 * sigma))
+        offsets = np.arange(-radius, radius + 1, dtype=np.float32)
+        for x, y, flux in self.stars:
+            cx, cy = int(round(x + dx)), int(round(y + dy))
+            if not (radius <= cx < self.width - radius and radius <= cy < self.height - radius):
+                continue
+
+            gy = np.exp(-((offsets + cy - y - dy) ** 2) / (2 * sigma * sigma))
+            gx = np.exp(-((offsets + cx - x - dx) ** 2) / (2 * sigma * sigma))
+            star = flux * np.outer(gy, gx)
+            sky[cy - radius : cy + radius + 1, cx - radius : cx + radius + 1] += star
+
+        light = sky * self.vignetting * self.response
+        return self._bias() + self.rng.poisson(light).astype(np.float32)
+
+    def write(self, path: str, data: np.ndarray, image_type: str, exposure: float):
+        hdr = fits.Header()
+        hdr["IMAGETYP"] = image_type
+        hdr["INSTRUME"] = "Benchmark"
+        hdr["EXPTIME"] = exposure
+        hdr["GAIN"] = 100
+        hdr["CCD-TEMP"] = -10.0
+        hdr["FILTER"] = "L"
+        hdr["OBJECT"] = "Benchmark"
+        if self.bayer:
+            hdr["BAYERPAT"] = self.bayer
+
+        pixels = np.clip(data, 0, 65535).astype(np.uint16)
+        fits.PrimaryHDU(pixels, hdr).writeto(path, overwrite=True)
+
+    def generate(
+        self, folder: str, lights: int, darks: int, flats: int, dither: float = 5.0
+    ) -> List[str]:
+        """
+        Writes the frames to `folder`, returning their paths in the order they
+        should be stacked.
+        """
+        paths = []
+
+        for i in range(darks):
+            paths.append(join(folder, f"dark_{i:04d}.fits"))
+            self.write(paths[-1], self.dark(), "Dark Frame", 60.0)
+
+        for i in range(flats):
+            paths.append(join(folder, f"flat_{i:04d}.fits"))
+            self.write(paths[-1], self.flat(), "Flat Frame", 1.0)
+
+        for i in range(lights):
+            dx, dy = self.rng.uniform(-dither, dither, 2)
+            paths.append(join(folder, f"light_{i:04d}.fits"))
+            self.write(paths[-1], self.light(dx, dy), "Light Frame", 60.0)
+
+        return paths
+
+
+def run(
+    paths: List[str],
+    storage_folder: str,
+    output_folder: str,
+    workers: int = 1,
+    **kwargs: object,
+) -> Dict[str, object]:
+    """
+    Stacks `paths` with a fresh Stacker, the way the watcher would hand them
+    over, waits for all of them to be done, and returns the timings. With 0
+    `workers`, each frame is run through `Stacker._process_item` in turn on
+    this thread instead, which times the stages without any overlap.
+    """
+    metrics.reset()
+
+    s = Stacker(storage_folder, output_folder, workers=max(workers, 1), **kwargs)  # type: ignore
+
+    started = time.perf_counter()
+    if workers:
+        s.start()
+        for path in paths:
+            s.stack_image(path)
+        s.wait_idle()
+    else:
+        for path in paths:
+            s._process_item(path)
+
+    s.stop()
+    elapsed = time.perf_counter() - started
+
+    stages = {}
+    for stage, h in sorted(metrics.stages().items()):
+        p50, p95, p99 = h.percentiles(50, 95, 99)
+        stages[stage] = {"count": h.count, "p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+
+    counters = {name: value for (name, labels), value in metrics.counters.items() if not labels}
+
+    return {
+        "frames": len(paths),
+        "elapsed_s": elapsed,
+        "frames_per_s": len(paths) / elapsed if elapsed > 0 else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": stages,
+        "bytes_read": counters.get("bytes_read", 0),
+        "bytes_written": counters.get("bytes_written", 0),
+    }
+
+
+def report(results: Dict[str, object]) -> str:
+    lines = [
+        f"{results['frames']} frames in {results['elapsed_s']:.1f}s, "
+        f"{results['frames_per_s']:.2f} frames/s, peak RSS {results['peak_rss_mb']:.0f}MB",
+        f"{results['bytes_read'] / 1e6:.0f}MB read, {results['bytes_written'] / 1e6:.0f}MB written",
+        "",
+        f"{'stage':<12} {'count':>6} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}",
+    ]
+
+    for stage, s in results["stages"].items():  # type: ignore
+        lines.append(
+            f"{stage:<12} {s['count']:>6} "
+            f"{s['p50_ms']:>10.1f} {s['p95_ms']:>10.1f} {s['p99_ms']:>10.1f}"
+        )
+
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--width", type=int, default=3000)
+    parser.add_argument("--height", type=int, default=2000)
+    parser.add_argument("--frames", type=int, default=20, help="number of lights")
+    parser.add_argument("--darks", type=int, default=5)
+    parser.add_argument("--flats", type=int, default=5)
+    parser.add_argument("--stars", type=int, default=500)
+    parser.add_argument("--bayer", default=None, help="bayer pattern, like RGGB, for colour frames")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="0 runs every frame inline, one at a time"
+    )
+    parser.add_argument("--align-mode", default="auto")
+    parser.add_argument("--integration", default="mean", help="integration mode of the lights")
+    parser.add_argument("--debayer", default="bilinear32")
+    parser.add_argument("--master-method", default="median")
+    parser.add_argument("--storage-format", default="fits", help="format stacks are kept in")
+    parser.add_argument(
+        "--catchup-batch", type=int, default=8, help="lights stacked at once from a backlog"
+    )
+    parser.add_argument(
+        "--live-bin", type=int, default=1, help="bin lights by this much for the live stack"
+    )
+    parser.add_argument(
+        "--live-full", default="demand", help="when the full resolution stack is built"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--folder", default=None, help="where to write the frames and stacks")
+    parser.add_argument("--keep", action="store_true", help="keep the frames and stacks")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="log every stage")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    folder = args.folder or tempfile.mkdtemp(prefix="livestack-benchmark-")
+    frames, storage, output = join(folder, "input"), join(folder, "storage"), join(folder, "output")
+    os.makedirs(frames, exist_ok=True)
+
+    try:
+        generator = FrameGenerator(args.width, args.height, args.bayer, args.stars, seed=args.seed)
+        started = time.perf_counter()
+        paths = generator.generate(frames, args.frames, args.darks, args.flats)
+        logging.warning(f"generated {len(paths)} frames in {time.perf_counter() - started:.1f}s")
+
+        results = run(
+            paths,
+            storage,
+            output,
+            workers=args.workers,
+            align_mode=args.align_mode,
+            integrations={"LIGHT": args.integration},
+            master_method=args.master_method,
+            storage_format=args.storage_format,
+            catchup_batch=args.catchup_batch,
+            live_bin=args.live_bin,
+            live_full=args.live_full,
+            debayer_mode=args.debayer,
+            # only write stacks when a different key arrives and on stop, as
+            # in a normal session
+            flush_interval=3600.0,
+            flush_frames=args.frames + 1,
+        )
+    finally:
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    print(json.dumps(results, indent=2) if args.json else report(results))
+
+
+if __name__ == "__main__":
+    main()
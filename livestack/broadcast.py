@@ -0,0 +1,165 @@
+import asyncio
+from collections import deque
+from http import HTTPStatus
+import logging
+import os
+from typing import Any, Callable, Deque, Dict, List, Mapping, Optional, Set, Tuple, Union
+from urllib.parse import unquote
+
+import simplejson as json
+import websockets
+
+from .metrics import metrics
+
+
+class Client:
+    """
+    What is waiting to be sent to one websocket client. Only the newest preview
+    is kept, and text messages are dropped oldest first once `max_messages` are
+    queued, so a slow reader never holds up the others or grows without bound.
+    """
+
+    def __init__(self, max_messages: int):
+        self.image: Optional[bytes] = None
+        self.messages: Deque[str] = deque(maxlen=max_messages)
+        self.ready = asyncio.Event()
+
+
+class Broadcaster:
+    """
+    Pushes stack previews and log lines to every connected websocket client.
+
+    Previews are read and encoded once, on the stacker thread that rendered
+    them, then handed to the event loop with call_soon_threadsafe and shared by
+    all clients. They are sent as binary messages holding the PNG, or, when
+    the Stacker renders tile pyramids, as JSON text messages listing the tiles
+    that changed. Log lines and metrics are sent as JSON text messages.
+
+    The same port answers plain HTTP GETs of /metrics with the metrics in the
+    Prometheus text format, for scraping, and of /stacks/{key}.fits with the
+    current stack as a plain FITS file, made by `exporter`.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        max_messages: int = 100,
+        exporter: Optional[Callable[[str], Optional[bytes]]] = None,
+    ):
+        self.loop = loop
+        self.max_messages = max_messages
+        self.exporter = exporter
+        self.clients: Set[Client] = set()
+
+    def put(self, png_path: str):
+        """
+        Called by the Stacker, from its own threads, with each new preview.
+        """
+        with open(png_path, "rb") as f:
+            data = f.read()
+
+        self.loop.call_soon_threadsafe(self.publish, data)
+
+    def put_tiles(self, tiles: Dict[str, Any]):
+        """
+        Called by the Stacker, instead of `put`, when it renders tiles.
+        """
+        self.put_message("livestack_tiles", tiles)
+
+    def put_message(self, message_type: str, payload: object):
+        """
+        Sends a JSON message to all clients. Safe to call from any thread.
+        """
+        if not self.clients:
+            return
+
+        # latencies of stages with no samples yet are NaN, which JSON lacks
+        message = json.dumps({"type": message_type, "payload": payload}, ignore_nan=True)
+        self.loop.call_soon_threadsafe(self.publish, message)
+
+    def publish(self, message: Union[str, bytes]):
+        for client in self.clients:
+            if isinstance(message, bytes):
+                client.image = message
+            else:
+                client.messages.append(message)
+
+            client.ready.set()
+
+    async def process_request(
+        self, path: str, headers: Mapping[str, str]
+    ) -> Optional[Tuple[HTTPStatus, List[Tuple[str, str]], bytes]]:
+        """
+        Answers /metrics and /stacks/ without a websocket handshake, lets
+        everything else through.
+        """
+        path = path.split("?")[0]
+
+        if path == "/metrics":
+            body = metrics.prometheus().encode()
+            return HTTPStatus.OK, [("Content-Type", "text/plain; version=0.0.4")], body
+
+        if path.startswith("/stacks/") and path.endswith(".fits") and self.exporter:
+            key = unquote(path[len("/stacks/") : -len(".fits")])
+
+            # the key names files in the storage folder
+            if not key or os.path.basename(key) != key or key.startswith("."):
+                return HTTPStatus.NOT_FOUND, [], b"not found\n"
+
+            # encoding a stack takes a while, keep the event loop free meanwhile
+            body = await self.loop.run_in_executor(None, self.exporter, key)
+            if body is None:
+                return HTTPStatus.NOT_FOUND, [], b"not found\n"
+
+            return (
+                HTTPStatus.OK,
+                [
+                    ("Content-Type", "application/fits"),
+                    ("Content-Disposition", f'attachment; filename="{key}.fits"'),
+                ],
+                body,
+            )
+
+        return None
+
+    async def serve(self, ws: websockets.WebSocketServerProtocol, path: str):
+        client = Client(self.max_messages)
+        self.clients.add(client)
+
+        sender = asyncio.ensure_future(self._send(ws, client))
+        closed = asyncio.ensure_future(ws.wait_closed())
+
+        try:
+            await asyncio.wait([sender, closed], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+            closed.cancel()
+
+    async def _send(self, ws: websockets.WebSocketServerProtocol, client: Client):
+        while True:
+            await client.ready.wait()
+            client.ready.clear()
+
+            while client.messages:
+                await ws.send(client.messages.popleft())
+
+            if client.image is not None:
+                image, client.image = client.image, None
+                await ws.send(image)
+
+
+class BroadcastHandler(logging.Handler):
+    """
+    Forwards log records to websocket clients as livestack_log messages.
+    """
+
+    def __init__(self, broadcaster: Broadcaster):
+        super().__init__()
+        self.broadcaster = broadcaster
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.broadcaster.put_message("livestack_log", record.getMessage())
+        except Exception:
+            self.handleError(record)
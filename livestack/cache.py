@@ -0,0 +1,117 @@
+from collections import OrderedDict
+import logging
+from threading import Lock
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+
+def _sizeof(value: Any) -> int:
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+
+    size = 0
+
+    data = getattr(value, "data", None)
+    if isinstance(data, np.ndarray):
+        size += int(data.nbytes)
+
+    # per pixel integration state kept with a stack
+    state = getattr(value, "state", None)
+    if isinstance(state, dict):
+        size += sum(int(v.nbytes) for v in state.values() if isinstance(v, np.ndarray))
+
+    return size
+
+
+class ImageCache:
+    """
+    LRU cache for stacks, masters and values derived from them, keyed by stack
+    key and bounded by the total number of bytes held.
+
+    Cached values are shared between callers and must be treated as read-only.
+    To change a stack, build a new value and `put` it.
+
+    Every `put` or `invalidate` of a key bumps its version, so a value read
+    from disk can be put with the `version` seen before the read, and is
+    dropped if a newer one was put in the meantime.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: "OrderedDict[Tuple[str, str], Tuple[Any, Any, int]]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._lock = Lock()
+
+    def version(self, key: str) -> int:
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._items.get((key, ""))
+            if entry is None:
+                return None
+
+            self._items.move_to_end((key, ""))
+            return entry[1]
+
+    def put(self, key: str, value: Any, version: Optional[int] = None) -> bool:
+        """
+        Caches `value` for `key`, unless a `version` is given and the key has
+        been put since. Returns whether it was cached.
+        """
+        with self._lock:
+            if version is not None and version != self._versions.get(key, 0):
+                return False
+
+            self._invalidate(key)
+            self._store((key, ""), None, value)
+            return True
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._invalidate(key)
+
+    def derived(self, key: str, name: str, source: Any, fn: Callable[[], Any]) -> Any:
+        """
+        Returns a value computed from `source` (usually the cached stack for
+        `key`), computing it with `fn` on a miss. The value is recomputed if
+        the stack for `key` has been replaced since it was cached.
+        """
+        with self._lock:
+            entry = self._items.get((key, name))
+            if entry is not None and entry[0] is source:
+                self._items.move_to_end((key, name))
+                return entry[1]
+
+        value = fn()
+
+        with self._lock:
+            self._store((key, name), source, value)
+
+        return value
+
+    def _invalidate(self, key: str):
+        self._versions[key] = self._versions.get(key, 0) + 1
+        for k in [k for k in self._items if k[0] == key]:
+            self.size -= self._items.pop(k)[2]
+
+    def _store(self, k: Tuple[str, str], source: Any, value: Any):
+        old = self._items.pop(k, None)
+        if old is not None:
+            self.size -= old[2]
+
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            logging.info(f"not caching {k[0]} {k[1]}, {size} bytes exceeds cache size")
+            return
+
+        self._items[k] = (source, value, size)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            evicted, (_, _, evicted_size) = self._items.popitem(last=False)
+            self.size -= evicted_size
+            logging.info(f"evicted {evicted[0]} {evicted[1]} from cache")
@@ -0,0 +1,127 @@
+from fnmatch import fnmatch
+from typing import Dict, Optional, Tuple
+
+from colour_demosaicing import demosaicing_CFA_Bayer_bilinear, demosaicing_CFA_Bayer_Malvar2004
+import numpy as np
+
+
+MODES = ("superpixel", "bilinear32", "bilinear", "malvar")
+
+
+def _offsets(pattern: str) -> Dict[str, Tuple[Tuple[int, int], ...]]:
+    """
+    Where each colour sits in the 2x2 cell of a pattern like "RGGB".
+    """
+    pattern = pattern.upper()
+    assert len(pattern) == 4 and sorted(pattern) == ["B", "G", "G", "R"], pattern
+
+    cells = ((0, 0), (0, 1), (1, 0), (1, 1))
+    return {c: tuple(cell for cell, p in zip(cells, pattern) if p == c) for c in "RGB"}
+
+
+def superpixel(data: np.ndarray, pattern: str) -> np.ndarray:
+    """
+    Turns each 2x2 cell into one RGB pixel, averaging the two greens. The
+    result is half the width and height, with no interpolation at all.
+    """
+    offsets = _offsets(pattern)
+    h, w = data.shape[0] // 2 * 2, data.shape[1] // 2 * 2
+
+    out = np.empty((3, h // 2, w // 2), dtype=np.float32)
+    for i, c in enumerate("RGB"):
+        out[i] = 0
+        for y, x in offsets[c]:
+            out[i] += data[y:h:2, x:w:2]
+        if len(offsets[c]) > 1:
+            out[i] *= np.float32(1.0 / len(offsets[c]))
+
+    return out
+
+
+def bilinear32(data: np.ndarray, pattern: str) -> np.ndarray:
+    """
+    Bilinear demosaicing in float32, written straight into a (3, H, W) array.
+
+    Each missing value is the mean of the nearest pixels of its colour: the
+    two or four adjacent ones, or the four diagonal ones. It is worked out
+    on the quarter size grid of each position in the 2x2 cell from strided
+    views of the frame, so only the missing values are computed and nothing
+    is convolved. Edges are mirrored, which keeps the pattern intact.
+    """
+    offsets = _offsets(pattern)
+    h, w = data.shape
+
+    padded = np.pad(data, 1, mode="reflect")
+    out = np.empty((3, h, w), dtype=np.float32)
+
+    for i, c in enumerate("RGB"):
+        sites = offsets[c]
+
+        for py, px in ((0, 0), (0, 1), (1, 0), (1, 1)):
+            target = out[i, py::2, px::2]
+            th, tw = target.shape
+
+            if (py, px) in sites:
+                target[...] = data[py::2, px::2]
+                continue
+
+            # green has 4 adjacent neighbours, red and blue 2 adjacent or 4
+            # diagonal ones
+            neighbours = [
+                (dy, dx)
+                for dy in (-1, 0, 1)
+                for dx in (-1, 0, 1)
+                if ((py + dy) % 2, (px + dx) % 2) in sites and (c != "G" or abs(dy) + abs(dx) == 1)
+            ]
+
+            target[...] = 0
+            for dy, dx in neighbours:
+                y, x = 1 + py + dy, 1 + px + dx
+                target += padded[y : y + 2 * th : 2, x : x + 2 * tw : 2]
+            target *= np.float32(1.0 / len(neighbours))
+
+    return out
+
+
+def _channels_first(data: np.ndarray) -> np.ndarray:
+    out = np.empty((3,) + data.shape[:2], dtype=np.float32)
+    np.copyto(out, np.moveaxis(data, 2, 0), casting="same_kind")
+    return out
+
+
+def debayer(data: np.ndarray, pattern: str, mode: str = "bilinear32") -> np.ndarray:
+    """
+    Demosaics a (H, W) frame into a (3, H, W) one, or (3, H/2, W/2) for
+    "superpixel", clipped to [0, 1].
+
+    - "superpixel" bins each 2x2 cell, a quarter of the pixels for everything
+      after it, for a fast live view.
+    - "bilinear32" interpolates in float32.
+    - "bilinear" and "malvar" use colour_demosaicing, in float64, for the best
+      quality.
+    """
+    if mode == "superpixel":
+        out = superpixel(data, pattern)
+    elif mode == "bilinear32":
+        out = bilinear32(data, pattern)
+    elif mode == "bilinear":
+        out = _channels_first(demosaicing_CFA_Bayer_bilinear(data, pattern=pattern))
+    elif mode == "malvar":
+        out = _channels_first(demosaicing_CFA_Bayer_Malvar2004(data, pattern=pattern))
+    else:
+        raise Exception(f"unknown debayer mode {mode}")
+
+    # malvar overshoots around stars
+    return np.clip(out, 0.0, 1.0, out=out)
+
+
+def mode_for(key: str, default: str, modes: Optional[Dict[str, str]] = None) -> str:
+    """
+    Returns the mode of the first of `modes`, keyed by shell style patterns
+    matched against the stack key, that matches `key`, or `default`.
+    """
+    for pattern, mode in (modes or {}).items():
+        if fnmatch(key, pattern):
+            return mode
+
+    return default
@@ -0,0 +1,289 @@
+import logging
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+# per pixel arrays an integration keeps next to the stack between frames
+State = Dict[str, np.ndarray]
+
+
+class Mean:
+    """
+    Running weighted mean. The stack itself is all the state there is.
+    """
+
+    name = "mean"
+
+    def start(self, data: np.ndarray, weight: float) -> State:
+        """
+        State for a stack made of the single frame `data`.
+        """
+        return {}
+
+    def resume(self, mean: np.ndarray, weight: float) -> State:
+        """
+        State for an existing stack that was integrated some other way.
+        """
+        return {}
+
+    def add(
+        self, mean: np.ndarray, total: float, state: State, data: np.ndarray, weight: float
+    ) -> Tuple[np.ndarray, State]:
+        return (total * mean + weight * data) / (total + weight), state
+
+    def add_batch(
+        self,
+        mean: np.ndarray,
+        total: float,
+        state: State,
+        frames: Sequence[np.ndarray],
+        weights: List[float],
+    ) -> Tuple[np.ndarray, State]:
+        """
+        Adds several frames at once, in a single weighted sum.
+        """
+        out = mean * np.float32(total)
+        for data, weight in zip(frames, weights):
+            out += np.float32(weight) * data
+        out *= np.float32(1.0 / (total + sum(weights)))
+
+        return out, state
+
+
+class SigmaClip:
+    """
+    Kappa-sigma clipping against a running mean and variance, using the
+    weighted form of Welford's algorithm. Pixels further than `kappa` standard
+    deviations from the mean, like satellite trails, planes and cosmic rays,
+    are left out of the stack once it holds `min_weight` of data for them.
+
+    The distance is judged against the spread a new sample is expected to
+    have: the unbiased variance, widened by the uncertainty of the mean
+    itself, and never less than `min_sigma`, the 16 bit step. A rejected
+    sample is left out of the mean, but counts towards the variance as if it
+    were at the clip limit. Otherwise each rejection shrinks the variance,
+    which makes the next rejection more likely, and good data is thrown away.
+
+    The state is three float32 arrays: the sum of squared differences from the
+    mean, the weight behind each pixel of the mean, and the weight behind the
+    variance, which starts at 0 when resuming a stack with no variance.
+    """
+
+    name = "sigma"
+
+    def __init__(self, kappa: float = 3.0, min_weight: float = 5.0, min_sigma: float = 1.0 / 65535):
+        self.kappa = kappa
+        self.min_weight = min_weight
+        self.min_sigma = min_sigma
+
+    def start(self, data: np.ndarray, weight: float) -> State:
+        w = np.full(data.shape, weight, dtype=np.float32)
+        return {"m2": np.zeros(data.shape, dtype=np.float32), "w": w, "wv": w.copy()}
+
+    def resume(self, mean: np.ndarray, weight: float) -> State:
+        return {
+            "m2": np.zeros(mean.shape, dtype=np.float32),
+            "w": np.full(mean.shape, weight, dtype=np.float32),
+            "wv": np.zeros(mean.shape, dtype=np.float32),
+        }
+
+    def add(
+        self, mean: np.ndarray, total: float, state: State, data: np.ndarray, weight: float
+    ) -> Tuple[np.ndarray, State]:
+        m2, w, wv = state["m2"], state["w"], state["wv"]
+
+        delta = data - mean
+
+        limit = self._limit(m2, w, wv, weight)
+        rejected = (wv >= self.min_weight) & (delta * delta > limit)
+
+        if rejected.any():
+            logging.info(f"sigma clipping rejected {np.count_nonzero(rejected)} pixels")
+
+        weights = np.where(rejected, np.float32(0.0), np.float32(weight))
+
+        w = w + weights
+        mean = mean + delta * (weights / w)
+        m2 = m2 + weights * delta * (data - mean) + self._winsorized(rejected, limit, w, weight)
+        wv = wv + np.float32(weight)
+
+        return mean, {"m2": m2, "w": w, "wv": wv}
+
+    def _limit(self, m2: np.ndarray, w: np.ndarray, wv: np.ndarray, weight: float) -> np.ndarray:
+        """
+        The squared distance from the mean past which a sample of `weight` is
+        rejected.
+        """
+        variance = m2 / np.maximum(wv - np.float32(1.0), np.float32(1e-6))
+        np.maximum(variance, np.float32(self.min_sigma ** 2), out=variance)
+
+        # the mean is an estimate too, a sample strays from it by a bit more
+        variance *= np.float32(1.0) + np.float32(weight) / np.maximum(w, np.float32(1e-6))
+
+        return np.float32(self.kappa ** 2) * variance
+
+    def _winsorized(
+        self, rejected: np.ndarray, limit: np.ndarray, w: np.ndarray, weight: float
+    ) -> np.ndarray:
+        # the squared differences of rejected samples, taken at the limit,
+        # without the widening for the uncertainty of the mean
+        spread = limit / (np.float32(1.0) + np.float32(weight) / np.maximum(w, np.float32(1e-6)))
+        return np.where(rejected, np.float32(weight) * spread, np.float32(0.0))
+
+    def add_batch(
+        self,
+        mean: np.ndarray,
+        total: float,
+        state: State,
+        frames: Sequence[np.ndarray],
+        weights: List[float],
+    ) -> Tuple[np.ndarray, State]:
+        """
+        Adds several frames at once. Every frame is clipped against the stack
+        as it was before the batch, then the weighted mean and squared
+        differences of what is left are merged into the stack's with Chan's
+        parallel form of Welford's algorithm.
+        """
+        m2, w, wv = state["m2"], state["w"], state["wv"]
+
+        active = wv >= self.min_weight
+
+        kept = []
+        batch_w = np.zeros(mean.shape, dtype=np.float32)
+        batch_sum = np.zeros(mean.shape, dtype=np.float32)
+        winsorized = np.zeros(mean.shape, dtype=np.float32)
+        rejected = 0
+
+        for data, weight in zip(frames, weights):
+            limit = self._limit(m2, w, wv, weight)
+            delta = data - mean
+            clipped = active & (delta * delta > limit)
+            rejected += np.count_nonzero(clipped)
+
+            fw = np.where(clipped, np.float32(0.0), np.float32(weight))
+            batch_w += fw
+            batch_sum += fw * data
+            winsorized += self._winsorized(clipped, limit, w, weight)
+            kept.append(fw)
+
+        if rejected:
+            logging.info(f"sigma clipping rejected {rejected} pixels")
+
+        batch_mean = batch_sum / np.maximum(batch_w, np.float32(1e-12))
+
+        # a second pass over the frames, which are in memory anyway, as the
+        # single pass form loses too much in float32
+        batch_m2 = np.zeros(mean.shape, dtype=np.float32)
+        for data, fw in zip(frames, kept):
+            d = data - batch_mean
+            batch_m2 += fw * d * d
+
+        new_w = w + batch_w
+        delta = batch_mean - mean
+        share = batch_w / np.maximum(new_w, np.float32(1e-12))
+
+        mean = mean + delta * share
+        m2 = m2 + batch_m2 + delta * delta * w * share + winsorized
+
+        return mean, {"m2": m2, "w": new_w, "wv": wv + np.float32(sum(weights))}
+
+
+class WindowedMedian:
+    """
+    Median of each run of `window` frames, with the medians averaged together.
+    Frames wait in the window until it is full, showing in the stack as a plain
+    mean until then. Only the last `window` frames are kept, so memory doesn't
+    grow with the number of subs. The frame weights are not used, as they
+    don't fit a median.
+    """
+
+    name = "median"
+
+    def __init__(self, window: int = 5):
+        self.window = window
+
+    def start(self, data: np.ndarray, weight: float) -> State:
+        return {
+            "base": np.zeros(data.shape, dtype=np.float32),
+            "base_count": np.zeros((), dtype=np.float32),
+            "window": data[np.newaxis].astype(np.float32),
+        }
+
+    def resume(self, mean: np.ndarray, weight: float) -> State:
+        return {
+            "base": mean.astype(np.float32),
+            "base_count": np.array(weight, dtype=np.float32),
+            "window": np.empty((0,) + mean.shape, dtype=np.float32),
+        }
+
+    def add(
+        self, mean: np.ndarray, total: float, state: State, data: np.ndarray, weight: float
+    ) -> Tuple[np.ndarray, State]:
+        base, count = state["base"], float(state["base_count"])
+        window = np.concatenate([state["window"], data[np.newaxis]])
+
+        if len(window) >= self.window:
+            median = np.median(window, axis=0).astype(np.float32)
+            base = (count * base + len(window) * median) / (count + len(window))
+            count += len(window)
+            window = window[:0]
+
+        n = len(window)
+        mean = (count * base + window.sum(axis=0, dtype=np.float32)) / (count + n)
+
+        return mean.astype(np.float32), {
+            "base": base,
+            "base_count": np.array(count, dtype=np.float32),
+            "window": window,
+        }
+
+    def add_batch(
+        self,
+        mean: np.ndarray,
+        total: float,
+        state: State,
+        frames: Sequence[np.ndarray],
+        weights: List[float],
+    ) -> Tuple[np.ndarray, State]:
+        # the windows are medians of consecutive frames either way
+        for data, weight in zip(frames, weights):
+            mean, state = self.add(mean, total, state, data, weight)
+            total += weight
+
+        return mean, state
+
+
+def create(mode: str, kappa: float = 3.0, window: int = 5):
+    if mode == "mean":
+        return Mean()
+    elif mode == "sigma":
+        return SigmaClip(kappa)
+    elif mode == "median":
+        return WindowedMedian(window)
+
+    raise Exception(f"unknown integration mode {mode}")
+
+
+def save_state(path: str, mode: str, state: State, flush_id: Optional[str]):
+    # the flush id ties the state to the stack it was saved with
+    with open(f"{path}.tmp", "wb") as f:
+        np.savez(f, mode=np.array(mode), flush_id=np.array(flush_id or ""), **state)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_state(path: str, mode: str, flush_id: Optional[str]) -> Optional[State]:
+    """
+    Returns the state saved with the stack written with `flush_id`, or None
+    if there is none, or it belongs to another mode or another write.
+    """
+    try:
+        with np.load(path) as f:
+            if str(f["mode"]) != mode or str(f["flush_id"]) != (flush_id or ""):
+                logging.info(f"discarding stale integration state {path}")
+                return None
+
+            return {name: f[name] for name in f.files if name not in ("mode", "flush_id")}
+    except OSError:
+        return None
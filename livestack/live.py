@@ -0,0 +1,114 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+# x, y, width and height of a region of the full frame, in pixels
+Roi = Tuple[int, int, int, int]
+
+
+def parse_roi(text: str) -> Optional[Roi]:
+    """
+    Parses "x,y,width,height", or "" for the whole frame.
+    """
+    if not text:
+        return None
+
+    x, y, w, h = (int(v) for v in text.split(","))
+    assert x >= 0 and y >= 0 and w > 0 and h > 0, text
+    return x, y, w, h
+
+
+def crop(data: np.ndarray, roi: Roi, mosaic: bool = False) -> np.ndarray:
+    """
+    The part of a (H, W) frame inside `roi`, clipped to the frame. For a
+    `mosaic`, the corner is moved up and left to an even pixel, so the crop
+    keeps the bayer pattern of the frame.
+    """
+    x, y, w, h = roi
+    if mosaic:
+        x, y = x // 2 * 2, y // 2 * 2
+
+    return data[y : y + h, x : x + w]
+
+
+def bin_frame(data: np.ndarray, factor: int, mosaic: bool = False) -> np.ndarray:
+    """
+    Averages each `factor` x `factor` block of a (H, W) frame into one pixel,
+    dropping the rows and columns that don't fill a block. A `mosaic` is
+    binned one colour at a time, each pixel with the pixels of the same
+    colour in the neighbouring cells, so the result is a mosaic of the same
+    pattern that can be calibrated and debayered like the original.
+
+    Averaging rather than summing keeps the frame in [0, 1], and the noise
+    goes down by `factor` all the same.
+    """
+    if factor == 1:
+        return data
+
+    cell = 2 if mosaic else 1
+    block = factor * cell
+    h, w = data.shape[0] // block, data.shape[1] // block
+
+    # (rows, factor, cell, cols, factor, cell), where the pixel of a row in
+    # the full frame is (row * factor + i) * cell + colour
+    blocks = data[: h * block, : w * block].reshape(h, factor, cell, w, factor, cell)
+
+    # adding up strided views is several times quicker than mean over the
+    # block axes, which numpy does with a much worse memory access pattern
+    out = np.zeros((h, cell, w, cell), dtype=np.float32)
+    for i in range(factor):
+        for j in range(factor):
+            out += blocks[:, i, :, :, j, :]
+    out *= np.float32(1.0 / (factor * factor))
+
+    return out.reshape(h * cell, w * cell)
+
+
+class LiveView:
+    """
+    The reduced version of each light frame that is stacked live when frames
+    are too big to stack at full resolution as they come in: the region
+    `roi` of the frame, if given, binned `factor` x `factor`. Calibration
+    masters are reduced the same way before use.
+
+    Reduced stacks are kept under the key of the full resolution stack with
+    `suffix` added, so they never mix with full resolution frames.
+    """
+
+    def __init__(self, factor: int = 1, roi: Optional[Roi] = None):
+        assert factor >= 1, factor
+        self.factor = factor
+        self.roi = roi
+
+    @property
+    def enabled(self) -> bool:
+        return self.factor > 1 or self.roi is not None
+
+    @property
+    def suffix(self) -> str:
+        suffix = ""
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            suffix += f"_ROI{w}x{h}+{x}+{y}"
+        if self.factor > 1:
+            suffix += f"_BIN{self.factor}"
+        return suffix
+
+    def full_key(self, key: str) -> Optional[str]:
+        """
+        The key of the full resolution stack for a reduced stack's key.
+        """
+        if not self.enabled or not key.endswith(self.suffix):
+            return None
+        return key[: -len(self.suffix)]
+
+    def reduce(self, data: np.ndarray, mosaic: bool = False) -> np.ndarray:
+        if self.roi is not None:
+            data = crop(data, self.roi, mosaic)
+
+        data = bin_frame(data, self.factor, mosaic)
+
+        # not binned, the crop is a view of the full frame, and calibration
+        # works in place
+        return np.array(data, dtype=np.float32) if self.factor == 1 else data
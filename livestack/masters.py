@@ -0,0 +1,239 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import logging
+import os
+from os.path import join
+import shutil
+from threading import Lock
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .utils import Timer
+
+
+def combine(
+    frames: Sequence[np.ndarray],
+    method: str = "median",
+    kappa: float = 3.0,
+    iterations: int = 3,
+    scales: Optional[np.ndarray] = None,
+    max_chunk_bytes: int = 256 * 1024 * 1024,
+    threads: int = 0,
+) -> np.ndarray:
+    """
+    Combines N (H, W) frames, usually memory mapped, into one (H, W) frame,
+    pixel by pixel. `method` is "median" or "sigma", a mean that
+    leaves out pixels more than `kappa` standard deviations from the median,
+    repeated `iterations` times. Each frame is first divided by its entry in
+    `scales`, if given.
+
+    The frames are worked through in bands of rows, stacked into an (N, rows,
+    W) cube, so no more than `max_chunk_bytes` is read at once per thread, and
+    the bands are spread over `threads` threads (all cores by default).
+    """
+    assert method in ("median", "sigma"), method
+
+    n = len(frames)
+    frame_shape = frames[0].shape
+    row_bytes = n * int(np.prod(frame_shape[1:])) * 4
+    rows = max(1, min(frame_shape[0], max_chunk_bytes // max(row_bytes, 1)))
+
+    out = np.empty(frame_shape, dtype=np.float32)
+
+    def work(start: int):
+        chunk = np.stack([f[start : start + rows] for f in frames]).astype(np.float32, copy=False)
+        if scales is not None:
+            chunk /= scales.reshape((n,) + (1,) * (chunk.ndim - 1))
+
+        if method == "median":
+            out[start : start + rows] = np.median(chunk, axis=0)
+            return
+
+        center = np.median(chunk, axis=0)
+        keep = np.ones(chunk.shape, dtype=bool)
+        for _ in range(iterations):
+            masked = np.where(keep, chunk, np.float32(np.nan))
+            sigma = np.nanstd(masked, axis=0)
+            keep = np.abs(chunk - center) <= np.float32(kappa) * sigma
+            # a pixel where every frame was rejected keeps them all
+            keep |= ~keep.any(axis=0)
+            center = np.nanmean(np.where(keep, chunk, np.float32(np.nan)), axis=0)
+
+        out[start : start + rows] = center
+
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as pool:
+        list(pool.map(work, range(0, frame_shape[0], rows)))
+
+    return out
+
+
+class MasterBuilder:
+    """
+    Collects the calibrated subs of dark and flat keys and combines each set
+    into a master in one go, which gives a far better master than averaging
+    subs in as they arrive.
+
+    Subs are written to a `{key}.subs` folder in the storage folder, one .npy
+    file each, and memory mapped when the set is combined. A set can be
+    combined before it is complete, when lights need its master, and is
+    then combined again from all of its subs each time it has grown. It is
+    complete, and discarded, when it has had no new sub for a while, or on
+    stop.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        method: str = "median",
+        kappa: float = 3.0,
+        max_chunk_bytes: int = 256 * 1024 * 1024,
+    ):
+        self.folder = folder
+        self.method = method
+        self.kappa = kappa
+        self.max_chunk_bytes = max_chunk_bytes
+        # the first sub of each set, without pixels, as a template for the
+        # master, and the paths and header fingerprints of the subs in the set
+        self._sets: Dict[str, Tuple[Any, List[Tuple[str, str]]]] = {}
+        # when each set last got a sub
+        self.since: Dict[str, float] = {}
+        # how many subs each set had when it was last combined, and the master
+        # from before the set, which every combination of it is averaged into
+        self._built: Dict[str, int] = {}
+        self._bases: Dict[str, Any] = {}
+        self._lock = Lock()
+
+        # subs left over from before a restart were never marked processed, so
+        # they come through again
+        for subs in os.listdir(folder):
+            if subs.endswith(".subs"):
+                logging.info(f"discarding unfinished master set {subs}")
+                shutil.rmtree(join(folder, subs), ignore_errors=True)
+
+    def add(self, key: str, img: Any, path: str) -> int:
+        """
+        Adds a calibrated sub to the set for `key`, returning the size of the
+        set.
+        """
+        subs = self._subs(key)
+        os.makedirs(subs, exist_ok=True)
+
+        with self._lock:
+            template, paths = self._sets.get(key) or (None, [])
+            index = len(paths)
+
+        np.save(join(subs, f"{index:05d}.npy"), img.data)
+
+        if template is None:
+            template = copy.copy(img)
+            template.data = None
+
+        with self._lock:
+            self._sets[key] = (template, paths + [(path, img.fingerprint)])
+            self.since[key] = time.monotonic()
+
+        return index + 1
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._sets)
+
+    def changed(self, key: str) -> bool:
+        """
+        Whether the set for `key` has subs that are not in its master yet.
+        """
+        with self._lock:
+            entry = self._sets.get(key)
+            return entry is not None and len(entry[1]) != self._built.get(key, 0)
+
+    def base(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        The master the set for `key` is averaged into, `fn()` as it was when
+        the set was first combined, so a set is never averaged into a master
+        made from its own subs.
+        """
+        with self._lock:
+            if key in self._bases:
+                return self._bases[key]
+
+        base = fn()
+
+        with self._lock:
+            self._bases[key] = base
+
+        return base
+
+    def build(self, key: str) -> Optional[Tuple[Any, List[Tuple[str, str]]]]:
+        """
+        Combines the set for `key`, returning the master, with the template's
+        headers and a subcount of the set size, and the paths and fingerprints
+        of the subs that went into it. The subs are kept until `discard` is called.
+        """
+        with self._lock:
+            entry = self._sets.get(key)
+
+        if entry is None:
+            return None
+
+        template, paths = entry
+        subs = self._subs(key)
+
+        with self._lock:
+            self._built[key] = len(paths)
+
+        frames = [np.load(join(subs, f"{i:05d}.npy"), mmap_mode="r") for i in range(len(paths))]
+
+        with Timer(
+            f"combining {len(frames)} subs into master {key} with {self.method}",
+            stage="master",
+            key=key,
+        ):
+            if len(frames) == 1:
+                data = np.array(frames[0], dtype=np.float32)
+            else:
+                scales = None
+                if template.image_type == "FLAT":
+                    # flats can vary in brightness, so match them up before
+                    # combining and restore the average level after
+                    scales = np.array([np.median(f[::8, ::8]) for f in frames], dtype=np.float32)
+                    scales = np.where(scales > 0, scales, np.float32(1.0))
+
+                data = combine(
+                    frames,
+                    self.method,
+                    self.kappa,
+                    scales=scales,
+                    max_chunk_bytes=self.max_chunk_bytes,
+                )
+
+                if scales is not None:
+                    data *= np.float32(scales.mean())
+
+            np.clip(data, 0.0, 1.0, out=data)
+
+        master = copy.copy(template)
+        master.data = data
+        master.subcount = len(paths)
+        master.weight = float(len(paths))
+
+        return master, paths
+
+    def discard(self, key: str) -> List[str]:
+        """
+        Drops the set for `key`, returning the paths of its subs.
+        """
+        with self._lock:
+            _, paths = self._sets.pop(key, None) or (None, [])
+            self.since.pop(key, None)
+            self._built.pop(key, None)
+            self._bases.pop(key, None)
+
+        shutil.rmtree(self._subs(key), ignore_errors=True)
+
+        return [path for path, _ in paths]
+
+    def _subs(self, key: str) -> str:
+        return join(self.folder, f"{key}.subs")
+
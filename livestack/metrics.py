@@ -0,0 +1,230 @@
+from collections import deque
+import cProfile
+import logging
+import os
+from os.path import join
+import re
+from threading import Lock
+import time
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """
+    Latencies of one stage for one key. Counts per bucket for Prometheus,
+    and the most recent `window` samples for percentiles.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, ms: float):
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+
+        self.count += 1
+        self.sum += ms
+        self.recent.append(ms)
+
+    def percentiles(self, *qs: float) -> List[float]:
+        if not self.recent:
+            return [float("nan")] * len(qs)
+
+        return [float(v) for v in np.percentile(list(self.recent), qs)]
+
+
+class Metrics:
+    """
+    Counters, gauges and per stage latency histograms, labelled by stack key.
+
+    Timer records into the histograms when it is given a stage. Gauges are
+    functions, read when the metrics are, so things like queue depths are
+    always current without anyone having to keep them up to date.
+    """
+
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self._lock = Lock()
+
+    def observe(self, stage: str, key: Optional[str], ms: float):
+        with self._lock:
+            histogram = self.histograms.get((stage, key or ""))
+            if histogram is None:
+                histogram = self.histograms[(stage, key or "")] = Histogram()
+
+            histogram.observe(ms)
+
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        k = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self.counters[k] = self.counters.get(k, 0) + amount
+
+    def gauge(self, name: str, fn: Callable[[], float]):
+        self.gauges[name] = fn
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def stages(self) -> Dict[str, Histogram]:
+        """
+        Returns the histograms of each stage with all keys merged, for reports.
+        """
+        merged: Dict[str, Histogram] = {}
+
+        with self._lock:
+            for (stage, _), h in self.histograms.items():
+                m = merged.setdefault(stage, Histogram(window=100000))
+                m.buckets = [a + b for a, b in zip(m.buckets, h.buckets)]
+                m.count += h.count
+                m.sum += h.sum
+                m.recent.extend(h.recent)
+
+        return merged
+
+    def snapshot(self) -> Dict[str, object]:
+        """
+        The metrics as plain data, for the livestack_metrics message.
+        """
+        stages = []
+
+        with self._lock:
+            for (stage, key), h in sorted(self.histograms.items()):
+                p50, p95, p99 = h.percentiles(50, 95, 99)
+                stages.append(
+                    {
+                        "stage": stage,
+                        "key": key,
+                        "count": h.count,
+                        "mean_ms": h.sum / h.count if h.count else 0.0,
+                        "p50_ms": p50,
+                        "p95_ms": p95,
+                        "p99_ms": p99,
+                    }
+                )
+
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+
+        gauges = {name: _read(fn) for name, fn in list(self.gauges.items())}
+
+        return {"stages": stages, "counters": counters, "gauges": gauges}
+
+    def prometheus(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP livestack_stage_duration_ms Time spent in each pipeline stage.",
+            "# TYPE livestack_stage_duration_ms histogram",
+        ]
+
+        with self._lock:
+            for (stage, key), h in sorted(self.histograms.items()):
+                labels = f'stage="{_escape(stage)}",key="{_escape(key)}"'
+
+                total = 0
+                for bound, n in zip(BUCKETS, h.buckets):
+                    total += n
+                    lines.append(
+                        f'livestack_stage_duration_ms_bucket{{{labels},le="{bound}"}} {total}'
+                    )
+                lines.append(f'livestack_stage_duration_ms_bucket{{{labels},le="+Inf"}} {h.count}')
+                lines.append(f"livestack_stage_duration_ms_sum{{{labels}}} {h.sum}")
+                lines.append(f"livestack_stage_duration_ms_count{{{labels}}} {h.count}")
+
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE livestack_{name}_total counter")
+                    typed.add(name)
+
+                text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                series = f"livestack_{name}_total{{{text}}}" if text else f"livestack_{name}_total"
+                lines.append(f"{series} {value}")
+
+        for name, fn in sorted(self.gauges.items()):
+            lines.append(f"# TYPE livestack_{name} gauge")
+            lines.append(f"livestack_{name} {_read(fn)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _read(fn: Callable[[], float]) -> float:
+    try:
+        return float(fn())
+    except Exception:
+        return float("nan")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Profiler:
+    """
+    Opt in profiling of single frames. Every `every`th frame is run under
+    cProfile, one stage at a time on whichever thread runs it, and the stats
+    are written to `{folder}/{time}_{stage}_{key}.prof` for snakeviz or
+    pstats. Worker threads are named, so py-spy dumps of a live service show
+    which stage each one is in.
+    """
+
+    def __init__(self, folder: str, every: int = 0):
+        self.folder = folder
+        self.every = every
+        self._frames = 0
+        self._lock = Lock()
+        # only one profiler can be active in the process at a time
+        self._active = Lock()
+
+    def sample(self) -> bool:
+        """
+        Called once per frame, says whether to profile it.
+        """
+        if not self.every:
+            return False
+
+        with self._lock:
+            self._frames += 1
+            return self._frames % self.every == 0
+
+    def run(self, stage: str, key: Optional[str], fn: Callable, *args):
+        if not self._active.acquire(blocking=False):
+            logging.info(f"not profiling {stage} for {key}, another stage is being profiled")
+            return fn(*args)
+
+        profile = cProfile.Profile()
+
+        try:
+            return profile.runcall(fn, *args)
+        finally:
+            self._active.release()
+            os.makedirs(self.folder, exist_ok=True)
+            name = re.sub(r"[^\w.-]", "_", f"{time.strftime('%Y%m%d-%H%M%S')}_{stage}_{key}")
+            path = join(self.folder, f"{name}.prof")
+            profile.dump_stats(path)
+            logging.info(f"wrote profile of {stage} for {key} to {path}")
+
+
+# the process wide metrics, recorded into by Timer
+metrics = Metrics()
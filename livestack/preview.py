@@ -0,0 +1,357 @@
+import logging
+import math
+import os
+from os.path import join
+import shutil
+from threading import Lock
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image as PILImage, ImageEnhance
+from skimage import exposure
+
+from .alignment import downsample
+from .metrics import metrics
+from .utils import Timer
+
+
+def crop_center(img, cropx, cropy):
+    y, x = img.shape
+    startx = x // 2 - (cropx // 2)
+    starty = y // 2 - (cropy // 2)
+    return img[starty : starty + cropy, startx : startx + cropx]
+
+
+def mtf(m: float, x: np.ndarray) -> np.ndarray:
+    """
+    Midtones transfer function, see "Midtones Balance" in
+    https://pixinsight.com/doc/tools/HistogramTransformation/HistogramTransformation.html
+    """
+    return (m - 1) * x / ((2 * m - 1) * x - m)
+
+
+def halve(data: np.ndarray) -> np.ndarray:
+    """
+    Halves the size of an (H, W, C) image by averaging 2x2 blocks, repeating
+    the last row or column when the size is odd, so the result is
+    ceil(H / 2) by ceil(W / 2) as deep zoom levels are. 8 bit images stay 8
+    bit, rounded to the nearest value.
+    """
+    h, w = data.shape[:2]
+    if h % 2 or w % 2:
+        data = np.pad(data, ((0, h % 2), (0, w % 2), (0, 0)), mode="edge")
+
+    blocks = data.reshape(data.shape[0] // 2, 2, data.shape[1] // 2, 2, data.shape[2])
+
+    if data.dtype == np.uint8:
+        total = blocks[:, 0, :, 0].astype(np.uint16)
+        total += blocks[:, 0, :, 1]
+        total += blocks[:, 1, :, 0]
+        total += blocks[:, 1, :, 1]
+        total += 2
+        total >>= 2
+        return total.astype(np.uint8)
+
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def pool(stale: np.ndarray) -> np.ndarray:
+    """
+    The tiles of the next level down that cover any of the `stale` tiles of
+    a level.
+    """
+    rows, cols = stale.shape
+    padded = np.zeros((rows + rows % 2, cols + cols % 2), dtype=bool)
+    padded[:rows, :cols] = stale
+
+    return padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).any(axis=(1, 3))
+
+
+class PreviewRenderer:
+    """
+    Renders the stretched PNG previews of stacks.
+
+    Frames are downsampled before anything else, so the stretch statistics and
+    the stretch itself run on a preview sized image and the cost doesn't grow
+    with the sensor. The auto stretch parameters (the same ones
+    auto_stretch.Stretch uses) are kept per key and eased towards the new
+    values as subs come in, so the preview doesn't flicker from one sub to
+    the next.
+
+    With a `tile_size`, the full resolution stack can also be rendered as a
+    Deep Zoom (DZI) tile pyramid, `{key}.dzi` and `{key}_files/{level}/{col}_{row}.png`,
+    that viewers like OpenSeadragon load tile by tile as they pan and zoom.
+    The stack is stretched to 8 bits once, and the pyramid is built from
+    that. Each full resolution tile is boiled down to a grid of block means,
+    and only the tiles where a block moved by more than `tile_threshold`
+    since they were last written are encoded and written again, along with
+    the tiles of the smaller levels that cover them. Nothing else of those
+    levels is computed at all.
+    """
+
+    def __init__(
+        self,
+        factor: int = 4,
+        max_size: int = 2048,
+        smoothing: float = 0.5,
+        target_bkg: float = 0.25,
+        shadows_clip: float = -1.25,
+        tile_size: int = 0,
+        tile_format: str = "png",
+        tile_threshold: float = 1.0 / 255,
+    ):
+        # downsample by at least `factor`, and further until it fits `max_size`
+        self.factor = factor
+        self.max_size = max_size
+        # weight given to the newest stretch parameters
+        self.smoothing = smoothing
+        self.target_bkg = target_bkg
+        self.shadows_clip = shadows_clip
+        self._params: Dict[str, List[Tuple[float, float, float]]] = {}
+        self._lock = Lock()
+
+        assert tile_format in ("png", "webp"), tile_format
+        assert tile_size % 16 == 0, f"tile size {tile_size} is not a multiple of 16"
+        self.tile_size = tile_size
+        self.tile_format = tile_format
+        self.tile_threshold = tile_threshold
+        # block means of every full resolution tile, by key, as last written
+        self._signatures: Dict[str, np.ndarray] = {}
+        # the 8 bit levels of each pyramid below full resolution, see render_tiles
+        self._levels: Dict[str, List[np.ndarray]] = {}
+
+    def render(self, key: str, data: np.ndarray, path: str) -> str:
+        with Timer(f"rendering preview for {key}", stage="png", key=key):
+            channels = data if data.ndim == 3 else data[np.newaxis]
+
+            h, w = channels.shape[1] - 128, channels.shape[2] - 128
+            factor = max(self.factor, math.ceil(max(h, w) / self.max_size))
+
+            small = [downsample(crop_center(c, w, h), factor) for c in channels]
+            params = self._update_params(key, [self._stretch_params(c) for c in small])
+            stretched = [self._stretch(c, p) for c, p in zip(small, params)]
+
+            if data.ndim == 2:  # mono
+                scaled = (stretched[0] * 65535).astype(np.uint16)
+                PILImage.fromarray(scaled).save(path)
+            elif data.ndim == 3:  # osc
+                final = np.dstack(stretched)
+                # the output is 8 bit, so more than 256 bins buys nothing
+                final = exposure.equalize_adapthist(final, clip_limit=0.0001, nbins=256)
+                final = (final * 255).astype(np.uint8)
+
+                png_image = PILImage.fromarray(final, mode="RGB")
+                converter = ImageEnhance.Color(png_image)
+                saturated = converter.enhance(2)  # increase color saturation
+                saturated.save(path)
+            else:
+                raise Exception(f"invalid image dimensions {data.ndim}")
+
+        metrics.inc("bytes_written", os.path.getsize(path))
+        return path
+
+    def render_tiles(self, key: str, data: np.ndarray, folder: str) -> Dict[str, Any]:
+        """
+        Brings the tile pyramid of a stack up to date, with the stretch last
+        used by `render` for it. Returns a description of the pyramid and the
+        [level, col, row] of the tiles that were written.
+        """
+        with Timer(f"rendering tiles for {key}", stage="tiles", key=key):
+            with self._lock:
+                params = self._params.get(key)
+                previous = self._signatures.get(key)
+                pyramid = self._levels.get(key)
+
+            channels = data if data.ndim == 3 else data[np.newaxis]
+            if params is None or len(params) != len(channels):
+                params = [self._stretch_params(downsample(c, self.factor)) for c in channels]
+
+            h, w = channels.shape[1] - 128, channels.shape[2] - 128
+            image = self._stretch8([crop_center(c, w, h) for c in channels], params)
+
+            tiles = join(folder, f"{key}_files")
+            top = max(0, math.ceil(math.log2(max(h, w))))
+
+            signature = self._signature(image)
+            fresh = previous is None or pyramid is None or previous.shape != signature.shape
+            if fresh:
+                # a new stack, or a new size, so nothing on disk can be reused
+                shutil.rmtree(tiles, ignore_errors=True)
+                stale = np.ones(signature.shape[:2], dtype=bool)
+                previous = signature
+            else:
+                diff = np.abs(signature - previous)
+                stale = (diff > self.tile_threshold * 255).any(axis=(2, 3, 4))
+                # only what is written is remembered, so changes too small to
+                # show from one render to the next still add up
+                previous[stale] = signature[stale]
+
+            if pyramid is None or fresh:
+                levels = [np.empty(0)] * top + [image]
+            else:
+                levels = pyramid + [image]
+            changed = []
+            written = 0
+            t = self.tile_size
+
+            for level in range(top, -1, -1):
+                if not stale.any():
+                    # nothing below a level that is up to date can have changed
+                    break
+
+                os.makedirs(join(tiles, str(level)), exist_ok=True)
+                for row, col in zip(*np.nonzero(stale)):
+                    tile = levels[level][row * t : (row + 1) * t, col * t : (col + 1) * t]
+                    written += self._write_tile(tile, join(tiles, str(level)), int(col), int(row))
+                    changed.append([level, int(col), int(row)])
+
+                if not level:
+                    break
+
+                stale = pool(stale)
+                if fresh:
+                    levels[level - 1] = halve(levels[level])
+                    continue
+
+                # each tile of the next level is made from 2x2 tiles of this one
+                for row, col in zip(*np.nonzero(stale)):
+                    y, x = row * t, col * t
+                    block = levels[level][2 * y : 2 * (y + t), 2 * x : 2 * (x + t)]
+                    levels[level - 1][y : y + t, x : x + t] = halve(block)
+
+            dzi = join(folder, f"{key}.dzi")
+            if fresh:
+                self._write_dzi(dzi, w, h)
+
+            with self._lock:
+                self._signatures[key] = previous
+                # all but the full resolution level, which is made again from
+                # the stack every time
+                self._levels[key] = levels[:top]
+
+        metrics.inc("bytes_written", written)
+        logging.info(f"wrote {len(changed)} tiles for {key}")
+
+        return {
+            "key": key,
+            "dzi": f"{key}.dzi",
+            "width": w,
+            "height": h,
+            "tile_size": self.tile_size,
+            "format": self.tile_format,
+            "changed": changed,
+        }
+
+    def _stretch8(
+        self,
+        channels: List[np.ndarray],
+        params: List[Tuple[float, float, float]],
+        band_bytes: int = 1024 * 1024,
+    ) -> np.ndarray:
+        """
+        Stretches (H, W) channels into an 8 bit (H, W, C) image, a band of
+        rows at a time so the float32 copies stay small.
+        """
+        h, w = channels[0].shape
+        out = np.empty((h, w, len(channels)), dtype=np.uint8)
+        rows = max(1, band_bytes // max(4 * w * len(channels), 1))
+
+        for start in range(0, h, rows):
+            band = np.stack(
+                [self._stretch(c[start : start + rows], p) for c, p in zip(channels, params)],
+                axis=-1,
+            )
+
+            if band.shape[2] == 3:
+                # the same saturation boost as the PNG preview
+                luminance = band.mean(axis=2, keepdims=True)
+                band = np.clip(luminance + 2 * (band - luminance), 0.0, 1.0)
+
+            band *= 255
+            band += 0.5
+            out[start : start + rows] = band
+
+        return out
+
+    def _grid(self, h: int, w: int) -> Tuple[int, int]:
+        return math.ceil(h / self.tile_size), math.ceil(w / self.tile_size)
+
+    def _signature(self, image: np.ndarray, blocks: int = 16) -> np.ndarray:
+        """
+        The means of `blocks` x `blocks` blocks of every tile of an 8 bit
+        `image`, as a (rows, cols, blocks, blocks, C) array.
+        """
+        h, w, c = image.shape
+        rows, cols = self._grid(h, w)
+        size = self.tile_size // blocks
+
+        padded = np.zeros((rows * self.tile_size, cols * self.tile_size, c), dtype=np.uint8)
+        padded[:h, :w] = image
+
+        # the rows of each block first, whole image rows at a time, which is
+        # much quicker than summing both block axes at once
+        b = padded.reshape(rows * blocks, size, -1).sum(axis=1, dtype=np.uint32)
+        b = b.reshape(rows, blocks, cols, blocks, size, c).sum(axis=4)
+        return (b * np.float32(1.0 / (size * size))).transpose(0, 2, 1, 3, 4)
+
+    def _write_tile(self, tile: np.ndarray, folder: str, col: int, row: int) -> int:
+        path = join(folder, f"{col}_{row}.{self.tile_format}")
+        pil = PILImage.fromarray(tile[:, :, 0] if tile.shape[2] == 1 else tile)
+
+        # viewers can ask for a tile at any moment, so never show them half of one
+        pil.save(f"{path}.tmp", format=self.tile_format.upper())
+        os.replace(f"{path}.tmp", path)
+
+        return os.path.getsize(path)
+
+    def _write_dzi(self, path: str, w: int, h: int):
+        with open(f"{path}.tmp", "w") as f:
+            f.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                f'Format="{self.tile_format}" Overlap="0" TileSize="{self.tile_size}">'
+                f'<Size Width="{w}" Height="{h}"/></Image>\n'
+            )
+        os.replace(f"{path}.tmp", path)
+
+    def _stretch_params(self, data: np.ndarray) -> Tuple[float, float, float]:
+        peak = float(data.max()) or 1.0
+        d = data / peak
+
+        median = float(np.median(d))
+        avg_dev = float(np.mean(np.abs(d - median)))
+
+        # keep clear of the values where the stretch divides by zero
+        c0 = float(np.clip(median + self.shadows_clip * avg_dev, 0.0, 0.999))
+        m = float(np.clip(mtf(self.target_bkg, np.float64(median - c0)), 1e-6, 1 - 1e-6))
+
+        return peak, c0, m
+
+    def _update_params(
+        self, key: str, params: List[Tuple[float, float, float]]
+    ) -> List[Tuple[float, float, float]]:
+        with self._lock:
+            previous = self._params.get(key)
+
+            if previous is not None and len(previous) == len(params):
+                a = self.smoothing
+                params = [
+                    (
+                        a * new[0] + (1 - a) * old[0],
+                        a * new[1] + (1 - a) * old[1],
+                        a * new[2] + (1 - a) * old[2],
+                    )
+                    for new, old in zip(params, previous)
+                ]
+
+            self._params[key] = params
+            return params
+
+    def _stretch(self, data: np.ndarray, params: Tuple[float, float, float]) -> np.ndarray:
+        peak, c0, m = params
+
+        d = data * np.float32(1.0 / (peak * (1 - c0)))
+        d -= np.float32(c0 / (1 - c0))
+        np.clip(d, 0.0, 1.0, out=d)
+
+        return np.clip(mtf(np.float32(m), d), 0.0, 1.0, out=d)
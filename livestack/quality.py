@@ -0,0 +1,188 @@
+from collections import deque
+import logging
+from threading import Lock
+from typing import Deque, Dict, Optional, Tuple
+
+import numpy as np
+import sep
+
+from .alignment import downsample
+from .utils import Timer
+
+
+# ratio of the full width at half maximum to the standard deviation of a gaussian
+FWHM_SIGMA = 2.0 * np.sqrt(2.0 * np.log(2.0))
+
+
+def measure(
+    data: np.ndarray, factor: int = 4, max_stars: int = 200, radius: int = 8
+) -> Dict[str, float]:
+    """
+    Measures the seeing and transparency of a calibrated frame: the number of
+    stars, their median FWHM, half flux radius and eccentricity, and the sky
+    background and noise.
+
+    Stars are found on a copy downsampled by `factor`, where they are only a
+    pixel or two across and can't be measured, so the brightest `max_stars`
+    are measured at full resolution, all at once, from the moments of a
+    small cutout around each of them.
+    """
+    if data.ndim == 3:
+        data = data.mean(axis=0, dtype=np.float32)
+
+    small = np.ascontiguousarray(downsample(data, factor))
+
+    bkg = sep.Background(small)
+    sources = sep.extract(small - bkg.back(), 5 * bkg.globalrms, minarea=3)
+
+    metrics = {
+        "stars": float(len(sources)),
+        "fwhm": float("nan"),
+        "hfr": float("nan"),
+        "eccentricity": float("nan"),
+        "background": float(bkg.globalback),
+        "noise": float(bkg.globalrms),
+    }
+
+    # blended and truncated sources give misleading shapes
+    sources = sources[sources["flag"] == 0]
+    sources.sort(order="flux")
+    sources = sources[::-1][:max_stars]
+
+    # centre of the downsampled pixel, in full resolution pixels
+    cy = np.round(sources["y"] * factor + (factor - 1) / 2).astype(int)
+    cx = np.round(sources["x"] * factor + (factor - 1) / 2).astype(int)
+    inside = (
+        (cy >= radius)
+        & (cy < data.shape[0] - radius)
+        & (cx >= radius)
+        & (cx < data.shape[1] - radius)
+    )
+    cy, cx = cy[inside], cx[inside]
+
+    if len(cy) == 0:
+        return metrics
+
+    offsets = np.arange(-radius, radius + 1)
+    cutouts = data[
+        cy[:, None, None] + offsets[None, :, None], cx[:, None, None] + offsets[None, None, :]
+    ]
+
+    # the local sky is the median of the cutout's border
+    border = np.concatenate(
+        [cutouts[:, 0], cutouts[:, -1], cutouts[:, 1:-1, 0], cutouts[:, 1:-1, -1]], axis=1
+    )
+    stars = cutouts - np.median(border, axis=1)[:, None, None]
+    np.clip(stars, 0.0, None, out=stars)
+
+    flux = stars.sum(axis=(1, 2))
+    stars, flux = stars[flux > 0], flux[flux > 0]
+
+    if len(flux) == 0:
+        return metrics
+
+    def moment(values: np.ndarray) -> np.ndarray:
+        return (stars * values).sum(axis=(1, 2)) / flux
+
+    yy, xx = np.meshgrid(offsets, offsets, indexing="ij")
+    dy = yy[None] - moment(yy[None])[:, None, None]
+    dx = xx[None] - moment(xx[None])[:, None, None]
+
+    hfr = moment(np.hypot(dy, dx))
+
+    # the variances along the major and minor axes are the eigenvalues of the
+    # covariance matrix
+    vyy, vxx, vxy = moment(dy * dy), moment(dx * dx), moment(dx * dy)
+    mean = (vxx + vyy) / 2
+    spread = np.sqrt(((vxx - vyy) / 2) ** 2 + vxy ** 2)
+    major, minor = mean + spread, np.clip(mean - spread, 0.0, None)
+
+    metrics["fwhm"] = float(FWHM_SIGMA * np.median(np.sqrt(mean)))
+    metrics["hfr"] = float(np.median(hfr))
+
+    # a single hot or saturated pixel has no spread and no shape
+    shaped = major > 0
+    if shaped.any():
+        metrics["eccentricity"] = float(np.median(np.sqrt(1 - minor[shaped] / major[shaped])))
+
+    return metrics
+
+
+class QualityGate:
+    """
+    Decides whether a light frame goes into its stack, and with what weight.
+
+    Frames are rejected when they break one of the absolute limits, or when
+    they show fewer than `min_star_ratio` of the stars that recent frames of
+    the same key did, which is what passing cloud looks like. With
+    `weighting`, the weight of a frame is its 1 / (FWHM² · noise²) relative to
+    the median of the recent frames of its key, so sharper and cleaner frames
+    count for more. Every limit and the weighting are off by default, so every
+    frame goes in with the same weight, as before frames were measured.
+    """
+
+    def __init__(
+        self,
+        factor: int = 4,
+        max_fwhm: float = 0.0,
+        max_eccentricity: float = 0.0,
+        min_stars: int = 0,
+        min_star_ratio: float = 0.0,
+        weighting: bool = False,
+        history: int = 20,
+    ):
+        self.factor = factor
+        self.max_fwhm = max_fwhm
+        self.max_eccentricity = max_eccentricity
+        self.min_stars = min_stars
+        self.min_star_ratio = min_star_ratio
+        self.weighting = weighting
+        self.history = history
+        # star counts and scores of the recently accepted frames of each key
+        self._recent: Dict[str, Deque[Tuple[float, float]]] = {}
+        self._lock = Lock()
+
+    def measure(self, key: str, data: np.ndarray) -> Dict[str, float]:
+        with Timer(f"measuring frame quality for {key}", stage="quality", key=key):
+            return measure(data, self.factor)
+
+    def judge(self, key: str, metrics: Dict[str, float]) -> Tuple[Optional[str], float]:
+        """
+        Returns why the frame should be rejected, or None, and its weight.
+        """
+        stars, fwhm = metrics["stars"], metrics["fwhm"]
+
+        with self._lock:
+            recent = self._recent.setdefault(key, deque(maxlen=self.history))
+            typical = float(np.median([r[0] for r in recent])) if recent else 0.0
+
+        if self.min_stars and stars < self.min_stars:
+            return f"only {stars:.0f} stars found", 0.0
+        if self.max_fwhm and not fwhm <= self.max_fwhm:
+            return f"FWHM {fwhm:.2f}px is over {self.max_fwhm:.2f}px", 0.0
+        if self.max_eccentricity and not metrics["eccentricity"] <= self.max_eccentricity:
+            return (
+                f"eccentricity {metrics['eccentricity']:.2f} "
+                f"is over {self.max_eccentricity:.2f}",
+                0.0,
+            )
+        if stars < self.min_star_ratio * typical:
+            return f"only {stars:.0f} stars found, against {typical:.0f} in recent frames", 0.0
+
+        score = 1.0
+        if np.isfinite(fwhm) and fwhm > 0 and metrics["noise"] > 0:
+            score = 1.0 / (fwhm * fwhm * metrics["noise"] * metrics["noise"])
+
+        with self._lock:
+            recent.append((stars, score))
+            median = float(np.median([r[1] for r in recent]))
+
+        weight = score / median if self.weighting and median > 0 else 1.0
+
+        logging.info(
+            f"frame quality for {key}: {stars:.0f} stars, FWHM {fwhm:.2f}px, "
+            f"HFR {metrics['hfr']:.2f}px, eccentricity {metrics['eccentricity']:.2f}, "
+            f"weight {weight:.2f}"
+        )
+
+        return None, weight
@@ -1,73 +1,286 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import hashlib
+import io
 import logging
 import math
 import simplejson as json
 import os
+from glob import glob
 from os.path import join, isfile
-from queue import Queue, Empty
-from threading import Thread
-from typing import Optional, Tuple, List, Dict
+from queue import Queue, Empty, Full
+import sqlite3
+from threading import Condition, Lock, Thread
+import time
+from typing import Any, Callable, Iterable, Optional, Protocol, Tuple, List, Dict, Set
 import uuid
+import warnings
 
-import astroalign as aa
 from astropy.io import fits
 from astropy.io.fits import ImageHDU, HDUList, Header, Card, PrimaryHDU
 import numpy as np
 import png
-from skimage import filters, transform, exposure
-from auto_stretch.stretch import Stretch
-from PIL import Image as PILImage, ImageEnhance
-from colour_demosaicing import demosaicing_CFA_Bayer_bilinear
-
+from skimage import filters
+
+from .alignment import Aligner
+from .cache import ImageCache
+from . import debayer
+from . import integration
+from .live import LiveView, Roi
+from .masters import MasterBuilder
+from .metrics import Profiler, metrics
+from .preview import PreviewRenderer
+from .quality import QualityGate
+from .storage import Storage
 from .utils import Timer
 
 
-def crop_center(img, cropx, cropy):
-    y, x = img.shape
-    startx = x // 2 - (cropx // 2)
-    starty = y // 2 - (cropy // 2)
-    return img[starty : starty + cropy, startx : startx + cropx]
+def to_float32(
+    data: np.ndarray, bitpix: int, bscale: float = 1.0, bzero: float = 0.0
+) -> np.ndarray:
+    """
+    Converts FITS pixel data to float32. Integer data is scaled to [0, 1] in a
+    single multiply straight into the output array, so a memory-mapped file is
+    read once and never staged as float64. `data` holds the values as stored,
+    as files are opened with `do_not_scale_image_data`, so `bscale` and `bzero`
+    are applied here, like the BZERO of 32768 of unsigned 16 bit data. Where
+    astropy does scale the data, it drops BSCALE and BZERO from the header.
+    """
+    out = np.empty(data.shape, dtype=np.float32)
+
+    if bitpix > 0:
+        scale = 1.0 / (int(math.pow(2, bitpix)) - 1)
+    else:  # fits stores bitpix as -32 or -64 for floating point data
+        scale = 1.0
+
+    np.multiply(data, np.float32(bscale * scale), out=out)
+    if bzero:
+        out += np.float32(bzero * scale)
+
+    if bitpix > 0:
+        np.clip(out, 0.0, 1.0, out=out)
+
+    return out
+
+
+def _number(hdr: Header, name: str) -> Optional[float]:
+    try:
+        return float(hdr[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def calibrate(
+    data: np.ndarray,
+    dark: Optional[np.ndarray] = None,
+    inverse_flat: Optional[np.ndarray] = None,
+    band_bytes: int = 1024 * 1024,
+) -> np.ndarray:
+    """
+    Dark subtracts and flat fields a float32 frame in place, as
+    clip((data - dark) * inverse_flat, 0, 1). The frame is worked through in
+    bands of rows of about `band_bytes`, so each band is still in the CPU cache
+    for the next operation and the frame is streamed from memory once rather
+    than once per operation. The single clip at the end is all that is needed
+    to keep the result in [0, 1].
+    """
+    assert data.dtype == np.float32, f"{data.dtype}"
+    for other in (dark, inverse_flat):
+        assert other is None or other.shape == data.shape, f"{other.shape} {data.shape}"
+
+    rows = max(1, band_bytes // max(data[0].nbytes, 1))
+
+    for start in range(0, data.shape[0], rows):
+        band = data[start : start + rows]
+
+        if dark is not None:
+            np.subtract(band, dark[start : start + rows], out=band)
+        if inverse_flat is not None:
+            np.multiply(band, inverse_flat[start : start + rows], out=band)
+
+        np.clip(band, 0.0, 1.0, out=band)
+
+    return data
+
+
+def inverse_normalized(flat: np.ndarray) -> np.ndarray:
+    """
+    mean(flat) / flat, to flat field by multiplying rather than dividing. Dead
+    pixels, where the flat is 0, come out as 0.
+    """
+    out = np.zeros(flat.shape, dtype=np.float32)
+    np.divide(np.float32(flat.mean(dtype=np.float64)), flat, out=out, where=flat > 0)
+    return out
 
 
 class Image:
     def __init__(self, img: ImageHDU):
+        self._reset()
+        self._data: Optional[np.ndarray] = self._decode(img.data, img.header)
+        self._read_header(img.header)
+
+    def _reset(self, path: Optional[str] = None):
         self.subcount = 1
+        # how the frame was registered, see Aligner.align
+        self.alignment: Dict[str, Any] = {}
+        # seeing and transparency of the frame, see quality.measure
+        self.quality: Dict[str, float] = {}
+        # how the stack is integrated and the per pixel state that needs, see
+        # integration.py. None until the state has been loaded.
+        self.integration: Optional[str] = None
+        self.state: integration.State = {}
+        # where the pixels are read from when a frame is opened lazily
+        self.path: Optional[str] = path
+        # whether the frame is run under the profiler, see metrics.Profiler
+        self.profiled = False
+        # the order the frame was queued for the workers in, see
+        # Stacker._dispatcher
+        self.seq = 0
+        # how many bytes of pixels the file is short of what its header
+        # says, when it is still being written
+        self.missing = 0
+
+    @property
+    def data(self) -> np.ndarray:
+        if self._data is None:
+            assert self.path is not None, f"no pixel data for {self.key}"
+
+            with Timer(f"loading pixels from {self.path}", stage="load", key=self.key):
+                with fits.open(self.path, memmap=True, do_not_scale_image_data=True) as f:
+                    self._data = self._decode(f[0].data, f[0].header)
+
+            metrics.inc("bytes_read", os.path.getsize(self.path))
+
+        return self._data
+
+    @data.setter
+    def data(self, value: np.ndarray):
+        self._data = value
 
-        hdr = img.header
+    def _decode(self, pixels: np.ndarray, hdr: Header) -> np.ndarray:
         bitpix = int(hdr["BITPIX"])
 
+        data = to_float32(
+            pixels, bitpix, float(hdr.get("BSCALE", 1.0)), float(hdr.get("BZERO", 0.0))
+        )
+
         if bitpix > 0:
-            self.data = np.float32(np.interp(img.data, (0, int(math.pow(2, bitpix)) - 1), (0, 1)))
-        else: # fits stores bitpix as -32 or -64 for floating point data
-            self.data = np.float32(img.data)
+            assert data.dtype == np.float32, f"{data.dtype}"
+        else:
+            assert (
+                data.dtype == np.float32 and data.max() <= 1.0 and data.min() >= 0.0
+            ), f"{data.dtype} {data.max()} {data.min()}"
+
+        return data
 
-        assert self.data.dtype == np.float32 and self.data.max() <= 1.0 and self.data.min() >= 0.0, f"{self.data.dtype} {self.data.max()} {self.data.min()}"
+    def _read_header(self, hdr: Header):
+        # identifies the exposure even if the file is renamed or copied
+        self.fingerprint = hashlib.sha1(hdr.tostring().encode()).hexdigest()
+
+        # why the frame can't be used, if it can't
+        self.rejected: Optional[str] = None
 
         self.bayer_pattern = hdr.get("BAYERPAT", None)
 
-        self.camera = hdr["INSTRUME"]
-        self.exp = round(float(hdr["EXPTIME"]), 2)
+        self.camera = hdr.get("INSTRUME")
         self.gain = hdr.get("GAIN", 0)
-        # round temp to the nearest 5 degrees
-        self.temp = 5 * round(float(hdr["CCD-TEMP"]) / 5)
+        self.subcount = hdr.get("SUBCOUNT") or 1
+        # the weight of a frame, or the total weight of the frames in a stack
+        self.weight = float(hdr.get("TOTWGT") or self.subcount)
+        # the flush that wrote a stack, see DB.flush
+        self.flush_id = hdr.get("FLUSHID")
+        # the key suffix of a reduced live view frame or stack, see live.LiveView
+        self.live = hdr.get("LIVEVIEW", "")
+        # how a colour frame is, or a stack was, debayered, see
+        # Stacker._choose_debayer
+        self.debayer_mode: Optional[str] = hdr.get("DEBAYER")
+        # how many frames of its live view stack a full resolution stack has
+        # been built from, see Stacker.build_full
+        self.live_subs = int(hdr.get("LIVESUBS") or 0)
+        self.image_type: Optional[str] = None
+        self.target = None
+        self.filter = None
+
+        exp = _number(hdr, "EXPTIME")
+        self.exp = round(exp, 2) if exp is not None else None
 
-        image_type = hdr["IMAGETYP"]
+        # round temp to the nearest 5 degrees
+        temp = _number(hdr, "CCD-TEMP")
+        self.temp = 5 * round(temp / 5) if temp is not None and math.isfinite(temp) else None
 
-        self.subcount = hdr.get("SUBCOUNT") or 1
+        image_type = str(hdr.get("IMAGETYP", "")).lower()
 
-        if str(image_type).lower().find("light") >= 0:
+        if image_type.find("light") >= 0:
             self.image_type = "LIGHT"
-            self.target = hdr["OBJECT"]
+            self.target = hdr.get("OBJECT")
             self.filter = hdr.get("FILTER", "NONE")
 
-        elif str(image_type).lower().find("dark") >= 0:
+        elif image_type.find("dark") >= 0:
             self.image_type = "DARK"
-            self.target = None
-            self.filter = None
 
-        elif str(image_type).lower().find("flat") >= 0:
+        elif image_type.find("flat") >= 0:
             self.image_type = "FLAT"
             self.filter = hdr.get("FILTER", "NONE")
-            self.target = None
+
+        elif image_type.find("bias") >= 0:
+            self.rejected = "bias frames are not used"
+            return
+
+        else:
+            self.rejected = f"unknown IMAGETYP {hdr.get('IMAGETYP')!r}"
+            return
+
+        if not self.camera:
+            self.rejected = "missing INSTRUME"
+        elif self.exp is None:
+            self.rejected = "missing or invalid EXPTIME"
+        elif self.temp is None:
+            self.rejected = "missing or invalid CCD-TEMP"
+        elif self.image_type == "LIGHT" and not self.target:
+            self.rejected = "light frame without OBJECT"
+
+    @classmethod
+    def triage(cls, path: str) -> "Image":
+        """
+        Reads only the header of a file. The frame can be classified, keyed and
+        rejected from that alone, and its pixels are read the first time
+        `data` is used.
+        """
+        img = cls.__new__(cls)
+        img._reset(path)
+        img._data = None
+
+        with warnings.catch_warnings():
+            # astropy warns about short files, which are dealt with below
+            warnings.simplefilter("ignore")
+            with fits.open(path, memmap=True, do_not_scale_image_data=True) as f:
+                hdr = f[0].header
+                start = f.fileinfo(0)["datLoc"]
+
+        img._read_header(hdr)
+
+        # only frames have to be 2d, stacks of colour frames are 3d
+        if not img.rejected and (
+            hdr.get("NAXIS") != 2 or not hdr.get("NAXIS1") or not hdr.get("NAXIS2")
+        ):
+            img.rejected = f"not a 2d image, NAXIS is {hdr.get('NAXIS')}"
+
+        if not img.rejected:
+            size = int(hdr["NAXIS1"]) * int(hdr["NAXIS2"]) * abs(int(hdr["BITPIX"])) // 8
+            img.missing = max(0, start + size - os.path.getsize(path))
+
+        return img
+
+    @classmethod
+    def from_pixels(cls, pixels: np.ndarray, hdr: Header) -> "Image":
+        """
+        An image from pixels of any dtype, as read back from a Storage.
+        """
+        img = cls.__new__(cls)
+        img._reset()
+        img._data = img._decode(pixels, hdr)
+        img._read_header(hdr)
+        return img
 
     def __iter__(self):
         yield "camera", self.camera
@@ -86,8 +299,13 @@ class Image:
 
     @property
     def key(self) -> Optional[str]:
-        if self.image_type == "LIGHT":
-            return f"{self.camera}_{self.image_type}_{self.target}_{self.filter}_{self.exp}_{self.gain}_{self.temp}"
+        if self.rejected:
+            return None
+        elif self.image_type == "LIGHT":
+            return (
+                f"{self.camera}_{self.image_type}_{self.target}_{self.filter}_{self.exp}"
+                f"_{self.gain}_{self.temp}{self.geometry}{self.live}"
+            )
         elif self.image_type == "DARK":
             return f"{self.camera}_{self.image_type}_{self.exp}_{self.gain}_{self.temp}"
         elif self.image_type == "FLAT":
@@ -96,6 +314,15 @@ class Image:
             )
         return None
 
+    @property
+    def geometry(self) -> str:
+        """
+        The key suffix of a stack debayered to a different size than the
+        frames it's made from, so it never mixes with stacks of full size
+        colour frames.
+        """
+        return "_SUPERPIXEL" if self.debayer_mode == "superpixel" else ""
+
     @property
     def dark_key(self) -> Optional[str]:
         if self.image_type == "LIGHT" or self.image_type == "FLAT":
@@ -128,129 +355,540 @@ class Image:
             hdr.set("IMAGETYP", "Dark Frame")
 
         hdr.set("SUBCOUNT", self.subcount)
+        hdr.set("TOTWGT", self.weight)
+
+        if self.debayer_mode:
+            hdr.set("DEBAYER", self.debayer_mode)
+        if self.live:
+            hdr.set("LIVEVIEW", self.live)
+        if self.live_subs:
+            hdr.set("LIVESUBS", self.live_subs)
 
         return hdr
 
 
-    def save_fits(self, folder: str) -> str:
-        data = self.data.copy()
+    def hdu(self, flush_id: Optional[str] = None) -> PrimaryHDU:
+        data = self.data
 
-        assert data.dtype == np.float32 and data.max() <= 1.0 and data.min() >= 0.0, f"{data.dtype} {data.max()} {data.min()}"
+        assert (
+            data.dtype == np.float32 and data.max() <= 1.0 and data.min() >= 0.0
+        ), f"{data.dtype} {data.max()} {data.min()}"
 
-        hdu = PrimaryHDU(
-            data=self.data,
-            header=self.fits_header,
+        hdr = self.fits_header
+        if flush_id:
+            hdr.set("FLUSHID", flush_id)
+
+        return PrimaryHDU(
+            data=data,
+            header=hdr,
         )
-        l = HDUList([hdu])
-        path = join(folder, f"{self.key}.fits")
-        l.writeto(path, overwrite=True)
+
+    def save(self, storage: Storage, flush_id: Optional[str] = None) -> str:
+        hdu = self.hdu(flush_id)
+        path = storage.write(str(self.key), hdu.data, hdu.header)
+
+        metrics.inc("bytes_written", storage.size(str(self.key)))
         return path
 
-    def save_stretched_png(self, folder: str) -> str:
-        data = self.data.copy()
+    def to_fits_bytes(self) -> bytes:
+        """
+        The image as a plain FITS file, for exporting stacks kept in another format.
+        """
+        buf = io.BytesIO()
+        HDUList([self.hdu()]).writeto(buf)
+        return buf.getvalue()
+
+    def save_stretched_png(self, folder: str, renderer: Optional[PreviewRenderer] = None) -> str:
         path = join(folder, f"{self.key}.png")
 
-        assert data.dtype == np.float32 and data.max() <= 1.0 and data.min() >= 0.0, f"{data.dtype} {data.max()} {data.min()}"
+        assert self.data.dtype == np.float32, f"{self.data.dtype}"
 
-        if data.ndim == 2: # mono
-            data = crop_center(data, data.shape[1] - 128, data.shape[0] - 128)
+        if renderer is None:
+            renderer = PreviewRenderer()
 
-            with Timer("stretch"):
-                data = Stretch().stretch(data)
+        return renderer.render(str(self.key), self.data, path)
 
-            data = transform.downscale_local_mean(data, (4, 4))
-            data = np.clip(data, 0.0, 1.0)
 
-            assert data.dtype == np.float32 and data.max() <= 1.0 and data.min() >= 0.0, f"{data.dtype} {data.max()} {data.min()}"
+# path, size, mtime, header fingerprint and stack key of a processed file
+FileRecord = Tuple[str, Optional[int], Optional[float], Optional[str], Optional[str]]
 
-            with Timer(f"saving {self.key}.png"):
-                scaled = np.interp(data, (0, 1), (0, 65535)).astype(np.uint16)
 
-                png_image = PILImage.fromarray(scaled)
-                png_image.save(path)
-        elif data.ndim == 3: # osc
-            channels = []
+class DB:
+    def __init__(
+        self,
+        folder: str,
+        cache_size: int = 1024 * 1024 * 1024,
+        storage_format: str = "fits",
+        quantize: float = 16.0,
+    ):
+        self.folder = folder
+        self.cache = ImageCache(cache_size)
+        # how stacks and masters are written, see storage.py
+        self.storage = Storage(folder, storage_format, quantize)
+
+        # stacks that have been updated in memory but not written yet, and the
+        # files that went into them since the last write
+        self.dirty: Dict[str, Image] = {}
+        self.dirty_since: Dict[str, float] = {}
+        self.pending: Dict[str, List[FileRecord]] = {}
+        self._pending_paths: Set[str] = set()
+        self._lock = Lock()
+        # held while a stack is written or read, so a read never sees half of
+        # a flush. apart from `_lock`, so lookups don't wait on slow writes
+        self._stack_lock = Lock()
+
+        os.makedirs(folder, exist_ok=True)
+
+        self.conn = sqlite3.connect(join(folder, "livestack.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS processed (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                fingerprint TEXT,
+                key TEXT,
+                processed_at REAL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS processed_key ON processed (key)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks (dir TEXT PRIMARY KEY, mtime INTEGER)"
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS quality (
+                path TEXT PRIMARY KEY,
+                key TEXT,
+                stars INTEGER,
+                fwhm REAL,
+                hfr REAL,
+                eccentricity REAL,
+                background REAL,
+                noise REAL,
+                weight REAL,
+                rejected TEXT,
+                measured_at REAL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS quality_key ON quality (key)")
+        self.conn.commit()
+
+        self._migrate_processed_txt()
+        self._recover_journals()
 
-            for i in range(3):
-                channel_data = data[i]
-                channel_data = crop_center(channel_data, channel_data.shape[1] - 128, channel_data.shape[0] - 128)
+    def is_already_processed(self, path: str) -> bool:
+        if path in self._pending_paths:
+            return True
+
+        with self._lock:
+            row = self.conn.execute("SELECT 1 FROM processed WHERE path = ?", (path,)).fetchone()
+
+        return row is not None
+
+    def contributors(self, key: str) -> List[str]:
+        """
+        Returns the files that went into the stack for `key`, oldest first.
+        """
+        with self._lock:
+            # files written in the same flush share a time, and were inserted in order
+            rows = self.conn.execute(
+                "SELECT path FROM processed WHERE key = ? ORDER BY processed_at, rowid", (key,)
+            ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def weight_of(self, path: str) -> Optional[float]:
+        """
+        The weight the quality gate gave a light frame, if it was measured.
+        """
+        with self._lock:
+            row = self.conn.execute("SELECT weight FROM quality WHERE path = ?", (path,)).fetchone()
+
+        return row[0] if row else None
+
+    def processed_in(self, dir: str) -> Set[str]:
+        """
+        Returns the files under `dir` recorded as processed, in one indexed
+        range query. Files staged in a stack that hasn't been written yet are
+        left out, as they would have to be stacked again after a crash, so a
+        watermark must not be set for their directory.
+        """
+        prefix = os.path.join(dir, "")
+        # "0" sorts right after the path separator, bounding the range
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT path FROM processed WHERE path >= ? AND path < ?", (prefix, upper)
+            ).fetchall()
+
+        return {row[0] for row in rows}
+
+    def get_watermark(self, dir: str) -> Optional[int]:
+        """
+        Returns the modification time, in ns, `dir` had when every file in it
+        was last found to be processed.
+        """
+        with self._lock:
+            row = self.conn.execute("SELECT mtime FROM watermarks WHERE dir = ?", (dir,)).fetchone()
+
+        return row[0] if row else None
+
+    def set_watermark(self, dir: str, mtime: int):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?)", (dir, mtime))
+
+    def record_quality(
+        self,
+        path: str,
+        key: str,
+        metrics: Dict[str, float],
+        weight: float,
+        rejected: Optional[str],
+    ):
+        """
+        Keeps the quality metrics of a light frame for later analysis, whether
+        or not it went into the stack.
+        """
+        # sqlite has no NaN, store unmeasured values as NULL
+        values = [
+            None if math.isnan(metrics[name]) else metrics[name]
+            for name in ("stars", "fwhm", "hfr", "eccentricity", "background", "noise")
+        ]
+
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO quality VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [path, key] + values + [weight, rejected, time.time()],
+            )
 
-                with Timer("stretch"):
-                    channel_data = Stretch().stretch(channel_data)
+    def close(self):
+        with self._lock:
+            self.conn.close()
 
-                channel_data = transform.downscale_local_mean(channel_data, (4, 4))
-                channel_data = np.clip(channel_data, 0.0, 1.0)
+    def stack_exists(self, img: Image) -> bool:
+        return self.storage.exists(str(img.key))
 
-                assert channel_data.dtype == np.float32 and channel_data.max() <= 1.0 and channel_data.min() >= 0.0, f"{channel_data.dtype} {channel_data.max()} {channel_data.min()}"
+    def mark_processed(self, path: str):
+        self._mark_processed([self._record(path)])
 
-                # channel_data = np.interp(channel_data, (0.0, 1.0), (0, 255)).astype(np.uint8)
+    def get_stacked_image(self, key: str) -> Optional[Image]:
+        img = self.dirty.get(key) or self.cache.get(key)
+        if img is not None:
+            return img
 
-                channels.append(channel_data)
+        if not self.storage.exists(key):
+            return None
 
-            final = np.dstack(channels)
-            final = exposure.equalize_adapthist(final, clip_limit=0.0001, nbins=1024)
+        # a flush can put a newer stack once this one is read
+        version = self.cache.version(key)
+        try:
+            with self._stack_lock, Timer(f"loading stack {key}", stage="load_stack", key=key):
+                img = self.storage.read(key, Image.from_pixels)
+        except (OSError, ValueError) as e:
+            if not self.storage.exists(key):
+                logging.warning(f"stack {key} was removed while it was read: {e}")
+                return None
+
+            # starting over would overwrite the stack on the next flush, so it
+            # is kept for a closer look
+            moved = self.storage.quarantine(key)
+            logging.error(f"error reading stack {key}, moved {moved} aside and starting over: {e}")
+            metrics.inc("stacks_quarantined")
+            return None
 
-            final = np.interp(final, (0.0, 1.0), (0, 255)).astype(np.uint8)
+        metrics.inc("bytes_read", self.storage.size(key))
 
-            with Timer(f"saving {self.key}.png"):
+        if not self.cache.put(key, img, version):
+            return self.get_stacked_image(key)
+        return img
 
-                assert final.dtype == np.uint8
+    def stage_stacked_image(self, img: Image, path: str, fingerprint: Optional[str] = None) -> int:
+        """
+        Keeps `img` as the current stack for its key without writing it. `path`
+        is marked processed together with the stack on the next `flush`.
+        Returns the number of files waiting to be flushed for the key.
+        """
+        key = str(img.key)
+        record = self._record(path, fingerprint or img.fingerprint, key)
+
+        with self._lock:
+            self.dirty[key] = img
+            self.dirty_since.setdefault(key, time.monotonic())
+            self.pending.setdefault(key, []).append(record)
+            self._pending_paths.add(path)
+
+            return len(self.pending[key])
+
+    def hold(self, path: str) -> bool:
+        """
+        Counts `path` as processed until it is flushed or `release`d, for a
+        sub collected into a master set that hasn't been written yet. Returns
+        False if it already was.
+        """
+        with self._lock:
+            if path in self._pending_paths:
+                return False
+            self._pending_paths.add(path)
+            return True
+
+    def release(self, paths: Iterable[str]):
+        with self._lock:
+            self._pending_paths.difference_update(paths)
+
+    def flush(self, key: str) -> Optional[str]:
+        img = self.dirty.get(key)
+        if img is None:
+            return None
 
-                png_image = PILImage.fromarray(final, mode="RGB")
-                converter = ImageEnhance.Color(png_image)
-                saturated = converter.enhance(2) # increase color saturation
-                saturated.save(path)
+        records = self.pending.get(key, [])
+        flush_id = uuid.uuid4().hex
 
-            pass
-        else:
-            raise Exception(f"invalid image dimensions {data.ndim}")
+        # record what is about to be committed before touching the stack. if we
+        # die before the stack is swapped in, the journal is discarded and the
+        # files are processed again. if we die after, the FLUSHID in the stack
+        # tells recovery to mark them processed.
+        journal = join(self.folder, f"{key}.journal")
+        with open(f"{journal}.tmp", "w") as f:
+            json.dump({"key": key, "id": flush_id, "files": records}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{journal}.tmp", journal)
+
+        # the state goes first. if we die before the stack is swapped in, its
+        # flush id no longer matches the stack and it is discarded on load.
+        state = join(self.folder, f"{key}.state.npz")
+        if img.integration and img.state:
+            integration.save_state(state, img.integration, img.state, flush_id)
+        elif isfile(state):
+            os.remove(state)
+
+        with self._stack_lock:
+            path = img.save(self.storage, flush_id)
+        img.flush_id = flush_id
+        self._mark_processed(records)
+        os.remove(journal)
+
+        with self._lock:
+            self.cache.put(key, img)
+            del self.dirty[key]
+            del self.dirty_since[key]
+            self.pending.pop(key, None)
+            self._pending_paths.difference_update(r[0] for r in records)
 
         return path
 
+    def load_state(
+        self, key: str, mode: str, flush_id: Optional[str]
+    ) -> Optional[integration.State]:
+        return integration.load_state(join(self.folder, f"{key}.state.npz"), mode, flush_id)
 
-class DB:
-    def __init__(self, folder: str):
-        self.folder = folder
-        self.processed: List[str] = []
+    def _record(
+        self, path: str, fingerprint: Optional[str] = None, key: Optional[str] = None
+    ) -> FileRecord:
+        try:
+            st = os.stat(path)
+            return (path, st.st_size, st.st_mtime, fingerprint, key)
+        except OSError:
+            return (path, None, None, fingerprint, key)
+
+    def _mark_processed(self, records: List[FileRecord]):
+        now = time.time()
+
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?, ?)",
+                [tuple(r) + (now,) for r in records],
+            )
+
+    def _migrate_processed_txt(self):
+        path = join(self.folder, "processed.txt")
+        if not isfile(path):
+            return
 
-        if isfile(join(folder, "processed.txt")):
-            with open(join(folder, "processed.txt")) as f:
-                self.processed = [line.rstrip() for line in f]
+        with open(path) as f:
+            paths = [line.rstrip() for line in f if line.strip()]
 
-    def is_already_processed(self, path: str) -> bool:
-        return path in self.processed
+        logging.info(f"importing {len(paths)} processed files from {path}")
 
-    def stack_exists(self, img: Image) -> bool:
-        return os.path.isfile(join(self.folder, f"{img.key}.fits"))
+        self._mark_processed([self._record(p) for p in paths])
+        os.replace(path, f"{path}.imported")
 
-    def mark_processed(self, path: str):
-        self.processed.append(path)
-        with open(join(self.folder, "processed.txt"), "a+") as f:
-            f.write(f"{path}\n")
-            f.flush()
+    def _recover_journals(self):
+        for journal in glob(join(self.folder, "*.journal")):
+            with open(journal) as f:
+                entry = json.load(f)
 
-    def get_stacked_image(self, key: str) -> Optional[Image]:
-        try:
-            with fits.open(join(self.folder, f"{key}.fits")) as f:
-                return Image(f[0])
-        except:
-            return None
+            try:
+                flush_id = self.storage.header(entry["key"]).get("FLUSHID")
+            except OSError:
+                flush_id = None
+
+            if flush_id == entry["id"]:
+                logging.info(f"recovering {len(entry['files'])} processed files for {entry['key']}")
+                self._mark_processed(entry["files"])
+            else:
+                logging.info(f"discarding unfinished flush for {entry['key']}")
+
+            os.remove(journal)
+
+
+class Batch:
+    """
+    Light frames of one key taken together from a backlog, calibrated and
+    aligned in parallel against the stack as it was when they were taken.
+    """
+
+    def __init__(self, key: str, items: List[Tuple[str, Image]]):
+        self.key = key
+        self.items = items
+
+
+class OutputQueue(Protocol):
+    def put(self, png_path: str) -> Any:
+        ...
+
+    def put_tiles(self, tiles: Dict[str, Any]) -> Any:
+        ...
 
 
 class Stacker:
-    def __init__(self, storage_folder: str, output_folder: str):
+    def __init__(
+        self,
+        storage_folder: str,
+        output_folder: str,
+        cache_size: int = 1024 * 1024 * 1024,
+        storage_format: str = "fits",
+        storage_quantize: float = 16.0,
+        flush_frames: int = 10,
+        flush_interval: float = 60.0,
+        workers: int = 1,
+        align_mode: str = "auto",
+        align_channel: str = "luminance",
+        preview_size: int = 2048,
+        tile_size: int = 0,
+        tile_format: str = "png",
+        profile_every: int = 0,
+        cameras: Optional[List[str]] = None,
+        quality: Optional[QualityGate] = None,
+        integrations: Optional[Dict[str, str]] = None,
+        kappa: float = 3.0,
+        median_window: int = 5,
+        master_method: str = "median",
+        master_idle: float = 600.0,
+        debayer_mode: str = "bilinear32",
+        debayer_modes: Optional[Dict[str, str]] = None,
+        catchup_batch: int = 8,
+        catchup_threads: int = 0,
+        incomplete_wait: float = 5.0,
+        incomplete_tries: int = 12,
+        live_bin: int = 1,
+        live_roi: Optional[Roi] = None,
+        live_full: str = "background",
+    ):
         self.storage_folder = storage_folder
         self.output_folder = output_folder
+        # stacks are written to the storage folder after this many frames, when
+        # the oldest unsaved frame is this many seconds old, when a frame for a
+        # different key arrives, or on stop
+        self.flush_frames = flush_frames
+        self.flush_interval = flush_interval
         self.queue: Queue = Queue()
-        self.thread = None
-        self.db = DB(self.storage_folder)
+        self.threads: List[Thread] = []
+        self.db = DB(self.storage_folder, cache_size, storage_format, storage_quantize)
+        self.aligner = Aligner(self.storage_folder, align_mode, align_channel)
+        self.preview = PreviewRenderer(
+            max_size=preview_size, tile_size=tile_size, tile_format=tile_format
+        )
+        # every nth frame is profiled, when set
+        self.profiler = Profiler(join(self.storage_folder, "profiles"), profile_every)
+        # frames from any other INSTRUME are rejected, when set
+        self.cameras = set(cameras) if cameras else None
+        self.quality = quality or QualityGate()
+        # how each type of frame is integrated, see integration.create
+        modes = {"LIGHT": "mean", "DARK": "mean", "FLAT": "mean"}
+        modes.update(integrations or {})
+        self.integrations = {
+            t: integration.create(mode, kappa, median_window) for t, mode in modes.items()
+        }
         self._stop = False
-        self.output_queues: Dict[str, Queue] = {}
+        self.output_queues: Dict[str, OutputQueue] = {}
+
+        # files are handed out to one queue per worker by stack key, so frames
+        # for a key are processed in order while different keys run in parallel
+        self.workers = workers
+        self._shards: List[Queue] = [Queue() for _ in range(workers)]
+
+        # within a worker, loading and calibration, alignment and stacking, and
+        # the preview each run in their own thread joined by these queues
+        self._calibrated: List[Queue] = [Queue(maxsize=2) for _ in range(workers)]
+        self._previews: List[Queue] = [Queue() for _ in range(workers)]
+        self._shard_of: Dict[str, int] = {}
+        self._frames = 0
+        self._started = time.monotonic()
+        self._stats_lock = Lock()
+        self._queued: Set[str] = set()
+        # notified when the last queued frame is done, see wait_idle
+        self._idle = Condition(self._stats_lock)
 
         os.makedirs(self.storage_folder, exist_ok=True)
         os.makedirs(self.output_folder, exist_ok=True)
 
-    def add_output_queue(self, q: Queue) -> str:
+        # darks and flats are combined in sets by the master builder, unless
+        # they are stacked one by one like lights with "incremental"
+        self.masters: Optional[MasterBuilder] = None
+        if master_method != "incremental":
+            self.masters = MasterBuilder(self.storage_folder, master_method, kappa)
+        # a set is complete once it has had no new sub for this many seconds
+        self.master_idle = master_idle
+
+        # how colour frames are debayered, by default and for the keys matching
+        # each pattern, see debayer.debayer
+        for mode in [debayer_mode] + list((debayer_modes or {}).values()):
+            assert mode in debayer.MODES, mode
+        self.debayer_mode = debayer_mode
+        self.debayer_modes = debayer_modes or {}
+        self._masters_lock = Lock()
+        # darks and flats on their way to the master builder, by path, with
+        # their key and the order they were queued in
+        self._subs_in_flight: Dict[str, Tuple[str, int]] = {}
+        self._subs_collected = Condition()
+        self._seq = 0
+
+        # a frame that is shorter than its header says, or has no complete
+        # header yet, is still being written by something slower than the
+        # watcher allowed for, and is queued again after `incomplete_wait`
+        # seconds, up to `incomplete_tries` times
+        self.incomplete_wait = incomplete_wait
+        self.incomplete_tries = incomplete_tries
+        self._retry_at: Dict[str, float] = {}
+        self._tries: Dict[str, int] = {}
+
+        # when light frames of a key queue up, up to this many are taken at a
+        # time, calibrated and aligned on the pool and added in one go
+        self.catchup_batch = catchup_batch
+        self._pool = ThreadPoolExecutor(
+            max_workers=catchup_threads or os.cpu_count(), thread_name_prefix="catchup"
+        )
+
+        # lights can be stacked live at reduced size, see live.LiveView. The
+        # full resolution stack is then built from the same frames on the
+        # pool after each write of the live stack, or only when exported.
+        assert live_full in ("background", "demand"), live_full
+        self.live = LiveView(live_bin, live_roi)
+        self.live_full = live_full
+        self._full_lock = Lock()
+        self._full_pending: Set[str] = set()
+
+        metrics.gauge("queue_depth", lambda: self.stats()["queued"])
+        metrics.gauge("unsaved_stacks", lambda: len(self.db.dirty))
+        metrics.gauge("cache_bytes", lambda: self.db.cache.size)
+
+    def add_output_queue(self, q: OutputQueue) -> str:
         id = str(uuid.uuid4())
         self.output_queues[id] = q
         return id
@@ -259,102 +897,530 @@ class Stacker:
         del self.output_queues[id]
 
     def start(self):
-        if self.thread:
+        if self.threads:
             return
 
-        self.thread = Thread(target=self._worker)
-        self.thread.start()
+        self._started = time.monotonic()
+        # named, so they can be told apart in py-spy dumps
+        self.threads.append(Thread(target=self._dispatcher, name="dispatcher"))
+        for shard in range(self.workers):
+            for name, target in (
+                ("calibrator", self._calibrator),
+                ("integrator", self._integrator),
+                ("previewer", self._previewer),
+            ):
+                self.threads.append(Thread(target=target, args=(shard,), name=f"{name}-{shard}"))
+
+        for t in self.threads:
+            t.start()
 
     def stop(self):
         self._stop = True
-        self.thread.join()
+        for t in self.threads:
+            t.join()
+        self._pool.shutdown()
+        self.flush()
+        self.db.close()
+
+    def flush(self, keep: Optional[str] = None):
+        """
+        Writes out the unsaved stacks. With `keep`, only the other stacks
+        handled by the same worker as `keep` are written.
+        """
+        for key in list(self.db.dirty) + self._master_keys():
+            if keep is None:
+                self._flush(key)
+            elif key != keep and self._shard(key) == self._shard(keep):
+                # a master set is only complete once it has been idle, more
+                # subs can still be on their way
+                self._flush(key, final=False)
+
+    def _flush(self, key: str, final: bool = True):
+        if key in self._master_keys():
+            self._build_master(key, final)
+            return
+
+        with Timer(f"saving stacked fits for {key}", stage="save_fits", key=key):
+            self.db.flush(key)
+
+        if self.live_full == "background" and self.live.full_key(key) and not self._stop:
+            with self._stats_lock:
+                if key in self._full_pending:
+                    return
+                self._full_pending.add(key)
+
+            self._pool.submit(self._build_full_pending, key)
+
+    def _flush_expired(self, shard: int):
+        now = time.monotonic()
+
+        for key, since in list(self.db.dirty_since.items()):
+            if self._shard(key) == shard and now - since >= self.flush_interval:
+                self._flush(key)
+
+        if self.masters:
+            for key, since in list(self.masters.since.items()):
+                if self._shard(key) == shard and now - since >= self.master_idle:
+                    self._flush(key)
+
+    def _master_keys(self) -> List[str]:
+        return self.masters.keys() if self.masters else []
+
+    def _build_master(self, key: str, final: bool = True):
+        """
+        Combines the collected set of subs for a dark or flat key and writes
+        the master, if the set has grown since it was last combined. A master
+        from before the set is averaged in, weighted by the number of subs in
+        each. Unless `final`, the set is kept, so subs that come in later are
+        combined with it rather than into a master of their own.
+        """
+        assert self.masters is not None
+
+        with self._masters_lock:
+            try:
+                if not self.masters.changed(key):
+                    return
+
+                built = self.masters.build(key)
+                if built is None:
+                    return
+
+                master, paths = built
+
+                existing = self.masters.base(key, lambda: self.db.get_stacked_image(key))
+                if existing is not None and existing.data.shape == master.data.shape:
+                    total = existing.weight
+                    master.data = (total * existing.data + master.weight * master.data) / (
+                        total + master.weight
+                    )
+                    master.subcount += existing.subcount
+                    master.weight += total
+
+                for path, fingerprint in paths:
+                    self.db.stage_stacked_image(master, path, fingerprint)
+
+                with Timer(f"saving master fits for {key}", stage="save_fits", key=key):
+                    self.db.flush(key)
+            except Exception as e:
+                # the subs aren't marked processed, so they are retried on restart
+                logging.error(f"error building master {key}: {e}")
+                final = True
+            finally:
+                if final:
+                    self.db.release(self.masters.discard(key))
+
+    def _shard(self, key: Optional[str]) -> int:
+        return self._shard_of.get(str(key), 0)
+
+    def export_fits(self, key: str) -> Optional[bytes]:
+        """
+        The current stack for `key`, unsaved subs included, as a plain float32
+        FITS file, whatever format the storage folder keeps it in. The full
+        resolution stack of a live view stack is brought up to date first,
+        with the frames written to the live view stack so far.
+        """
+        if self.live.enabled and self.db.get_stacked_image(key + self.live.suffix) is not None:
+            self.build_full(key + self.live.suffix)
+
+        img = self.db.get_stacked_image(key)
+        if img is None:
+            return None
+
+        with Timer(f"exporting fits for {key}", stage="export", key=key):
+            return img.to_fits_bytes()
+
+    def build_full(self, key: str) -> Optional[Image]:
+        """
+        Brings the full resolution stack of the live view stack `key` up to
+        date, stacking the frames that went into the live view stack since it
+        was last built, at full resolution and calibrated with the full
+        masters, in the order they were stacked live. Returns the full
+        resolution stack.
+        """
+        full_key = self.live.full_key(key)
+        if full_key is None:
+            return None
+
+        with self._full_lock:
+            stacked = self.db.get_stacked_image(full_key)
+            done = stacked.live_subs if stacked is not None else 0
+            paths = self.db.contributors(key)[done:]
+            if not paths:
+                return stacked
+
+            method = self.integrations["LIGHT"]
+
+            with Timer(
+                f"stacking {len(paths)} frames at full resolution for {full_key}",
+                stage="full",
+                key=full_key,
+            ):
+                for path in paths:
+                    if self._stop:
+                        break
+
+                    done += 1
+                    try:
+                        img = Image.triage(path)
+                        self._choose_debayer(img)
+                        img.weight = self.db.weight_of(path) or 1.0
+                        img = self._calibrate_light(img)
+
+                        if stacked is not None:
+                            img = self._align_to(img, stacked)
+                        stacked = self._add(stacked, img, method)
+                    except Exception as e:
+                        logging.error(f"error stacking {path} at full resolution: {e}")
+
+            if stacked is None:
+                return None
+
+            stacked.live_subs = done
+            with Timer(
+                f"saving full resolution fits for {full_key}", stage="save_fits", key=full_key
+            ):
+                stacked.save(self.db.storage)
+            self.db.cache.put(full_key, stacked)
+
+        return stacked
+
+    def _build_full_pending(self, key: str):
+        with self._stats_lock:
+            self._full_pending.discard(key)
+
+        try:
+            self.build_full(key)
+        except Exception as e:
+            logging.error(f"error building the full resolution stack for {key}: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            elapsed = time.monotonic() - self._started
+            return {
+                "frames": self._frames,
+                "elapsed": elapsed,
+                "frames_per_minute": 60 * self._frames / elapsed if elapsed > 0 else 0.0,
+                "queued": self.queue.qsize()
+                + sum(q.qsize() for q in self._shards)
+                + sum(q.qsize() for q in self._calibrated),
+                "workers": self.workers,
+            }
 
     def stack_image(self, path: str):
+        # the startup scan and the watcher can both see the same new file, and
+        # a file can be reported more than once while it is written
+        with self._stats_lock:
+            if path in self._queued:
+                return
+            self._queued.add(path)
+
         self.queue.put(path)
 
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until every frame passed to `stack_image` has been stacked or
+        dropped, for at most `timeout` seconds. Returns whether it has.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._queued, timeout)
+
+    def _done(self, path: str):
+        with self._stats_lock:
+            self._queued.discard(path)
+            if not self._queued:
+                self._idle.notify_all()
+
+        with self._subs_collected:
+            if self._subs_in_flight.pop(path, None) is not None:
+                self._subs_collected.notify_all()
+
+    def _await_subs(self, key: str, seq: int):
+        """
+        Waits until the darks or flats of the master set `key` queued before
+        the frame numbered `seq` have been collected, or dropped. They are
+        ahead of it in their workers' queues, so they never wait on it.
+        """
+        def pending() -> bool:
+            return any(k == key and s < seq for k, s in self._subs_in_flight.values())
+
+        with self._subs_collected:
+            while pending() and not self._stop:
+                self._subs_collected.wait(timeout=1)
+
     def _process_item(self, path: str):
+        with Timer(f"processing file {path}", stage="process"):
+            try:
+                img = self._guard(path, self._triage, path)
+                if img is None:
+                    return
+
+                img = self._guard(path, self._profiled, "calibrate", img, self._calibrate, img)
+                if img is None:
+                    return
+
+                stacked = self._guard(
+                    path, self._profiled, "integrate", img, self._integrate, img, path
+                )
+            finally:
+                self._done(path)
+
+            if stacked is not None:
+                self._publish(stacked)
+
+    def _profiled(self, stage: str, img: Image, fn: Callable[..., Any], *args: Any) -> Any:
+        if img.profiled:
+            return self.profiler.run(stage, img.key, fn, *args)
+
+        return fn(*args)
+
+    def _guard(self, path: str, fn: Callable[..., Any], *args: Any) -> Any:
+        try:
+            return fn(*args)
+        except:
+            # always mark it as processed. if we error out, we don't want to
+            # keep erroring on the same file
+            if not self.db.is_already_processed(path):
+                self.db.mark_processed(path)
+            raise
+
+    def _triage(self, path: str) -> Optional[Image]:
+        """
+        Classifies a frame from its header alone, without reading any pixels.
+        Returns None for frames that are already processed or can't be used,
+        marking the latter as processed so they aren't looked at again.
+        """
         if self.db.is_already_processed(path):
             logging.info(f"skipping already processed file {path}")
-            return
+            return None
+
+        try:
+            img = Image.triage(path)
+        except OSError as e:
+            if self._retry_later(path, str(e)):
+                return None
+            raise
 
-        with Timer(f"processing file {path}"):
-            with fits.open(path) as fit:
-                img = Image(fit[0])
+        if img.missing and self._retry_later(path, f"{img.missing} bytes short"):
+            return None
+        self._tries.pop(path, None)
+
+        if img.missing:
+            img.rejected = f"{img.missing} bytes shorter than its header says"
 
-            # always mark it as processed. if we error out, we don't want to keep
-            # erroring on the same file
+        if not img.rejected and self.cameras and img.camera not in self.cameras:
+            img.rejected = f"camera {img.camera} is not one of {sorted(self.cameras)}"
+
+        if img.rejected:
+            logging.info(f"rejecting {path}: {img.rejected}")
+            metrics.inc("frames_rejected", reason="header")
             self.db.mark_processed(path)
+            return None
+
+        self._choose_debayer(img)
+        if img.image_type == "LIGHT" and self.live.enabled:
+            img.live = self.live.suffix
+
+        img.profiled = self.profiler.sample()
+        return img
+
+    def _retry_later(self, path: str, reason: str) -> bool:
+        """
+        Queues a frame that looks incomplete again in a while, unless it has
+        been tried too many times already. Returns whether it was.
+        """
+        tries = self._tries.get(path, 0)
+        if tries >= self.incomplete_tries:
+            self._tries.pop(path, None)
+            return False
+
+        logging.info(f"{path} looks incomplete ({reason}), trying again in {self.incomplete_wait}s")
+        self._tries[path] = tries + 1
+        self._retry_at[path] = time.monotonic() + self.incomplete_wait
+        return True
+
+    def _requeue_due(self):
+        now = time.monotonic()
+        for path, at in list(self._retry_at.items()):
+            if at <= now:
+                del self._retry_at[path]
+                self.queue.put(path)
+
+    def _choose_debayer(self, img: Image):
+        """
+        Picks the debayer mode of a colour light frame by matching the key it
+        has before any suffix is added. The mode goes into the key, as a
+        superpixel stack is half the size of a stack debayered any other way.
+        """
+        img.debayer_mode = None
+        if img.image_type == "LIGHT" and img.bayer_pattern:
+            img.debayer_mode = debayer.mode_for(str(img.key), self.debayer_mode, self.debayer_modes)
+
+    def _calibrate(self, img: Image) -> Optional[Image]:
+        """
+        First pipeline stage: load and calibrate a frame, and score lights.
+        Safe to run for one frame while the previous frame of the same key is
+        being aligned. Returns None for lights that fail the quality gate.
+        """
+        if img.image_type == "LIGHT":
+            img = self._calibrate_light(img)
+
+            if not self._judge(img):
+                return None
+
+        elif img.image_type == "FLAT":
+            dark = self._dark_for(img)
+
+            if dark is not None:
+                with Timer(f"subtracting dark for {img.dark_key}", stage="calibrate", key=img.key):
+                    img.data = calibrate(img.data, dark)
+
+        return img
+
+    def _calibrate_light(self, img: Image) -> Image:
+        if img.live:
+            with Timer(f"reducing image for {img.key}", stage="reduce", key=img.key):
+                img.data = self.live.reduce(img.data, bool(img.bayer_pattern))
+
+        dark = self._dark_for(img)
+        inverse_flat = self._inverse_flat_for(img)
 
-            if img.image_type == "LIGHT":
-                img = self._subtract_dark(img)
-                img = self._divide_flat(img)
+        if dark is not None or inverse_flat is not None:
+            with Timer(f"calibrating image for {img.key}", stage="calibrate", key=img.key):
+                img.data = calibrate(img.data, dark, inverse_flat)
 
-                if img.bayer_pattern:
-                    img = self._debayer(img)
+        if img.bayer_pattern:
+            img = self._debayer(img)
 
-                img = self._align(img)
-                stacked = self._stack(img)
+        return img
+
+    def _judge(self, img: Image) -> bool:
+        key, path = str(img.key), str(img.path)
+
+        img.quality = self.quality.measure(key, img.data)
+        rejected, img.weight = self.quality.judge(key, img.quality)
+        self.db.record_quality(path, key, img.quality, img.weight, rejected)
+
+        if rejected:
+            logging.info(f"rejecting {path}: {rejected}")
+            metrics.inc("frames_rejected", reason="quality")
+            self.db.mark_processed(path)
+            return False
+
+        return True
+
+    def _integrate(self, img: Image, path: str) -> Optional[Image]:
+        """
+        Second pipeline stage: align and add a calibrated frame to its stack.
+        Frames of a key must go through here one at a time, in order. Returns
+        the new stack if it needs a preview.
+        """
+        # a different key means the previous run is done, so write it out
+        self.flush(keep=img.key)
+
+        if img.image_type == "LIGHT":
+            img = self._align(img)
+            return self._stack(img, path)
+
+        elif img.image_type in ("DARK", "FLAT"):
+            if self.masters:
+                with self._masters_lock:
+                    if not self.db.hold(path):
+                        logging.info(f"{path} is already in master set {img.key}")
+                        return None
+                    count = self.masters.add(str(img.key), img, path)
+                logging.info(f"collected {count} subs for master {img.key}")
+            else:
+                self._stack(img, path)
+
+        return None
 
-                png_path = stacked.save_stretched_png(self.output_folder)
-                for q in self.output_queues.values():
-                    q.put(png_path)
+    def _publish(self, stacked: Image):
+        """
+        Last pipeline stage: render the preview for a stack and hand it to the
+        output queues. With tiles, the queues are told which tiles changed
+        instead of being handed the whole preview.
+        """
+        png_path = stacked.save_stretched_png(self.output_folder, self.preview)
+
+        if self.preview.tile_size:
+            tiles = self.preview.render_tiles(str(stacked.key), stacked.data, self.output_folder)
+            for q in list(self.output_queues.values()):
+                q.put_tiles(tiles)
+            return
+
+        for q in list(self.output_queues.values()):
+            q.put(png_path)
 
-            elif img.image_type == "DARK":
-                self._stack(img)
-            elif img.image_type == "FLAT":
-                img = self._subtract_dark(img)
-                self._stack(img)
+    def _dark_for(self, img: Image) -> Optional[np.ndarray]:
+        # subs queued before the frame go into the master it is calibrated with
+        self._await_subs(str(img.dark_key), img.seq)
+        if str(img.dark_key) in self._master_keys():
+            self._build_master(str(img.dark_key), final=False)
 
-    def _subtract_dark(self, img: Image) -> Image:
         dark = self.db.get_stacked_image(str(img.dark_key))
         if dark is None:
             logging.info(f"no dark found for {img.dark_key}")
-            return img
+            return None
 
-        assert dark.data.dtype == np.float32 and dark.data.min() >= 0.0 and dark.data.max() <= 1.0, f"{dark.data.dtype} {dark.data.max()} {dark.data.min()}"
-        assert img.data.dtype == np.float32 and img.data.min() >= 0.0 and img.data.max() <= 1.0, f"{img.data.dtype} {img.data.max()} {img.data.min()}"
-        assert dark.data.shape == img.data.shape, f"{dark.data.shape} {img.data.shape}"
+        assert dark.data.dtype == np.float32, f"{dark.data.dtype}"
 
-        with Timer(f"subtracting dark for {img.dark_key}"):
-            img.data = img.data - dark.data
-            img.data = np.clip(img.data, 0.0, 1.0)
+        if img.live:
+            # reduced once per master, like the frames that use it
+            return self.db.cache.derived(
+                str(img.dark_key),
+                f"live{img.live}",
+                dark,
+                lambda: self.live.reduce(dark.data, bool(img.bayer_pattern)),
+            )
 
-        return img
+        return dark.data
+
+    def _inverse_flat_for(self, img: Image) -> Optional[np.ndarray]:
+        self._await_subs(str(img.flat_key), img.seq)
+        if str(img.flat_key) in self._master_keys():
+            self._build_master(str(img.flat_key), final=False)
 
-    def _divide_flat(self, img: Image) -> Image:
         flat = self.db.get_stacked_image(str(img.flat_key))
         if flat is None:
             logging.info(f"no flat found for {img.flat_key}")
-            return img
+            return None
 
-        assert flat.data.dtype == np.float32 and flat.data.min() >= 0.0 and flat.data.max() <= 1.0, f"{flat.data.dtype} {flat.data.max()} {flat.data.min()}"
-        assert img.data.dtype == np.float32 and img.data.min() >= 0.0 and img.data.max() <= 1.0, f"{img.data.dtype} {img.data.max()} {img.data.min()}"
-        assert flat.data.shape == img.data.shape, f"{flat.data.shape} {img.data.shape}"
+        assert flat.data.dtype == np.float32, f"{flat.data.dtype}"
 
-        with Timer(f"dividing flat for {img.flat_key}"):
-            img.data = img.data / (flat.data / flat.data.mean())
-            img.data = np.clip(img.data, 0.0, 1.0)
+        if img.live:
+            return self.db.cache.derived(
+                str(img.flat_key),
+                f"inverse{img.live}",
+                flat,
+                lambda: inverse_normalized(self.live.reduce(flat.data, bool(img.bayer_pattern))),
+            )
 
-        return img
+        # worked out once per flat and kept until the flat changes
+        return self.db.cache.derived(
+            str(img.flat_key), "inverse", flat, lambda: inverse_normalized(flat.data)
+        )
 
     def _debayer(self, img: Image) -> Image:
-        assert img.data.dtype == np.float32 and img.data.min() >= 0.0 and img.data.max() <= 1.0, f"{img.data.dtype} {img.data.max()} {img.data.min()}"
+        assert img.data.dtype == np.float32, f"{img.data.dtype}"
 
         if not img.bayer_pattern:
             logging.warn(f"no bayer pattern detected for {img.key}")
             return img
 
-        with Timer(f"debayering image for {img.key} with pattern {img.bayer_pattern}"):
-            data = demosaicing_CFA_Bayer_bilinear(img.data, pattern=img.bayer_pattern)
+        mode = img.debayer_mode or debayer.mode_for(
+            str(img.key), self.debayer_mode, self.debayer_modes
+        )
 
-            # fix the image shape
-            img.data = np.array([data[:,:,0],data[:,:,1],data[:,:,2]])
-            img.data = np.interp(img.data, (0.0, img.data.max()), (0.0, 1.0)).astype(np.float32)
+        with Timer(
+            f"debayering image for {img.key} with pattern {img.bayer_pattern} ({mode})",
+            stage="debayer",
+            key=img.key,
+        ):
+            img.data = debayer.debayer(img.data, img.bayer_pattern, mode)
 
             # poor man's SCNR
             # img.data[1] *= 0.8
 
-        assert img.data.dtype == np.float32 and img.data.min() >= 0.0 and img.data.max() <= 1.0, f"{img.data.dtype} {img.data.max()} {img.data.min()}"
         return img
 
     def _align(self, img: Image) -> Image:
@@ -364,76 +1430,373 @@ class Stacker:
             logging.info(f"no reference found for {img.key}")
             return img
 
-        assert img.data.dtype == np.float32 and img.data.min() >= 0.0 and img.data.max() <= 1.0, f"{img.data.dtype} {img.data.max()} {img.data.min()}"
-        assert reference.data.dtype == np.float32 and reference.data.min() >= 0.0 and reference.data.max() <= 1.0, f"{reference.data.dtype} {reference.data.max()} {reference.data.min()}"
+        return self._align_to(img, reference)
+
+    def _align_to(self, img: Image, reference: Image) -> Image:
+        # calibration and stacking clip as they go, so only the cheap checks
+        # are left here
+        assert (
+            img.data.dtype == np.float32 and reference.data.dtype == np.float32
+        ), f"{img.data.dtype} {reference.data.dtype}"
         assert reference.data.ndim == img.data.ndim, f"{reference.data.ndim} {img.data.ndim}"
         assert reference.data.shape == img.data.shape, f"{reference.data.shape} {img.data.shape}"
 
-        with Timer(f"aligning image for {img.key}"):
-            if img.data.ndim == 2:
-                registered, footprint = aa.register(img.data, reference.data, fill_value=0.0)
-                img.data = registered
-            elif img.data.ndim == 3:
-                transform, _ = aa.find_transform(img.data[0], reference.data[0])
+        with Timer(f"aligning image for {img.key}", stage="align", key=img.key):
+            img.data, img.alignment = self.aligner.align(
+                str(img.key), img.data, reference.data, reference.subcount
+            )
 
-                for i in range(3):
-                    transformed, _ = aa.apply_transform(transform, img.data[i], reference.data[i], fill_value=0.0)
-                    img.data[i] = transformed
-            else:
-                raise Exception(f"invalid image dimensions {img.data.ndim}")
+        return img
 
-        assert img.data.dtype == np.float32 and img.data.min() >= 0.0 and img.data.max() <= 1.0, f"{img.data.dtype} {img.data.max()} {img.data.min()}"
+    def _stack(self, img: Image, path: str) -> Image:
+        stacked = self.db.get_stacked_image(str(img.key))
+        stacked = self._add(stacked, img, self.integrations[str(img.image_type)])
 
-        return img
+        if self.db.stage_stacked_image(stacked, path, img.fingerprint) >= self.flush_frames:
+            self._flush(str(stacked.key))
 
-    def _stack(self, img: Image) -> Image:
-        assert img.data.dtype == np.float32 and img.data.min() >= 0.0 and img.data.max() <= 1.0, f"{img.data.dtype} {img.data.max()} {img.data.min()}"
+        return stacked
 
-        stacked = self.db.get_stacked_image(str(img.key))
+    def _add(self, stacked: Optional[Image], img: Image, method: Any) -> Image:
+        """
+        Returns a new stack with `img` added to `stacked`, or a stack of just
+        `img` when there is none yet.
+        """
+        assert img.data.dtype == np.float32, f"{img.data.dtype}"
 
         if stacked is None:
             logging.info(f"no reference found for {img.key}")
             stacked = img
             stacked.subcount = 0
+            stacked.integration = method.name
+            stacked.state = method.start(img.data, img.weight)
         else:
-            assert stacked.data.dtype == np.float32 and stacked.data.min() >= 0.0 and stacked.data.max() <= 1.0, f"{stacked.data.dtype} {stacked.data.max()} {stacked.data.min()}"
+            assert stacked.data.dtype == np.float32, f"{stacked.data.dtype}"
             assert stacked.data.ndim == img.data.ndim, f"{stacked.data.ndim} {img.data.ndim}"
             assert stacked.data.shape == img.data.shape, f"{stacked.data.shape} {img.data.shape}"
 
-            with Timer(f"stacking image for {img.key}"):
+            stacked = self._resume(stacked, method)
+
+            with Timer(
+                f"stacking image for {img.key} with {method.name}", stage="stack", key=img.key
+            ):
                 if img.image_type == "LIGHT":
                     data = img.data
                 else:
-                    data = filters.gaussian(img.data)
+                    data = filters.gaussian(img.data).astype(np.float32, copy=False)
 
-                assert img.data.dtype == np.float32 and img.data.min() >= 0.0 and img.data.max() <= 1.0, f"{img.data.dtype} {img.data.max()} {img.data.min()}"
+                total = stacked.weight
 
-                count = stacked.subcount
+                stacked.data, stacked.state = method.add(
+                    stacked.data, total, stacked.state, data, img.weight
+                )
+                stacked.weight = total + img.weight
 
-                stacked.data = (count * stacked.data + data) / (count + 1)
+        assert stacked.data.dtype == np.float32, f"{stacked.data.dtype}"
 
-        assert stacked.data.dtype == np.float32 and stacked.data.min() >= 0.0 and stacked.data.max() <= 1.0, f"{stacked.data.dtype} {stacked.data.max()} {stacked.data.min()}"
+        # rounding can take a mean a hair past 1. the stack is a new array
+        # unless it is the first frame, which is ours too, so clip in place
+        np.clip(stacked.data, 0.0, 1.0, out=stacked.data)
 
         stacked.subcount += 1
 
-        with Timer(f"saving stacked fits for {stacked.key}"):
-            stacked.save_fits(self.storage_folder)
+        return stacked
+
+    def _stack_batch(self, batch: Batch) -> Image:
+        """
+        Adds the frames of a batch to their stack in a single reduction, with
+        one staging and at most one write for the lot.
+        """
+        key = batch.key
+        self.flush(keep=key)
+
+        method = self.integrations["LIGHT"]
+        items = batch.items
+
+        stacked = self.db.get_stacked_image(key)
+        if stacked is None:
+            # batches are only made for keys with a stack, but it can turn out
+            # to be unreadable. the frames were all aligned to it, so they
+            # still line up, and the first starts a new stack as it would alone
+            stacked = self._add(None, items[0][1], method)
+            items = items[1:]
+
+        frames = [img.data for _, img in items]
+        weights = [img.weight for _, img in items]
+        for data in frames:
+            assert data.dtype == np.float32, f"{data.dtype}"
+            assert stacked.data.shape == data.shape, f"{stacked.data.shape} {data.shape}"
+
+        if frames:
+            stacked = self._resume(stacked, method)
+
+            with Timer(
+                f"stacking {len(frames)} frames for {key} with {method.name}",
+                stage="stack",
+                key=key,
+            ):
+                total = stacked.weight
+
+                stacked.data, stacked.state = method.add_batch(
+                    stacked.data, total, stacked.state, frames, weights
+                )
+                stacked.weight = total + sum(weights)
+
+            np.clip(stacked.data, 0.0, 1.0, out=stacked.data)
+            stacked.subcount += len(frames)
+
+        count = 0
+        for path, img in batch.items:
+            count = self.db.stage_stacked_image(stacked, path, img.fingerprint)
+
+        if count >= self.flush_frames:
+            self._flush(key)
+
+        logging.info(f"caught up {len(batch.items)} frames for {key}")
+        return stacked
+
+    def _resume(self, stacked: Image, method: Any) -> Image:
+        # the cached stack is shared, so build the new one on a copy
+        stacked = copy.copy(stacked)
+
+        if stacked.integration != method.name:
+            # read from disk, or the mode was changed since it was written
+            state = self.db.load_state(str(stacked.key), method.name, stacked.flush_id)
+            stacked.integration = method.name
+            if state is None:
+                state = method.resume(stacked.data, stacked.weight)
+            stacked.state = state
 
         return stacked
 
-    def _worker(self):
+    def _dispatcher(self):
         while not self._stop:
+            self._requeue_due()
+
             try:
                 item = self.queue.get(timeout=1)
             except Empty:
                 continue
 
+            img = None
             try:
-                self._process_item(item)
+                # frames are triaged here, so the workers only see usable ones
+                img = self._guard(item, self._triage, item)
+                if img is not None:
+                    self._seq += 1
+                    img.seq = self._seq
+
+                    if self.masters and img.image_type in ("DARK", "FLAT"):
+                        with self._subs_collected:
+                            self._subs_in_flight[item] = (str(img.key), img.seq)
+
+                    self._shards[self._assign_shard(str(img.key))].put((item, img))
             except Exception as e:
-                logging.error(e)
-                raise
+                logging.error(f"error reading header of {item}: {e}")
             finally:
+                # a frame waiting to be tried again is still queued
+                if img is None and item not in self._retry_at:
+                    self._done(item)
                 self.queue.task_done()
 
-            logging.info(f"{self.queue.qsize()} items remaining")
+    def _assign_shard(self, key: str) -> int:
+        if key not in self._shard_of:
+            # new keys go to the least busy worker and stay there
+            self._shard_of[key] = min(
+                range(self.workers), key=lambda i: self._shards[i].qsize()
+            )
+
+        return self._shard_of[key]
+
+    def _put(self, q: Queue, item: Any):
+        while not self._stop:
+            try:
+                q.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    def _calibrator(self, shard: int):
+        inbox, outbox = self._shards[shard], self._calibrated[shard]
+        # the frame of another key that ended the last batch
+        carried: Optional[Tuple[str, Image]] = None
+
+        while not self._stop:
+            if carried is not None:
+                item, carried = carried, None
+            else:
+                try:
+                    item = inbox.get(timeout=1)
+                except Empty:
+                    continue
+
+            items, carried = self._gather(inbox, item)
+            if len(items) > 1:
+                self._calibrate_batch(inbox, outbox, items)
+                continue
+
+            path, img = item
+            calibrated = None
+            try:
+                calibrated = self._guard(
+                    path, self._profiled, "calibrate", img, self._calibrate, img
+                )
+                if calibrated is not None:
+                    self._put(outbox, (path, calibrated))
+            except Exception as e:
+                logging.error(f"error calibrating {path}: {e}")
+            finally:
+                if calibrated is None:
+                    self._done(path)
+                inbox.task_done()
+
+    def _gather(
+        self, inbox: Queue, item: Tuple[str, Image]
+    ) -> Tuple[List[Tuple[str, Image]], Optional[Tuple[str, Image]]]:
+        """
+        Takes the light frames of the same key queued right behind `item`, up
+        to `catchup_batch` in all, when they have a stack to be aligned to.
+        Returns them, and the frame of another key that ended the run, if one
+        was taken.
+        """
+        key = str(item[1].key)
+        items = [item]
+
+        if self.catchup_batch < 2 or item[1].image_type != "LIGHT" or inbox.empty():
+            return items, None
+        if self.db.get_stacked_image(key) is None:
+            # the first frame starts the stack, the others are batched after
+            return items, None
+
+        while len(items) < self.catchup_batch:
+            try:
+                other = inbox.get_nowait()
+            except Empty:
+                break
+
+            if str(other[1].key) != key:
+                return items, other
+
+            items.append(other)
+
+        return items, None
+
+    def _calibrate_batch(self, inbox: Queue, outbox: Queue, items: List[Tuple[str, Image]]):
+        key = str(items[0][1].key)
+        # every frame is aligned to the same stack, which is fine as the stack
+        # itself never moves
+        reference = self.db.get_stacked_image(key)
+        assert reference is not None, key
+
+        def work(item: Tuple[str, Image]) -> Tuple[str, Optional[Image]]:
+            path, img = item
+            try:
+                calibrated = self._guard(path, self._calibrate, img)
+                if calibrated is not None:
+                    calibrated = self._guard(path, self._align_to, calibrated, reference)
+                return path, calibrated
+            except Exception as e:
+                logging.error(f"error calibrating {path}: {e}")
+                return path, None
+
+        with Timer(
+            f"calibrating and aligning {len(items)} frames for {key}", stage="catchup", key=key
+        ):
+            results = list(self._pool.map(work, items))
+
+        batch = Batch(key, [(path, img) for path, img in results if img is not None])
+        for path, img in results:
+            if img is None:
+                self._done(path)
+
+        if batch.items:
+            self._put(outbox, batch)
+
+        for _ in items:
+            inbox.task_done()
+
+    def _integrator(self, shard: int):
+        inbox, outbox = self._calibrated[shard], self._previews[shard]
+
+        while not self._stop:
+            self._flush_expired(shard)
+
+            try:
+                item = inbox.get(timeout=1)
+            except Empty:
+                continue
+
+            if isinstance(item, Batch):
+                self._integrate_batch(item, outbox)
+                inbox.task_done()
+                continue
+
+            path, img = item
+            try:
+                stacked = self._guard(
+                    path, self._profiled, "integrate", img, self._integrate, img, path
+                )
+                if stacked is not None:
+                    outbox.put(stacked)
+            except Exception as e:
+                logging.error(f"error stacking {path}: {e}")
+            finally:
+                self._done(path)
+                inbox.task_done()
+
+            self._count_frames(1)
+
+    def _integrate_batch(self, batch: Batch, outbox: Queue):
+        try:
+            outbox.put(self._stack_batch(batch))
+        except Exception as e:
+            logging.error(f"error stacking {len(batch.items)} frames for {batch.key}: {e}")
+            # as _guard does for single frames
+            for path, _ in batch.items:
+                if not self.db.is_already_processed(path):
+                    self.db.mark_processed(path)
+        finally:
+            for path, _ in batch.items:
+                self._done(path)
+
+        self._count_frames(len(batch.items))
+
+    def _count_frames(self, n: int):
+        with self._stats_lock:
+            self._frames += n
+
+        metrics.inc("frames_processed", n)
+
+        stats = self.stats()
+        logging.info(
+            f"{stats['queued']} items remaining, "
+            f"{stats['frames_per_minute']:.1f} frames/min over {self.workers} workers"
+        )
+
+    def _previewer(self, shard: int):
+        inbox = self._previews[shard]
+
+        while not self._stop:
+            try:
+                items = [inbox.get(timeout=1)]
+            except Empty:
+                continue
+
+            # only the newest stack of each key is worth rendering, skip the
+            # ones that were replaced while the last preview was being drawn
+            while True:
+                try:
+                    items.append(inbox.get_nowait())
+                except Empty:
+                    break
+
+            latest = {str(stacked.key): stacked for stacked in items}
+
+            for stacked in latest.values():
+                try:
+                    self._publish(stacked)
+                except Exception as e:
+                    logging.error(f"error rendering preview for {stacked.key}: {e}")
+
+            for _ in items:
+                inbox.task_done()
@@ -0,0 +1,266 @@
+import os
+from os.path import isfile, join
+import re
+import time
+from typing import Callable, List, Optional, TypeVar, Union
+import warnings
+
+from astropy.io import fits
+from astropy.io.fits import CompImageHDU, Header, HDUList, PrimaryHDU
+import numpy as np
+
+
+T = TypeVar("T")
+
+# turns the pixels and header of a stack into whatever the caller wants, while
+# the file is still open
+Decoder = Callable[[np.ndarray, Header], T]
+
+
+class Fits:
+    """
+    Plain, uncompressed float32 FITS, that any astro software can open.
+    """
+
+    name = "fits"
+
+    def path(self, folder: str, key: str) -> str:
+        return join(folder, f"{key}.fits")
+
+    def exists(self, folder: str, key: str) -> bool:
+        return isfile(self.path(folder, key))
+
+    def write(self, folder: str, key: str, data: np.ndarray, header: Header) -> str:
+        path = self.path(folder, key)
+
+        # write next to the old stack and swap it in, so a crash never leaves a
+        # partially written stack behind
+        HDUList([PrimaryHDU(data=data, header=header)]).writeto(f"{path}.tmp", overwrite=True)
+        os.replace(f"{path}.tmp", path)
+
+        return path
+
+    def read(self, folder: str, key: str, decode: Decoder) -> T:
+        # memory mapped, so the float32 copy made by decode is the only read
+        with fits.open(self.path(folder, key), memmap=True, do_not_scale_image_data=True) as f:
+            return decode(f[0].data, f[0].header)
+
+    def header(self, folder: str, key: str) -> Header:
+        return fits.getheader(self.path(folder, key))
+
+    def files(self, folder: str, key: str) -> List[str]:
+        return [self.path(folder, key)]
+
+
+class CompressedFits(Fits):
+    """
+    Tile compressed FITS, as written by fpack. With `quantize`, the pixels are
+    quantized to 1/`quantize` of the noise of each tile, with subtractive
+    dithering so no bias creeps in, which is lossy but typically shrinks a stack
+    to about a fifth. Without, GZIP_2 compresses the float32 pixels losslessly,
+    which only saves about a quarter.
+    """
+
+    def __init__(self, name: str, compression: str, quantize: float = 0.0):
+        self.name = name
+        self.compression = compression
+        self.quantize = quantize
+
+    def path(self, folder: str, key: str) -> str:
+        return join(folder, f"{key}.fits.fz")
+
+    def write(self, folder: str, key: str, data: np.ndarray, header: Header) -> str:
+        path = self.path(folder, key)
+
+        hdu = CompImageHDU(
+            data=data,
+            header=header,
+            compression_type=self.compression,
+            quantize_level=self.quantize,
+        )
+        with warnings.catch_warnings():
+            # astropy warns that quantizing floats is lossy, which is the point
+            warnings.simplefilter("ignore")
+            HDUList([PrimaryHDU(), hdu]).writeto(f"{path}.tmp", overwrite=True)
+        os.replace(f"{path}.tmp", path)
+
+        return path
+
+    def read(self, folder: str, key: str, decode: Decoder) -> T:
+        with fits.open(self.path(folder, key)) as f:
+            data = f[1].data
+            if self.quantize and data.dtype.kind == "f":
+                # the dithering puts pixels at the ends of [0, 1], like
+                # saturated stars, a fraction of the noise outside of it
+                np.clip(data, 0.0, 1.0, out=data)
+
+            return decode(data, f[1].header)
+
+    def header(self, folder: str, key: str) -> Header:
+        return fits.getheader(self.path(folder, key), 1)
+
+
+class Npy:
+    """
+    The raw pixels in a .npy file, memory mapped on read with no decoding at
+    all, and the header in a small FITS header text file next to it. With
+    `dtype` float16, half the size of a float32 stack, accurate to about 1 part
+    in 2000.
+
+    The pixels go in a file named after the FLUSHID of the header, and the
+    header, written last, names its pixel file, so swapping the header in
+    commits both at once.
+    """
+
+    def __init__(self, name: str, dtype: type = np.float32):
+        self.name = name
+        self.dtype = dtype
+
+    def path(self, folder: str, key: str) -> str:
+        return join(folder, f"{key}.hdr")
+
+    def exists(self, folder: str, key: str) -> bool:
+        return isfile(self.path(folder, key))
+
+    def write(self, folder: str, key: str, data: np.ndarray, header: Header) -> str:
+        path = self.path(folder, key)
+        header = header.copy()
+        name = f"{key}.{header.get('FLUSHID') or 'stack'}.npy"
+        header.set("DATAFILE", name)
+
+        np.save(join(folder, f"{name}.tmp.npy"), data.astype(self.dtype, copy=False))
+        os.replace(join(folder, f"{name}.tmp.npy"), join(folder, name))
+
+        header.totextfile(f"{path}.tmp", overwrite=True)
+        os.replace(f"{path}.tmp", path)
+
+        # pixels of the stacks this one replaces
+        for other in self._pixels(folder, key):
+            if other != name:
+                os.remove(join(folder, other))
+
+        return path
+
+    def read(self, folder: str, key: str, decode: Decoder) -> T:
+        header = self.header(folder, key)
+        while True:
+            try:
+                pixels = np.load(join(folder, header["DATAFILE"]), mmap_mode="r")
+                break
+            except FileNotFoundError:
+                # a write swapped in a new header and removed the pixels the
+                # old one named, read the new one instead
+                latest = self.header(folder, key)
+                if latest.get("DATAFILE") == header["DATAFILE"]:
+                    raise
+                header = latest
+
+        # the header of the pixels as they are in memory, float32 either way
+        header.set("BITPIX", -32)
+
+        return decode(pixels, header)
+
+    def header(self, folder: str, key: str) -> Header:
+        return Header.fromtextfile(self.path(folder, key))
+
+    def files(self, folder: str, key: str) -> List[str]:
+        return [self.path(folder, key)] + [join(folder, p) for p in self._pixels(folder, key)]
+
+    def _pixels(self, folder: str, key: str) -> List[str]:
+        # matched exactly, as keys can be prefixes of other keys, like a
+        # CCD-TEMP of -10 and one of -10.5
+        pattern = re.compile(re.escape(key) + r"\.([0-9a-f]{32}|stack)\.npy")
+        return [p for p in os.listdir(folder) if pattern.fullmatch(p)]
+
+
+Format = Union[Fits, CompressedFits, Npy]
+
+FORMATS = ("fits", "rice", "gzip", "npy", "float16")
+
+
+def create(name: str, quantize: float = 16.0) -> Format:
+    if name == "fits":
+        return Fits()
+    elif name == "rice":
+        return CompressedFits(name, "RICE_1", quantize)
+    elif name == "gzip":
+        return CompressedFits(name, "GZIP_2", 0.0)
+    elif name == "npy":
+        return Npy(name)
+    elif name == "float16":
+        return Npy(name, np.float16)
+
+    raise Exception(f"unknown storage format {name}")
+
+
+class Storage:
+    """
+    Where the DB keeps stacks and masters. They are written in `format`, and
+    read from whichever format they are found in, so changing the format
+    doesn't lose existing stacks: each is converted the next time it is
+    written.
+    """
+
+    def __init__(self, folder: str, format: str = "fits", quantize: float = 16.0):
+        self.folder = folder
+        self.format = create(format, quantize)
+        # the format for writing first, for reading
+        self.formats = [self.format] + [create(f) for f in FORMATS if f != format]
+
+    def find(self, key: str) -> Optional[Format]:
+        for f in self.formats:
+            if f.exists(self.folder, key):
+                return f
+
+        return None
+
+    def exists(self, key: str) -> bool:
+        return self.find(key) is not None
+
+    def write(self, key: str, data: np.ndarray, header: Header) -> str:
+        path = self.format.write(self.folder, key, data, header)
+
+        for f in self.formats[1:]:
+            if f.path(self.folder, key) == path:
+                continue
+            for old in f.files(self.folder, key):
+                if isfile(old):
+                    os.remove(old)
+
+        return path
+
+    def read(self, key: str, decode: Decoder) -> T:
+        f = self.find(key)
+        if f is None:
+            raise FileNotFoundError(f"no stack for {key} in {self.folder}")
+
+        return f.read(self.folder, key, decode)
+
+    def header(self, key: str) -> Header:
+        f = self.find(key)
+        if f is None:
+            raise FileNotFoundError(f"no stack for {key} in {self.folder}")
+
+        return f.header(self.folder, key)
+
+    def quarantine(self, key: str) -> List[str]:
+        """
+        Moves the files of the stack for `key` aside, so a new one can be
+        started without overwriting it. Returns where they were moved to.
+        """
+        f = self.find(key)
+        if f is None:
+            return []
+
+        moved = []
+        suffix = time.strftime("%Y%m%d%H%M%S")
+        for path in f.files(self.folder, key):
+            if isfile(path):
+                os.replace(path, f"{path}.unreadable-{suffix}")
+                moved.append(f"{path}.unreadable-{suffix}")
+
+        return moved
+
+    def size(self, key: str) -> int:
+        f = self.find(key)
+        return sum(os.path.getsize(p) for p in f.files(self.folder, key) if isfile(p)) if f else 0
@@ -1,14 +1,21 @@
 import logging
 import signal
 import time
+from typing import Optional
+
+from .metrics import metrics
 
 
 class Timer:
-    def __init__(self, msg=""):
+    def __init__(self, msg="", stage: Optional[str] = None, key: Optional[str] = None):
         self.msg = msg
+        # with a stage, the time is also recorded in the stage's histogram
+        self.stage = stage
+        self.key = key
 
     def __enter__(self):
         self.start = time.time()
+        self._start = time.perf_counter()
 
         logging.info(f"start {self.msg}")
 
@@ -16,9 +23,12 @@ class Timer:
 
     def __exit__(self, *args):
         self.end = time.time()
-        self.elapsed_in_milli = (self.end - self.start) * 1000
+        self.elapsed_in_milli = (time.perf_counter() - self._start) * 1000
         self.elapsed_in_milli_as_str = "%0.3f" % self.elapsed_in_milli
 
+        if self.stage:
+            metrics.observe(self.stage, self.key, self.elapsed_in_milli)
+
         logging.info(f"done {self.msg} in {self.elapsed_in_milli_as_str}ms")
 
 
@@ -1,46 +1,216 @@
 import logging
-from pathlib import Path
+import os
+from threading import Event, Lock, Thread
 import time
-from typing import Union, Callable
+from typing import Callable, Dict, Optional, Protocol, Set, Tuple
 
-from watchdog.observers.polling import PollingObserver as Observer
-from watchdog.events import FileSystemEventHandler, FileCreatedEvent, DirCreatedEvent
+from watchdog.observers import Observer as NativeObserver
+from watchdog.observers.api import BaseObserver
+from watchdog.observers.polling import PollingObserver
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
 
+from .utils import Timer
 
-class Handler(FileSystemEventHandler):
-    def __init__(self, callback: Callable[[str], None]):
+
+class PendingFiles:
+    """
+    Files that have appeared but may still be being written. They are all
+    checked every `interval` seconds, and each is handed to the callback once
+    its size and modification time have held still for `settle` seconds.
+    watchdog 1.0.1 doesn't report files being closed, so settling is the only
+    sign a file is complete.
+    """
+
+    def __init__(self, callback: Callable[[str], None], interval: float = 0.2, settle: float = 0.5):
         self.callback = callback
+        self.interval = interval
+        self.settle = settle
+        self._files: Dict[str, Tuple[int, int, float]] = {}
+        self._lock = Lock()
+        self._stop = Event()
+        self.thread = Thread(target=self._worker, name="pending-files")
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
+
+    def add(self, path: str):
+        with self._lock:
+            # a file being written is reported many times, the checks see it
+            # change anyway
+            self._files.setdefault(path, (-1, -1, time.monotonic()))
+
+    def _worker(self):
+        while not self._stop.wait(self.interval):
+            for path in self._check():
+                logging.info(f"new file: {path}")
+                self.callback(path)
+
+    def _check(self):
+        ready = []
+        now = time.monotonic()
+
+        with self._lock:
+            for path, (size, mtime, changed) in list(self._files.items()):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # moved or deleted before it was finished
+                    del self._files[path]
+                    continue
+
+                if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                    self._files[path] = (st.st_size, st.st_mtime_ns, now)
+                elif now - changed >= self.settle:
+                    del self._files[path]
+                    ready.append(path)
+
+        return ready
+
+
+class Handler(FileSystemEventHandler):
+    def __init__(self, pending: PendingFiles):
+        self.pending = pending
+
+    def on_created(self, event: FileSystemEvent):
+        self._seen(event, event.src_path)
+
+    def on_modified(self, event: FileSystemEvent):
+        self._seen(event, event.src_path)
+
+    def on_moved(self, event: FileSystemEvent):
+        self._seen(event, event.dest_path)
 
-    def on_created(self, event: Union[FileCreatedEvent, DirCreatedEvent]):
+    def _seen(self, event: FileSystemEvent, path: str):
         if event.is_directory:
             return
 
-        if not event.src_path.endswith(".fits"):
+        if not path.endswith(".fits"):
             return
 
-        logging.info(f"file created: {event.src_path}")
+        logging.debug(f"file changed: {path}")
 
-        time.sleep(10)  # give the file time to be written
+        self.pending.add(path)
 
-        self.callback(event.src_path)
+
+class Index(Protocol):
+    def processed_in(self, dir: str) -> Set[str]:
+        ...
+
+    def get_watermark(self, dir: str) -> Optional[int]:
+        ...
+
+    def set_watermark(self, dir: str, mtime: int):
+        ...
 
 
 class Watcher:
-    def __init__(self, callback: Callable[[str], None]):
-        self.observer = Observer()
+    def __init__(
+        self,
+        callback: Callable[[str], None],
+        polling: bool = False,
+        index: Optional[Index] = None,
+        settle: float = 0.5,
+    ):
         self.callback = callback
+        # how long a new file has to stay the same size before it is handed
+        # on, longer for slow network shares or USB drives
+        self.pending = PendingFiles(callback, settle=settle)
+        # lets the startup scan skip files that were already processed
+        self.index = index
+        self.scanner: Optional[Thread] = None
+        self._stop = Event()
+
+        self.observer: BaseObserver
+        if polling:
+            self.observer = PollingObserver()
+        else:
+            self.observer = NativeObserver()
 
     def run(self, dir: str):
-        event_handler = Handler(self.callback)
-        self.observer.schedule(event_handler, dir, recursive=True)
-        self.observer.start()
+        event_handler = Handler(self.pending)
+
+        try:
+            self.observer.schedule(event_handler, dir, recursive=True)
+            self.observer.start()
+        except OSError as e:
+            # inotify can fail on network mounts or when out of watches
+            logging.warning(f"unable to watch {dir} natively, falling back to polling: {e}")
+            self.observer = PollingObserver()
+            self.observer.schedule(event_handler, dir, recursive=True)
+            self.observer.start()
 
-        files = list(Path(dir).rglob("*.fits"))
-        files.sort()
+        self.pending.start()
 
-        for f in files:
-            self.callback(str(f))
+        # scan in the background, so processing starts with the first new file
+        self.scanner = Thread(target=self._scan, args=(dir,), name="scanner")
+        self.scanner.start()
 
     def stop(self):
+        self._stop.set()
+        if self.scanner:
+            self.scanner.join()
+
         self.observer.stop()
         self.observer.join()
+        self.pending.stop()
+
+    def _scan(self, dir: str):
+        with Timer(f"scanning {dir}", stage="scan"):
+            self._scan_dir(dir)
+
+    def _scan_dir(self, dir: str):
+        """
+        Queues the new files under `dir` in path order. A directory whose mtime
+        hasn't moved since all its files were last found processed can't have
+        gained any files, so its files are skipped without a lookup. Otherwise
+        its processed files are fetched from the index in one query. Files
+        only staged in a stack that hasn't been written yet aren't processed
+        as far as the index goes, so they are queued again, for the stacker
+        to skip, and keep the directory from being watermarked until they
+        are written.
+        """
+        try:
+            st = os.stat(dir)
+            entries = sorted(os.scandir(dir), key=lambda e: e.name)
+        except OSError as e:
+            logging.warning(f"unable to scan {dir}: {e}")
+            return
+
+        watermark = self.index.get_watermark(dir) if self.index else None
+        unchanged = watermark is not None and st.st_mtime_ns <= watermark
+        processed: Optional[Set[str]] = None
+        new = 0
+
+        for entry in entries:
+            if self._stop.is_set():
+                return
+
+            if entry.is_dir():
+                self._scan_dir(entry.path)
+                continue
+
+            if unchanged or not entry.name.endswith(".fits"):
+                continue
+
+            if processed is None:
+                processed = self.index.processed_in(dir) if self.index else set()
+
+            if entry.path in processed:
+                continue
+
+            new += 1
+
+            if time.time() - entry.stat().st_mtime < self.pending.settle:
+                # may still be being written
+                self.pending.add(entry.path)
+            else:
+                self.callback(entry.path)
+
+        # a file added in the same filesystem timestamp tick as the last change
+        # wouldn't move the mtime, so only trust directories that have settled
+        if self.index and not unchanged and new == 0 and time.time() - st.st_mtime > 2:
+            self.index.set_watermark(dir, st.st_mtime_ns)
@@ -1,18 +1,13 @@
-import base64
-import functools
-import json
 import logging
-import logging.handlers
 import os
-import sys
-import time
-from queue import SimpleQueue as Queue, Empty
-from typing import List
 
 import asyncio
 import websockets
-import png
 
+from livestack.broadcast import Broadcaster, BroadcastHandler
+from livestack.live import parse_roi
+from livestack.metrics import metrics
+from livestack.quality import QualityGate
 from livestack.watcher import Watcher
 from livestack.stacking_service import Stacker
 from livestack.utils import GracefulSignalHandler
@@ -20,67 +15,15 @@ from livestack.utils import GracefulSignalHandler
 logging.basicConfig(level=logging.INFO)
 
 
-class LocalQueueHandler(logging.handlers.QueueHandler):
-    def emit(self, record: logging.LogRecord) -> None:
-        # Removed the call to self.prepare(), handle task cancellation
-        try:
-            self.enqueue(record)
-        except asyncio.CancelledError:
-            raise
-        except Exception:
-            self.handleError(record)
-
-
-async def server(ws: websockets.WebSocketServerProtocol, path, stacker: Stacker = None):
-    queue: Queue = Queue()
-    logging.getLogger().addHandler(LocalQueueHandler(queue))
-
-    output_queue: Queue = Queue()
-    if stacker:
-        queue_id = stacker.add_output_queue(output_queue)
-
-    while not ws.closed:
-        try:
-            f = output_queue.get(block=False)
-
-            with open(f, "br") as img:
-                encoded = base64.b64encode(img.read())
-
-            await ws.send(
-                json.dumps(
-                    {
-                        "type": "livestack_image",
-                        "payload": "data:image/png;base64," + encoded.decode("ascii"),
-                    }
-                )
-            )
-        except Empty:
-            pass
-
-        try:
-            record = queue.get(block=False)
-
-            await ws.send(
-                json.dumps(
-                    {
-                        "type": "livestack_log",
-                        "payload": record.getMessage(),
-                    }
-                )
-            )
-        except Empty:
-            await asyncio.sleep(0.5)
-
-    await ws.wait_closed()
-
-    if stacker:
-        stacker.remove_output_queue(queue_id)
-
-
 async def stacker(s: Stacker):
     s.start()
 
-    w = Watcher(s.stack_image)
+    w = Watcher(
+        s.stack_image,
+        polling=os.environ.get("WATCHER_POLLING", "0") == "1",
+        index=s.db,
+        settle=float(os.environ.get("WATCHER_SETTLE", "0.5")),
+    )
     w.run(os.environ["INPUT_FOLDER"])
 
     with GracefulSignalHandler() as h:
@@ -97,15 +40,66 @@ async def stacker(s: Stacker):
     loop.stop()
 
 
+async def publish_metrics(broadcaster: Broadcaster, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        broadcaster.put_message("livestack_metrics", metrics.snapshot())
+
+
 if __name__ == "__main__":
     s = Stacker(
         os.environ["STORAGE_FOLDER"],
         os.environ["OUTPUT_FOLDER"],
+        cache_size=int(os.environ.get("CACHE_SIZE_MB", "1024")) * 1024 * 1024,
+        storage_format=os.environ.get("STORAGE_FORMAT", "fits"),
+        storage_quantize=float(os.environ.get("STORAGE_QUANTIZE", "16")),
+        flush_frames=int(os.environ.get("FLUSH_FRAMES", "10")),
+        flush_interval=float(os.environ.get("FLUSH_INTERVAL", "60")),
+        workers=int(os.environ.get("WORKERS", "1")),
+        align_mode=os.environ.get("ALIGN_MODE", "auto"),
+        align_channel=os.environ.get("ALIGN_CHANNEL", "luminance"),
+        preview_size=int(os.environ.get("PREVIEW_SIZE", "2048")),
+        tile_size=int(os.environ.get("PREVIEW_TILE_SIZE", "0")),
+        tile_format=os.environ.get("PREVIEW_TILE_FORMAT", "png"),
+        profile_every=int(os.environ.get("PROFILE_EVERY", "0")),
+        catchup_batch=int(os.environ.get("CATCHUP_BATCH", "8")),
+        live_bin=int(os.environ.get("LIVE_BIN", "1")),
+        live_roi=parse_roi(os.environ.get("LIVE_ROI", "")),
+        live_full=os.environ.get("LIVE_FULL", "background"),
+        cameras=[c for c in os.environ.get("CAMERAS", "").split(",") if c],
+        quality=QualityGate(
+            max_fwhm=float(os.environ.get("QUALITY_MAX_FWHM", "0")),
+            max_eccentricity=float(os.environ.get("QUALITY_MAX_ECCENTRICITY", "0")),
+            min_stars=int(os.environ.get("QUALITY_MIN_STARS", "0")),
+            min_star_ratio=float(os.environ.get("QUALITY_MIN_STAR_RATIO", "0")),
+            weighting=os.environ.get("QUALITY_WEIGHTING", "0") == "1",
+        ),
+        integrations={
+            "LIGHT": os.environ.get("INTEGRATION_LIGHT", "mean"),
+            "DARK": os.environ.get("INTEGRATION_DARK", "mean"),
+            "FLAT": os.environ.get("INTEGRATION_FLAT", "mean"),
+        },
+        kappa=float(os.environ.get("INTEGRATION_KAPPA", "3")),
+        median_window=int(os.environ.get("INTEGRATION_WINDOW", "5")),
+        master_method=os.environ.get("MASTER_METHOD", "median"),
+        master_idle=float(os.environ.get("MASTER_IDLE", "600")),
+        debayer_mode=os.environ.get("DEBAYER_MODE", "bilinear32"),
+        debayer_modes=dict(
+            m.rsplit("=", 1) for m in os.environ.get("DEBAYER_MODES", "").split(",") if m
+        ),
     )
 
-    bound_handler = functools.partial(server, stacker=s)
-    start_server = websockets.serve(bound_handler, "0.0.0.0", 5678)
+    broadcaster = Broadcaster(asyncio.get_event_loop(), exporter=s.export_fits)
+    s.add_output_queue(broadcaster)
+    logging.getLogger().addHandler(BroadcastHandler(broadcaster))
+
+    start_server = websockets.serve(
+        broadcaster.serve, "0.0.0.0", 5678, process_request=broadcaster.process_request
+    )
     asyncio.get_event_loop().run_until_complete(start_server)
 
     asyncio.ensure_future(stacker(s))
+    asyncio.ensure_future(
+        publish_metrics(broadcaster, float(os.environ.get("METRICS_INTERVAL", "10")))
+    )
     asyncio.get_event_loop().run_forever()
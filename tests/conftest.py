@@ -0,0 +1,102 @@
+from astropy.io import fits
+from astropy.io.fits import Header
+import numpy as np
+import pytest
+
+from livestack.stacking_service import Image
+
+
+def light_header() -> Header:
+    hdr = Header()
+    hdr.set("IMAGETYP", "Light Frame")
+    hdr.set("INSTRUME", "CAM")
+    hdr.set("OBJECT", "M42")
+    hdr.set("EXPTIME", 60.0)
+    hdr.set("CCD-TEMP", -10.0)
+    return hdr
+
+
+@pytest.fixture
+def light():
+    """
+    Makes an 8x8 light frame of a single value, as if read from a file.
+    """
+
+    def make(value: float = 0.5) -> Image:
+        hdr = light_header()
+        hdr.set("BITPIX", -32)
+        return Image.from_pixels(np.full((8, 8), value, dtype=np.float32), hdr)
+
+    return make
+
+
+@pytest.fixture
+def frames(tmp_path):
+    """
+    Makes `n` empty files to stand in for the frames that went into a stack.
+    """
+
+    def make(n: int):
+        paths = []
+        for i in range(n):
+            path = tmp_path / f"light{i}.fits"
+            path.write_bytes(b"")
+            paths.append(str(path))
+        return paths
+
+    return make
+
+
+@pytest.fixture
+def light_file():
+    """
+    Writes a 16 bit light frame, or another `image_type`, to `path` and
+    returns its bytes.
+    """
+
+    def write(path, rows: int = 64, image_type: str = "Light Frame") -> bytes:
+        hdr = light_header()
+        hdr.set("IMAGETYP", image_type)
+        fits.PrimaryHDU(np.zeros((rows, 64), dtype=np.uint16), hdr).writeto(str(path))
+        return path.read_bytes()
+
+    return write
+
+
+@pytest.fixture
+def star_field():
+    """
+    Makes a frame of `n` gaussian stars on a noisy sky, the same stars for a
+    `seed`, moved by (`dy`, `dx`) and turned by `angle` degrees about the
+    centre. Frames of the same stars need a different `noise` seed to tell
+    them apart.
+    """
+
+    def make(
+        shape=(256, 256),
+        n: int = 60,
+        sigma: float = 1.5,
+        seed: int = 0,
+        noise: int = 0,
+        dy: float = 0.0,
+        dx: float = 0.0,
+        angle: float = 0.0,
+    ) -> np.ndarray:
+        rng = np.random.default_rng(seed)
+        h, w = shape
+        y = rng.uniform(16, h - 16, n) - h / 2
+        x = rng.uniform(16, w - 16, n) - w / 2
+        flux = rng.uniform(0.2, 0.6, n)
+
+        a = np.radians(angle)
+        y, x = y * np.cos(a) + x * np.sin(a), x * np.cos(a) - y * np.sin(a)
+        y, x = y + h / 2 + dy, x + w / 2 + dx
+
+        yy, xx = np.mgrid[0:h, 0:w]
+        data = np.random.default_rng(noise).normal(0.1, 0.002, shape)
+        for sy, sx, f in zip(y, x, flux):
+            data += f * np.exp(-((yy - sy) ** 2 + (xx - sx) ** 2) / (2 * sigma * sigma))
+
+        return np.clip(data, 0.0, 1.0).astype(np.float32)
+
+    return make
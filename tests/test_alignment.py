@@ -0,0 +1,44 @@
+import numpy as np
+
+from livestack.alignment import Aligner, phase_correlate
+
+
+def test_phase_correlate_finds_the_shift(star_field):
+    reference = star_field()
+    moving = star_field(noise=1, dy=-7, dx=12)
+
+    dy, dx, strength = phase_correlate(reference, moving)
+
+    assert abs(dy - 7) < 0.5 and abs(dx + 12) < 0.5
+    assert strength > 10
+
+    # plain cross correlation places the peak more precisely
+    dy, dx, _ = phase_correlate(reference, moving, whiten=False)
+
+    assert abs(dy - 7) < 0.2 and abs(dx + 12) < 0.2
+
+
+def test_shifted_frame_aligned_by_phase_correlation(tmp_path, star_field):
+    reference = star_field(shape=(512, 512), n=150)
+    moving = star_field(shape=(512, 512), n=150, noise=1, dy=5.4, dx=-9.3)
+
+    registered, metrics = Aligner(str(tmp_path)).align("k", moving, reference, 1)
+
+    assert metrics["method"] == "phase"
+    assert abs(metrics["dy"] + 5.4) < 0.1 and abs(metrics["dx"] - 9.3) < 0.1
+    # left with the difference in noise, and a little lost to interpolation
+    inner = (slice(32, -32), slice(32, -32))
+    assert np.abs(registered[inner] - reference[inner]).mean() < 0.003
+
+
+def test_rotated_frame_falls_back_to_astroalign(tmp_path, star_field):
+    reference = star_field(shape=(512, 512), n=150)
+    moving = star_field(shape=(512, 512), n=150, noise=1, angle=3.0)
+
+    registered, metrics = Aligner(str(tmp_path)).align("k", moving, reference, 1)
+
+    assert metrics["method"] == "astroalign"
+    assert abs(abs(metrics["rotation"]) - np.radians(3.0)) < 0.005
+    assert metrics["residual"] < 0.5
+    inner = (slice(64, -64), slice(64, -64))
+    assert np.abs(registered[inner] - reference[inner]).mean() < 0.003
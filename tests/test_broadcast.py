@@ -0,0 +1,102 @@
+import asyncio
+from http import HTTPStatus
+from threading import Thread
+
+import simplejson as json
+
+from livestack.broadcast import Broadcaster, Client
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed = asyncio.Event()
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    async def wait_closed(self):
+        await self.closed.wait()
+
+
+def run(loop, coro):
+    return loop.run_until_complete(coro)
+
+
+def test_slow_client_keeps_the_newest_preview():
+    loop = asyncio.new_event_loop()
+    b = Broadcaster(loop, max_messages=2)
+    client = Client(2)
+    b.clients.add(client)
+
+    b.publish(b"first")
+    b.publish(b"second")
+    for i in range(3):
+        b.publish(f"line {i}")
+
+    assert client.image == b"second"
+    assert list(client.messages) == ["line 1", "line 2"]
+    assert client.ready.is_set()
+    loop.close()
+
+
+def test_previews_and_messages_from_other_threads(tmp_path):
+    loop = asyncio.new_event_loop()
+    b = Broadcaster(loop)
+    client = Client(10)
+    b.clients.add(client)
+    png = tmp_path / "k.png"
+    png.write_bytes(b"png")
+
+    thread = Thread(target=lambda: (b.put(str(png)), b.put_message("t", {"x": float("nan")})))
+    thread.start()
+    thread.join()
+    # the loop runs what the thread handed it
+    run(loop, asyncio.sleep(0))
+
+    assert client.image == b"png"
+    assert json.loads(client.messages[0]) == {"type": "t", "payload": {"x": None}}
+    loop.close()
+
+
+def test_serve_sends_until_closed():
+    loop = asyncio.new_event_loop()
+    b = Broadcaster(loop)
+    ws = FakeSocket()
+
+    async def session():
+        serving = asyncio.ensure_future(b.serve(ws, "/"))
+        await asyncio.sleep(0)
+        assert len(b.clients) == 1
+
+        b.publish("hello")
+        b.publish(b"png")
+        await asyncio.sleep(0.01)
+        ws.closed.set()
+        await serving
+
+    run(loop, session())
+
+    assert ws.sent == ["hello", b"png"]
+    assert not b.clients
+    loop.close()
+
+
+def test_http_requests():
+    loop = asyncio.new_event_loop()
+    b = Broadcaster(loop, exporter=lambda key: b"SIMPLE" if key == "M42 L" else None)
+
+    status, headers, body = run(loop, b.process_request("/metrics", {}))
+    assert status == HTTPStatus.OK
+    assert b"# TYPE livestack_stage_duration_ms histogram" in body
+
+    status, headers, body = run(loop, b.process_request("/stacks/M42%20L.fits?x=1", {}))
+    assert status == HTTPStatus.OK and body == b"SIMPLE"
+    assert ("Content-Type", "application/fits") in headers
+
+    for path in ("/stacks/M31.fits", "/stacks/..%2Fdb.fits", "/stacks/.hidden.fits"):
+        assert run(loop, b.process_request(path, {}))[0] == HTTPStatus.NOT_FOUND
+
+    # everything else is a websocket
+    assert run(loop, b.process_request("/", {})) is None
+    loop.close()
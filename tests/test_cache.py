@@ -0,0 +1,68 @@
+import numpy as np
+
+from livestack.cache import ImageCache
+
+
+def test_put_read_before_a_newer_put():
+    cache = ImageCache(1024)
+    old, new = np.zeros(4), np.ones(4)
+
+    # a cold read starts, and a flush puts the new stack before it is done
+    version = cache.version("k")
+    assert cache.put("k", new)
+
+    assert not cache.put("k", old, version)
+    assert cache.get("k") is new
+
+
+def test_put_read_with_nothing_newer():
+    cache = ImageCache(1024)
+    value = np.zeros(4)
+
+    assert cache.put("k", value, cache.version("k"))
+    assert cache.get("k") is value
+
+
+def test_invalidate_makes_reads_stale():
+    cache = ImageCache(1024)
+    version = cache.version("k")
+
+    cache.invalidate("k")
+
+    assert not cache.put("k", np.zeros(4), version)
+    assert cache.get("k") is None
+
+
+def test_least_recently_used_evicted():
+    cache = ImageCache(3 * 32)
+    for key in "abc":
+        cache.put(key, np.zeros(4))
+
+    # a read makes "a" the most recent, so "b" goes first
+    cache.get("a")
+    cache.put("d", np.zeros(4))
+
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in "acd")
+    assert cache.size == 3 * 32
+
+
+def test_derived_values_count_and_go_with_their_stack():
+    cache = ImageCache(1024)
+    stack = np.zeros(4)
+    cache.put("k", stack)
+
+    derived = cache.derived("k", "reduced", stack, lambda: np.ones(2))
+    assert cache.derived("k", "reduced", stack, lambda: np.zeros(2)) is derived
+    assert cache.size == 32 + 16
+
+    # a new stack makes the derived value stale
+    cache.put("k", np.ones(4))
+    assert cache.size == 32
+
+
+def test_too_big_to_cache():
+    cache = ImageCache(16)
+
+    assert cache.put("k", np.zeros(4))
+    assert cache.get("k") is None and cache.size == 0
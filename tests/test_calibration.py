@@ -0,0 +1,59 @@
+import numpy as np
+
+from livestack.stacking_service import calibrate, inverse_normalized, to_float32
+
+
+def test_to_float32_unsigned_16_bit():
+    # unsigned 16 bit data is stored as signed integers with a BZERO of 32768
+    raw = np.array([[-32768, 0, 32767]], dtype=">i2")
+
+    out = to_float32(raw, 16, 1.0, 32768.0)
+
+    assert out.dtype == np.float32
+    np.testing.assert_allclose(out, [[0.0, 32768 / 65535, 1.0]], rtol=1e-6)
+
+
+def test_to_float32_scaled_data():
+    # signed bytes are stored as unsigned ones with a BZERO of -128
+    out = to_float32(np.array([0, 128, 255], dtype=np.uint8), 8, 1.0, -128.0)
+
+    np.testing.assert_allclose(out, [0.0, 0.0, 127 / 255], rtol=1e-6)
+
+    out = to_float32(np.array([10, 60], dtype=np.uint8), 8, 2.0, 10.0)
+
+    np.testing.assert_allclose(out, [30 / 255, 130 / 255], rtol=1e-6)
+
+
+def test_to_float32_float_data():
+    data = np.array([0.0, 0.25, 1.0], dtype=">f8")
+
+    out = to_float32(data, -64)
+
+    assert out.dtype == np.float32
+    np.testing.assert_array_equal(out, [0.0, 0.25, 1.0])
+
+
+def test_calibrate_in_bands():
+    rng = np.random.default_rng(0)
+    data = rng.random((37, 50), dtype=np.float32)
+    dark = rng.random((37, 50), dtype=np.float32) * np.float32(0.2)
+    inverse_flat = np.float32(0.5) + rng.random((37, 50), dtype=np.float32)
+    expected = np.clip((data - dark) * inverse_flat, 0.0, 1.0)
+
+    # a few rows per band, with a short last one
+    out = calibrate(data, dark, inverse_flat, band_bytes=data[0].nbytes * 4)
+
+    assert out is data
+    np.testing.assert_allclose(out, expected, rtol=1e-6)
+
+
+def test_calibrate_without_masters():
+    data = np.array([[-0.5, 0.5, 1.5]], dtype=np.float32)
+
+    np.testing.assert_array_equal(calibrate(data), [[0.0, 0.5, 1.0]])
+
+
+def test_inverse_normalized_dead_pixels():
+    flat = np.array([[0.5, 1.0, 0.0, 0.5]], dtype=np.float32)
+
+    np.testing.assert_allclose(inverse_normalized(flat), [[1.0, 0.5, 0.0, 1.0]])
@@ -0,0 +1,170 @@
+import numpy as np
+import pytest
+
+from livestack.stacking_service import DB
+
+
+def test_flush(tmp_path, light, frames):
+    db = DB(str(tmp_path / "db"))
+    img = light()
+    a, b = frames(2)
+
+    db.stage_stacked_image(img, a)
+    assert db.stage_stacked_image(img, b) == 2
+    # pending files count as processed, but aren't recorded yet
+    assert db.is_already_processed(a)
+    assert DB(str(tmp_path / "db")).is_already_processed(a) is False
+
+    db.flush(str(img.key))
+
+    assert db.contributors(str(img.key)) == [a, b]
+    assert not list((tmp_path / "db").glob("*.journal"))
+    reopened = DB(str(tmp_path / "db"))
+    assert reopened.is_already_processed(a) and reopened.is_already_processed(b)
+    assert reopened.get_stacked_image(str(img.key)).flush_id == img.flush_id
+
+
+def test_recover_journal_after_the_stack_was_written(tmp_path, monkeypatch, light, frames):
+    db = DB(str(tmp_path / "db"))
+    img = light()
+    (a,) = frames(1)
+    db.stage_stacked_image(img, a)
+
+    # dies after swapping in the stack, before recording the files
+    def crash(records):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(db, "_mark_processed", crash)
+    with pytest.raises(KeyboardInterrupt):
+        db.flush(str(img.key))
+    assert list((tmp_path / "db").glob("*.journal"))
+
+    reopened = DB(str(tmp_path / "db"))
+
+    assert reopened.is_already_processed(a)
+    assert not list((tmp_path / "db").glob("*.journal"))
+
+
+def test_discard_journal_when_the_stack_was_not_written(tmp_path, monkeypatch, light, frames):
+    db = DB(str(tmp_path / "db"))
+    old = light(0.25)
+    a, b = frames(2)
+    db.stage_stacked_image(old, a)
+    db.flush(str(old.key))
+
+    img = light()
+    db.stage_stacked_image(img, b)
+
+    # dies while writing the stack, leaving the one before it in place
+    def crash(*args):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(db.storage, "write", crash)
+    with pytest.raises(KeyboardInterrupt):
+        db.flush(str(img.key))
+
+    reopened = DB(str(tmp_path / "db"))
+
+    assert reopened.is_already_processed(a)
+    assert not reopened.is_already_processed(b)
+    assert not list((tmp_path / "db").glob("*.journal"))
+    assert float(reopened.get_stacked_image(str(img.key)).data.mean()) == 0.25
+
+
+def test_saturated_stack_round_trip(tmp_path, light, frames):
+    db = DB(str(tmp_path / "db"), storage_format="rice")
+    img = light()
+    img.data[2:4, 2:4] = 1.0
+    (a,) = frames(1)
+    db.stage_stacked_image(img, a)
+    db.flush(str(img.key))
+
+    stacked = DB(str(tmp_path / "db"), storage_format="rice").get_stacked_image(str(img.key))
+
+    assert stacked is not None and stacked.flush_id == img.flush_id
+    assert float(stacked.data.max()) == 1.0
+
+
+def test_unreadable_stack_is_kept(tmp_path, light, frames):
+    db = DB(str(tmp_path / "db"))
+    img = light()
+    a, b = frames(2)
+    db.stage_stacked_image(img, a)
+    db.flush(str(img.key))
+
+    path = tmp_path / "db" / f"{img.key}.fits"
+    path.write_bytes(path.read_bytes()[:100])
+    reopened = DB(str(tmp_path / "db"))
+
+    assert reopened.get_stacked_image(str(img.key)) is None
+
+    # the new stack doesn't replace the old one
+    reopened.stage_stacked_image(light(0.25), b)
+    reopened.flush(str(img.key))
+    (moved,) = (tmp_path / "db").glob(f"{img.key}.fits.unreadable-*")
+    assert moved.stat().st_size == 100
+
+
+def test_cold_read_racing_a_flush(tmp_path, light, frames):
+    db = DB(str(tmp_path / "db"))
+    a, b = frames(2)
+    old = light(0.25)
+    db.stage_stacked_image(old, a)
+    db.flush(str(old.key))
+    db.cache.invalidate(str(old.key))
+
+    new = light(0.75)
+    size = db.storage.size
+
+    # the flush lands after the old stack is read, before it is cached
+    def flush_then_size(key):
+        if db.storage.size is flush_then_size:
+            db.storage.size = size
+            db.stage_stacked_image(new, b)
+            db.flush(key)
+        return size(key)
+
+    db.storage.size = flush_then_size
+
+    assert db.get_stacked_image(str(old.key)) is new
+    assert db.get_stacked_image(str(old.key)) is new
+
+
+def test_npy_read_racing_a_flush(tmp_path, light, frames):
+    db = DB(str(tmp_path / "db"), storage_format="npy")
+    a, b = frames(2)
+    old = light(0.25)
+    db.stage_stacked_image(old, a)
+    db.flush(str(old.key))
+    db.cache.invalidate(str(old.key))
+
+    new = light(0.75)
+    header = db.storage.format.header
+
+    # the old header is read, then a write swaps in a new one and removes the
+    # pixels the old one named
+    def header_then_write(folder, key):
+        hdr = header(folder, key)
+        if db.storage.format.header is header_then_write:
+            db.storage.format.header = header
+            new.save(db.storage, "f" * 32)
+        return hdr
+
+    db.storage.format.header = header_then_write
+
+    np.testing.assert_allclose(db.get_stacked_image(str(old.key)).data, 0.75)
+    assert not list((tmp_path / "db").glob("*.unreadable-*"))
+
+
+def test_broken_npy_stack_is_kept(tmp_path, light, frames):
+    db = DB(str(tmp_path / "db"), storage_format="npy")
+    img = light()
+    db.stage_stacked_image(img, frames(1)[0])
+    db.flush(str(img.key))
+
+    (pixels,) = (tmp_path / "db").glob(f"{img.key}.*.npy")
+    pixels.unlink()
+    reopened = DB(str(tmp_path / "db"), storage_format="npy")
+
+    assert reopened.get_stacked_image(str(img.key)) is None
+    assert list((tmp_path / "db").glob(f"{img.key}.hdr.unreadable-*"))
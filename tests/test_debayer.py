@@ -0,0 +1,64 @@
+from colour_demosaicing import demosaicing_CFA_Bayer_bilinear
+import numpy as np
+import pytest
+
+from livestack import debayer
+
+
+def mosaic(r: float, g: float, b: float, pattern: str, h: int = 8, w: int = 10) -> np.ndarray:
+    """
+    A frame of a single colour as seen through the bayer `pattern`.
+    """
+    cell = np.array([{"R": r, "G": g, "B": b}[c] for c in pattern], dtype=np.float32).reshape(2, 2)
+    return np.tile(cell, (h // 2, w // 2))
+
+
+@pytest.mark.parametrize("mode", debayer.MODES)
+def test_debayer_shape_and_range(mode):
+    data = np.random.default_rng(0).random((16, 20), dtype=np.float32)
+
+    out = debayer.debayer(data, "RGGB", mode)
+
+    assert out.dtype == np.float32
+    assert out.shape == ((3, 8, 10) if mode == "superpixel" else (3, 16, 20))
+    assert out.min() >= 0.0 and out.max() <= 1.0
+
+
+@pytest.mark.parametrize("mode", debayer.MODES)
+@pytest.mark.parametrize("pattern", ["RGGB", "BGGR", "GRBG", "GBRG"])
+def test_debayer_flat_colour(mode, pattern):
+    out = debayer.debayer(mosaic(0.8, 0.4, 0.2, pattern), pattern, mode)
+
+    # away from the edges, where colour_demosaicing doesn't mirror
+    inner = out[:, 2:-2, 2:-2] if mode != "superpixel" else out
+    for channel, value in zip(inner, (0.8, 0.4, 0.2)):
+        np.testing.assert_allclose(channel, value, rtol=1e-5)
+
+
+def test_superpixel_averages_greens():
+    data = np.array([[0.1, 0.2, 0.5, 0.6], [0.4, 0.3, 0.8, 0.7]], dtype=np.float32)
+
+    out = debayer.superpixel(data, "RGGB")
+
+    np.testing.assert_allclose(out[:, 0, :], [[0.1, 0.5], [0.3, 0.7], [0.3, 0.7]])
+
+
+def test_superpixel_drops_odd_edges():
+    assert debayer.superpixel(np.zeros((5, 7), dtype=np.float32), "RGGB").shape == (3, 2, 3)
+
+
+def test_bilinear32_matches_bilinear():
+    data = np.random.default_rng(1).random((16, 20), dtype=np.float32)
+
+    out = debayer.bilinear32(data, "GRBG")
+    expected = np.moveaxis(demosaicing_CFA_Bayer_bilinear(data, pattern="GRBG"), 2, 0)
+
+    np.testing.assert_allclose(out[:, 1:-1, 1:-1], expected[:, 1:-1, 1:-1], rtol=1e-5)
+
+
+def test_mode_for():
+    modes = {"*_LIGHT_M42_*": "malvar", "*_LIGHT_*": "superpixel"}
+
+    assert debayer.mode_for("CAM_LIGHT_M42_L_60.0_100_-10", "bilinear32", modes) == "malvar"
+    assert debayer.mode_for("CAM_LIGHT_M31_L_60.0_100_-10", "bilinear32", modes) == "superpixel"
+    assert debayer.mode_for("CAM_FLAT_L_100_-10", "bilinear32", modes) == "bilinear32"
@@ -0,0 +1,169 @@
+import numpy as np
+
+from livestack import integration
+
+
+def noise(rng: np.random.Generator, n: int, pixels: int = 100000):
+    return [rng.normal(0.5, 0.02, pixels).astype(np.float32) for _ in range(n)]
+
+
+def rejection_rates(method: integration.SigmaClip, frames, batch: int = 1):
+    """
+    Stacks `frames`, `batch` at a time, and returns the fraction of pixels
+    rejected from each of them after the first.
+    """
+    mean = frames[0].copy()
+    state = method.start(mean, 1.0)
+    total = 1.0
+    rates = []
+
+    for i in range(1, len(frames), batch):
+        chunk = frames[i : i + batch]
+        before = state["w"].copy()
+
+        if batch == 1:
+            mean, state = method.add(mean, total, state, chunk[0], 1.0)
+        else:
+            mean, state = method.add_batch(mean, total, state, chunk, [1.0] * len(chunk))
+
+        total += len(chunk)
+        rates.append(1 - float(np.mean(state["w"] - before)) / len(chunk))
+
+    return rates
+
+
+def test_sigma_clip_keeps_gaussian_noise():
+    rates = rejection_rates(integration.SigmaClip(kappa=3.0), noise(np.random.default_rng(0), 100))
+
+    # nothing is clipped until there are enough frames to know the spread
+    assert rates[:3] == [0.0, 0.0, 0.0]
+    # a sample estimate of the spread makes for a bit more than the 0.27% of
+    # a known one, but that must not grow as rejections pile up
+    assert np.mean(rates) < 0.01
+    assert np.mean(rates[-50:]) < 0.006
+
+
+def test_sigma_clip_batches_keep_gaussian_noise():
+    rates = rejection_rates(
+        integration.SigmaClip(kappa=3.0), noise(np.random.default_rng(1), 97), batch=8
+    )
+
+    assert np.mean(rates[-6:]) < 0.006
+
+
+def test_sigma_clip_rejects_outliers():
+    rng = np.random.default_rng(2)
+    frames = noise(rng, 30, pixels=10000)
+    # a satellite trail through the first 100 pixels of every 10th frame
+    for i in (10, 20):
+        frames[i][:100] = 0.9
+
+    method = integration.SigmaClip(kappa=3.0)
+    mean, state, total = frames[0].copy(), method.start(frames[0], 1.0), 1.0
+    for data in frames[1:]:
+        mean, state = method.add(mean, total, state, data, 1.0)
+        total += 1
+
+    assert abs(float(mean[:100].mean()) - 0.5) < 0.005
+    # both trail samples are dropped, and perhaps the odd good one
+    assert state["w"][:100].max() <= 28
+
+
+def test_sigma_clip_variance_floor():
+    # a pixel that has been exactly the same in every frame, like a clipped
+    # one, would otherwise reject any change at all
+    method = integration.SigmaClip(kappa=3.0)
+    flat = np.zeros(10, dtype=np.float32)
+    mean, state = flat, method.start(flat, 1.0)
+    for i in range(1, 10):
+        mean, state = method.add(mean, i, state, flat, 1.0)
+
+    mean, state = method.add(mean, 10, state, np.full(10, 1.0 / 65535, dtype=np.float32), 1.0)
+
+    assert np.all(state["w"] == 11)
+
+
+def stack(method, frames, weights=None):
+    weights = weights or [1.0] * len(frames)
+    mean, state, total = frames[0].copy(), method.start(frames[0], weights[0]), weights[0]
+    for data, weight in zip(frames[1:], weights[1:]):
+        mean, state = method.add(mean, total, state, data, weight)
+        total += weight
+    return mean, state
+
+
+def test_mean_is_weighted():
+    frames = [np.full(4, v, dtype=np.float32) for v in (0.2, 0.4, 0.8)]
+
+    mean, _ = stack(integration.Mean(), frames, [1.0, 2.0, 1.0])
+
+    np.testing.assert_allclose(mean, 0.45, rtol=1e-6)
+
+
+def test_mean_batch_matches_one_by_one():
+    frames = noise(np.random.default_rng(3), 9, pixels=1000)
+    weights = [1.0, 0.5, 2.0, 1.0, 1.5, 1.0, 0.8, 1.2, 1.0]
+    method = integration.Mean()
+
+    expected, _ = stack(method, frames, weights)
+    mean, _ = method.add_batch(frames[0].copy(), weights[0], {}, frames[1:], weights[1:])
+
+    np.testing.assert_allclose(mean, expected, rtol=1e-5)
+
+
+def test_sigma_clip_batch_onto_a_new_stack():
+    frames = noise(np.random.default_rng(4), 20, pixels=1000)
+    method = integration.SigmaClip()
+
+    mean, state = method.add_batch(
+        frames[0].copy(), 1.0, method.start(frames[0], 1.0), frames[1:], [1.0] * 19
+    )
+
+    # the frames of a batch are clipped against the stack they go into, which
+    # is too small to know its spread yet
+    np.testing.assert_allclose(mean, np.mean(frames, axis=0), rtol=1e-5)
+    assert np.all(state["w"] == 20)
+
+
+def test_windowed_median():
+    frames = [np.full(4, v, dtype=np.float32) for v in (0.5, 0.5, 1.0, 0.3, 0.3, 0.3, 0.4)]
+    method = integration.WindowedMedian(window=3)
+
+    mean, state = stack(method, frames[:3])
+    # the outlier of the first window is gone
+    np.testing.assert_allclose(mean, 0.5)
+
+    mean, state = stack(method, frames)
+    # the median of each full window, then the frame still waiting in the next
+    np.testing.assert_allclose(mean, (3 * 0.5 + 3 * 0.3 + 0.4) / 7, rtol=1e-6)
+    assert len(state["window"]) == 1
+
+
+def test_windowed_median_resume():
+    method = integration.WindowedMedian(window=2)
+    state = method.resume(np.full(4, 0.5, dtype=np.float32), 4.0)
+
+    mean, state = method.add(
+        np.full(4, 0.5, dtype=np.float32), 4.0, state, np.full(4, 0.8, dtype=np.float32), 1.0
+    )
+
+    # the frame waits in the window, weighed as one frame against the stack
+    np.testing.assert_allclose(mean, (4 * 0.5 + 0.8) / 5, rtol=1e-6)
+
+
+def test_state_round_trip(tmp_path):
+    path = str(tmp_path / "stack.state.npz")
+    method = integration.SigmaClip()
+    _, state = stack(method, noise(np.random.default_rng(5), 3, pixels=100))
+
+    integration.save_state(path, method.name, state, "abc")
+
+    loaded = integration.load_state(path, method.name, "abc")
+    assert loaded is not None and sorted(loaded) == sorted(state)
+    for name in state:
+        np.testing.assert_array_equal(loaded[name], state[name])
+
+    # saved with another version of the stack, or for another method
+    assert integration.load_state(path, method.name, "def") is None
+    assert integration.load_state(path, "median", "abc") is None
+    assert integration.load_state(str(tmp_path / "missing.npz"), method.name, "abc") is None
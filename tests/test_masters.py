@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+
+from livestack.masters import MasterBuilder, combine
+
+
+def test_combine_median_in_bands():
+    rng = np.random.default_rng(0)
+    frames = [rng.random((37, 20), dtype=np.float32) for _ in range(5)]
+    frames[2][10, 10] = 1e6
+
+    # a few rows per band, with a short last one
+    out = combine(frames, "median", max_chunk_bytes=5 * 20 * 4 * 4, threads=2)
+
+    np.testing.assert_allclose(out, np.median(frames, axis=0), rtol=1e-6)
+
+
+def test_combine_sigma_leaves_out_outliers():
+    rng = np.random.default_rng(1)
+    frames = [rng.normal(0.5, 0.01, (8, 8)).astype(np.float32) for _ in range(15)]
+    clean = np.mean(frames, axis=0)
+    # a cosmic ray
+    frames.append(frames[0].copy())
+    frames[-1][3, 4] = 1.0
+
+    out = combine(frames, "sigma", kappa=3.0)
+
+    assert abs(out[3, 4] - 0.5) < 0.02
+    np.testing.assert_allclose(out[5:], np.mean(frames, axis=0)[5:], atol=0.01)
+    assert abs(out.mean() - clean.mean()) < 0.001
+
+
+def test_combine_scaled_frames():
+    frames = [np.full((4, 4), v, dtype=np.float32) for v in (0.2, 0.4, 0.8)]
+
+    out = combine(frames, "median", scales=np.array([0.2, 0.4, 0.8], dtype=np.float32))
+
+    np.testing.assert_allclose(out, 1.0)
+
+
+def test_master_set(tmp_path, light):
+    masters = MasterBuilder(str(tmp_path))
+    for i, value in enumerate((0.2, 0.3, 0.9)):
+        assert masters.add("k", light(value), f"dark{i}.fits") == i + 1
+
+    assert masters.keys() == ["k"] and masters.changed("k")
+
+    master, paths = masters.build("k")
+
+    np.testing.assert_allclose(master.data, 0.3)
+    assert master.subcount == 3 and master.weight == 3.0
+    assert [p for p, _ in paths] == ["dark0.fits", "dark1.fits", "dark2.fits"]
+    assert not masters.changed("k")
+
+    # a sub that comes in later is combined with the rest
+    masters.add("k", light(0.4), "dark3.fits")
+    assert masters.changed("k")
+    np.testing.assert_allclose(masters.build("k")[0].data, 0.35)
+
+    assert masters.discard("k") == ["dark0.fits", "dark1.fits", "dark2.fits", "dark3.fits"]
+    assert masters.keys() == [] and masters.build("k") is None
+    assert not os.path.exists(tmp_path / "k.subs")
+
+
+def test_flats_matched_in_brightness(tmp_path, light):
+    masters = MasterBuilder(str(tmp_path))
+    for i, value in enumerate((0.2, 0.4, 0.6)):
+        flat = light(value)
+        flat.image_type = "FLAT"
+        flat.data[0, 0] = value / 2
+        masters.add("k", flat, f"flat{i}.fits")
+
+    master, _ = masters.build("k")
+
+    # the same shape in each, at the average level
+    np.testing.assert_allclose(master.data[0, 0], 0.2, rtol=1e-5)
+    np.testing.assert_allclose(master.data[1:], 0.4, rtol=1e-5)
+
+
+def test_unfinished_sets_discarded_on_restart(tmp_path, light):
+    MasterBuilder(str(tmp_path)).add("k", light(), "dark.fits")
+
+    masters = MasterBuilder(str(tmp_path))
+
+    assert masters.keys() == [] and not os.path.exists(tmp_path / "k.subs")
@@ -0,0 +1,57 @@
+from os.path import join
+
+import numpy as np
+from PIL import Image as PILImage
+
+from livestack.preview import PreviewRenderer, halve
+
+
+def tiles(folder: str, changed):
+    files = join(folder, "k_files")
+    return {
+        tuple(t): np.asarray(PILImage.open(join(files, str(t[0]), f"{t[1]}_{t[2]}.png")))
+        for t in changed
+    }
+
+
+def test_halve_8_bit():
+    image = np.array([[1, 2, 10], [2, 2, 20], [255, 254, 0]], dtype=np.uint8)[:, :, np.newaxis]
+
+    out = halve(image)
+
+    assert out.dtype == np.uint8
+    # rounded, with the odd last row and column repeated
+    np.testing.assert_array_equal(out[:, :, 0], [[2, 15], [255, 0]])
+
+
+def test_tiles_only_where_the_stack_changed(tmp_path):
+    rng = np.random.default_rng(0)
+    data = np.clip(rng.normal(0.1, 0.01, (3, 128 + 300, 128 + 500)), 0, 1).astype(np.float32)
+    renderer = PreviewRenderer(tile_size=64)
+    renderer._params["k"] = [renderer._stretch_params(c) for c in data]
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+
+    first = renderer.render_tiles("k", data, str(tmp_path / "a"))
+    assert len(first["changed"]) == sum(
+        np.ceil(300 / 2 ** (9 - level) / 64) * np.ceil(500 / 2 ** (9 - level) / 64)
+        for level in range(10)
+    )
+
+    data[:, 200:210, 300:350] += 0.05
+    update = renderer.render_tiles("k", data, str(tmp_path / "a"))
+
+    # the two tiles under the change, and those covering them at the smaller
+    # levels, columns 3 and 4 being in different pairs
+    changed = [[9, 3, 2], [9, 4, 2], [8, 1, 1], [8, 2, 1], [7, 0, 0], [7, 1, 0]]
+    assert update["changed"] == changed + [[level, 0, 0] for level in range(6, -1, -1)]
+    assert renderer.render_tiles("k", data, str(tmp_path / "a"))["changed"] == []
+
+    # the same as a pyramid rendered from scratch
+    fresh = PreviewRenderer(tile_size=64)
+    fresh._params["k"] = renderer._params["k"]
+    fresh.render_tiles("k", data, str(tmp_path / "b"))
+
+    expected = tiles(str(tmp_path / "b"), first["changed"])
+    for t, tile in tiles(str(tmp_path / "a"), first["changed"]).items():
+        np.testing.assert_array_equal(tile, expected[t])
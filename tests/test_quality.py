@@ -0,0 +1,69 @@
+import numpy as np
+
+from livestack.quality import QualityGate, measure
+
+
+def metrics(stars: float = 100, fwhm: float = 3.0, eccentricity: float = 0.2, noise: float = 0.01):
+    return {
+        "stars": float(stars),
+        "fwhm": fwhm,
+        "hfr": fwhm / 2,
+        "eccentricity": eccentricity,
+        "background": 0.1,
+        "noise": noise,
+    }
+
+
+def test_measure_star_field(star_field):
+    sharp = measure(star_field(shape=(512, 512), n=150, sigma=1.5))
+    soft = measure(star_field(shape=(512, 512), n=150, sigma=2.5))
+
+    # a few stars are lost where they overlap
+    assert 100 <= sharp["stars"] <= 150
+    assert sharp["fwhm"] < soft["fwhm"]
+    assert abs(sharp["background"] - 0.1) < 0.01
+
+
+def test_measure_empty_frame():
+    out = measure(np.full((256, 256), 0.1, dtype=np.float32))
+
+    assert out["stars"] == 0 and np.isnan(out["fwhm"])
+
+
+def test_gate_takes_everything_by_default():
+    gate = QualityGate()
+
+    assert gate.judge("k", metrics()) == (None, 1.0)
+    assert gate.judge("k", metrics(stars=0, fwhm=float("nan"))) == (None, 1.0)
+
+
+def test_gate_rejects_over_the_limits():
+    gate = QualityGate(max_fwhm=4.0, max_eccentricity=0.5, min_stars=20)
+
+    assert gate.judge("k", metrics())[0] is None
+    assert gate.judge("k", metrics(fwhm=4.5))[0].startswith("FWHM")
+    assert gate.judge("k", metrics(fwhm=float("nan")))[0].startswith("FWHM")
+    assert gate.judge("k", metrics(eccentricity=0.6))[0].startswith("eccentricity")
+    assert gate.judge("k", metrics(stars=10)) == ("only 10 stars found", 0.0)
+
+
+def test_gate_rejects_passing_cloud():
+    gate = QualityGate(min_star_ratio=0.5)
+    for stars in (100, 110, 90):
+        assert gate.judge("k", metrics(stars=stars))[0] is None
+
+    rejected, weight = gate.judge("k", metrics(stars=40))
+
+    assert rejected == "only 40 stars found, against 100 in recent frames" and weight == 0.0
+    # measured against the frames of its own key only
+    assert gate.judge("other", metrics(stars=40))[0] is None
+
+
+def test_gate_weights_against_recent_frames():
+    gate = QualityGate(weighting=True)
+    gate.judge("k", metrics(fwhm=3.0))
+
+    _, sharper = gate.judge("k", metrics(fwhm=2.0))
+    _, noisier = gate.judge("k", metrics(fwhm=3.0, noise=0.02))
+
+    assert sharper > 1.0 and noisier < 1.0
@@ -0,0 +1,95 @@
+from threading import Thread
+
+import numpy as np
+
+from livestack.stacking_service import Batch, Stacker
+
+
+def test_batch_without_a_stack(tmp_path, light, frames):
+    # the stack the batch was aligned to was unreadable, and moved aside
+    s = Stacker(str(tmp_path / "storage"), str(tmp_path / "output"), integrations={"LIGHT": "mean"})
+    paths = frames(3)
+    images = [light(v) for v in (0.2, 0.4, 0.9)]
+
+    stacked = s._stack_batch(Batch(str(images[0].key), list(zip(paths, images))))
+
+    assert stacked.subcount == 3 and stacked.weight == 3.0
+    np.testing.assert_allclose(stacked.data, 0.5, rtol=1e-6)
+    assert s.db.pending[str(stacked.key)] and all(s.db.is_already_processed(p) for p in paths)
+    s.db.close()
+
+
+def test_incomplete_frame_is_tried_again(tmp_path, light_file):
+    s = Stacker(
+        str(tmp_path / "storage"), str(tmp_path / "output"), incomplete_wait=0.0, incomplete_tries=2
+    )
+    path = tmp_path / "light.fits"
+    whole = light_file(path)
+
+    # still being written, first without a whole header, then short of pixels
+    for size in (1000, 5000):
+        path.write_bytes(whole[:size])
+        assert s._guard(str(path), s._triage, str(path)) is None
+        assert not s.db.is_already_processed(str(path))
+        s._requeue_due()
+        assert s.queue.get_nowait() == str(path)
+
+    path.write_bytes(whole)
+    img = s._triage(str(path))
+
+    assert img is not None and img.key is not None and img.missing == 0
+    s.db.close()
+
+
+def test_incomplete_frame_is_rejected_in_the_end(tmp_path, light_file):
+    s = Stacker(
+        str(tmp_path / "storage"), str(tmp_path / "output"), incomplete_wait=0.0, incomplete_tries=1
+    )
+    path = tmp_path / "light.fits"
+    path.write_bytes(light_file(path)[:5000])
+
+    assert s._triage(str(path)) is None
+    assert not s.db.is_already_processed(str(path))
+
+    assert s._triage(str(path)) is None
+    assert s.db.is_already_processed(str(path))
+    s.db.close()
+
+
+def test_sub_is_collected_once(tmp_path, light_file):
+    s = Stacker(str(tmp_path / "storage"), str(tmp_path / "output"))
+    path = tmp_path / "dark.fits"
+    light_file(path, image_type="Dark Frame")
+
+    # queued again by a rescan before its master set was built
+    s._process_item(str(path))
+    s._process_item(str(path))
+
+    (key,) = s.masters.keys()
+    assert len(s.masters._sets[key][1]) == 1
+    assert s.db.is_already_processed(str(path))
+
+    s._build_master(key)
+
+    assert s.db.get_stacked_image(key).subcount == 1
+    assert s.db.is_already_processed(str(path))
+    s.db.close()
+
+
+def test_frames_wait_for_subs_queued_before_them(tmp_path):
+    s = Stacker(str(tmp_path / "storage"), str(tmp_path / "output"))
+    s._subs_in_flight["dark.fits"] = ("DARK_KEY", 2)
+
+    # queued after the sub, or for another master, they don't wait
+    s._await_subs("DARK_KEY", 1)
+    s._await_subs("FLAT_KEY", 3)
+
+    waiter = Thread(target=s._await_subs, args=("DARK_KEY", 3))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()
+
+    s._done("dark.fits")
+    waiter.join(1)
+    assert not waiter.is_alive()
+    s.db.close()
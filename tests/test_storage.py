@@ -0,0 +1,93 @@
+from astropy.io.fits import Header
+import numpy as np
+import pytest
+
+from livestack import storage
+
+
+def frame() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return np.clip(rng.normal(0.3, 0.05, (3, 40, 60)), 0.0, 1.0).astype(np.float32)
+
+
+def header() -> Header:
+    hdr = Header()
+    hdr.set("OBJECT", "M42")
+    hdr.set("SUBCOUNT", 12)
+    hdr.set("FLUSHID", "0123456789abcdef0123456789abcdef")
+    return hdr
+
+
+def read(s: storage.Storage, key: str):
+    return s.read(key, lambda pixels, hdr: (np.array(pixels, dtype=np.float32), hdr.copy()))
+
+
+# how close each format keeps the pixels
+TOLERANCE = {"fits": 0.0, "gzip": 0.0, "npy": 0.0, "float16": 1e-3, "rice": 0.01}
+
+
+@pytest.mark.parametrize("name", storage.FORMATS)
+def test_round_trip(tmp_path, name):
+    s = storage.Storage(str(tmp_path), name)
+    data = frame()
+
+    s.write("CAM_LIGHT_M42", data, header())
+
+    assert s.exists("CAM_LIGHT_M42")
+    pixels, hdr = read(s, "CAM_LIGHT_M42")
+    assert pixels.shape == data.shape
+    np.testing.assert_allclose(pixels, data, atol=TOLERANCE[name])
+    assert hdr["OBJECT"] == "M42" and hdr["SUBCOUNT"] == 12
+    assert s.header("CAM_LIGHT_M42")["FLUSHID"] == header()["FLUSHID"]
+
+
+@pytest.mark.parametrize("name", storage.FORMATS)
+def test_round_trip_saturated(tmp_path, name):
+    s = storage.Storage(str(tmp_path), name)
+    data = frame()
+    # saturated stars, and a corner with nothing left after the dark
+    data[:, 10:20, 10:20] = 1.0
+    data[:, 30:, 50:] = 0.0
+
+    s.write("CAM_LIGHT_M42", data, header())
+
+    pixels, _ = read(s, "CAM_LIGHT_M42")
+    assert pixels.max() <= 1.0 and pixels.min() >= 0.0
+    np.testing.assert_allclose(pixels, data, atol=TOLERANCE[name])
+
+
+def test_quarantine(tmp_path):
+    s = storage.Storage(str(tmp_path), "npy")
+    s.write("CAM_LIGHT_M42", frame(), header())
+
+    moved = s.quarantine("CAM_LIGHT_M42")
+
+    assert len(moved) == 2 and not s.exists("CAM_LIGHT_M42")
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(p.split("/")[-1] for p in moved)
+    assert s.quarantine("CAM_LIGHT_M42") == []
+
+
+@pytest.mark.parametrize("name", storage.FORMATS)
+def test_format_change(tmp_path, name):
+    # a stack written in another format is read, and replaced on the next write
+    storage.Storage(str(tmp_path), "fits").write("CAM_LIGHT_M42", frame(), header())
+    s = storage.Storage(str(tmp_path), name)
+
+    pixels, _ = read(s, "CAM_LIGHT_M42")
+    np.testing.assert_array_equal(pixels, frame())
+
+    s.write("CAM_LIGHT_M42", frame(), header())
+    assert s.find("CAM_LIGHT_M42") is s.format
+    files = sorted(p.name for p in tmp_path.iterdir())
+    assert files == sorted(p.split("/")[-1] for p in s.format.files(str(tmp_path), "CAM_LIGHT_M42"))
+
+
+def test_npy_keys_that_are_prefixes(tmp_path):
+    s = storage.Storage(str(tmp_path), "npy")
+    s.write("CAM_LIGHT_M42_-10", frame(), header())
+    s.write("CAM_LIGHT_M42_-10.5", frame() / 2, header())
+
+    s.write("CAM_LIGHT_M42_-10", frame(), header())
+
+    pixels, _ = read(s, "CAM_LIGHT_M42_-10.5")
+    np.testing.assert_array_equal(pixels, frame() / 2)
@@ -0,0 +1,112 @@
+import os
+import time
+
+from livestack.stacking_service import DB
+from livestack.watcher import PendingFiles, Watcher
+
+
+def scan(db: DB, folder: str):
+    queued = []
+    Watcher(queued.append, index=db)._scan_dir(folder)
+    return queued
+
+
+def age(*paths, seconds: float = 60):
+    past = time.time() - seconds
+    for path in paths:
+        os.utime(path, (past, past))
+
+
+def test_pending_file_handed_on_once_settled(tmp_path):
+    pending = PendingFiles(lambda path: None, settle=0.2)
+    path = tmp_path / "light.fits"
+    path.write_bytes(b"x")
+    pending.add(str(path))
+
+    assert pending._check() == []
+    assert pending._check() == []
+
+    # still being written, so it has to hold still for another while
+    time.sleep(0.25)
+    path.write_bytes(b"xx")
+    assert pending._check() == []
+    time.sleep(0.25)
+    assert pending._check() == [str(path)]
+    assert pending._check() == []
+
+
+def test_pending_file_deleted_before_it_settled(tmp_path):
+    pending = PendingFiles(lambda path: None, settle=0.0)
+    path = tmp_path / "light.fits"
+    path.write_bytes(b"x")
+    pending.add(str(path))
+
+    path.unlink()
+
+    assert pending._check() == []
+    assert pending._files == {}
+
+
+def test_scan_sets_and_trusts_watermarks(tmp_path):
+    folder = tmp_path / "2026-10-17"
+    folder.mkdir()
+    paths = [folder / f"light{i}.fits" for i in range(3)]
+    for path in paths:
+        path.write_bytes(b"")
+    (folder / "notes.txt").write_bytes(b"")
+    age(*paths, folder)
+
+    db = DB(str(tmp_path / "db"))
+
+    # only the frames, in order, and nothing settles while they are new
+    assert scan(db, str(folder)) == [str(p) for p in paths]
+    assert db.get_watermark(str(folder)) is None
+
+    for path in paths:
+        db.mark_processed(str(path))
+
+    assert scan(db, str(folder)) == []
+    assert db.get_watermark(str(folder)) == os.stat(folder).st_mtime_ns
+
+    # the directory is skipped without looking its files up
+    db.processed_in = lambda dir: set()
+    assert scan(db, str(folder)) == []
+    del db.processed_in
+
+    # until a file is added
+    new = folder / "light3.fits"
+    new.write_bytes(b"")
+    age(new, folder, seconds=30)
+    assert scan(db, str(folder)) == [str(new)]
+
+
+def test_recent_files_wait_to_settle(tmp_path):
+    path = tmp_path / "light.fits"
+    path.write_bytes(b"")
+    queued = []
+    watcher = Watcher(queued.append, settle=60)
+
+    watcher._scan_dir(str(tmp_path))
+
+    assert queued == [] and str(path) in watcher.pending._files
+
+
+def test_no_watermark_for_staged_frames(tmp_path, light):
+    folder = tmp_path / "2026-10-17"
+    folder.mkdir()
+    path = folder / "light.fits"
+    path.write_bytes(b"")
+    age(path, folder)
+
+    db = DB(str(tmp_path / "db"))
+    db.stage_stacked_image(light(), str(path))
+
+    # staged but not written, so queued again for the stacker to skip
+    assert scan(db, str(folder)) == [str(path)]
+    assert db.get_watermark(str(folder)) is None
+
+    # the power fails before the flush
+    db = DB(str(tmp_path / "db"))
+
+    assert not db.is_already_processed(str(path))
+    assert scan(db, str(folder)) == [str(path)]